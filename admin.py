@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, Request, Form, HTTPException
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 import asyncio
+import json
 import uuid
 
 from account import get_current_admin, pwd_context
@@ -15,6 +16,9 @@ from backend.db import (
     get_all_invite_codes, create_invite_code,
     get_all_subsystem_status, list_prompt_versions,
 )
+from backend.rag import embedding_cache_stats, corpus_cache_stats
+from backend.prompt_budget import token_cache_stats
+from backend.vector_cache import session_vector_cache
 
 admin_router = APIRouter()
 templates = Jinja2Templates(directory="templates")
@@ -40,21 +44,35 @@ async def admin_users(request: Request, admin=Depends(get_current_admin)):
 
 @admin_router.get("/perf", response_class=HTMLResponse)
 async def admin_perf(request: Request, admin=Depends(get_current_admin)):
-    """性能调优：子系统状态 + 近期 trace + prompt 版本。"""
+    """性能调优：子系统状态 + 近期 trace + 缓存命中（含语义回答缓存）+ prompt 版本。"""
     subsystems = await get_all_subsystem_status()
     traces = await database.fetch_all(
         """SELECT t.id, t.session_id, t.user_id, u.username, t.query, t.route,
-                  t.iterations, t.duration_ms, t.tokens_in, t.tokens_out, t.created_at
+                  t.iterations, t.duration_ms, t.tokens_in, t.tokens_out, t.tokens_cached,
+                  t.cache_hit, t.prompt_budget, t.created_at
            FROM agent_traces t LEFT JOIN users u ON u.id = t.user_id
            ORDER BY t.created_at DESC LIMIT 50"""
     )
     traces = [dict(r) for r in traces]
+    for t in traces:
+        if isinstance(t["prompt_budget"], str):
+            t["prompt_budget"] = json.loads(t["prompt_budget"])
+    # 语义回答缓存命中率（近 24 小时，按路径）
+    answer_cache = await database.fetch_all(
+        """SELECT route, COUNT(*) AS total, COUNT(*) FILTER (WHERE cache_hit) AS hits
+           FROM agent_traces
+           WHERE created_at > NOW() - INTERVAL '24 hours'
+           GROUP BY route ORDER BY total DESC"""
+    )
+    answer_cache = [dict(r) for r in answer_cache]
     prompt_versions = await list_prompt_versions("agent_tool_rules")
     return templates.TemplateResponse("admin/perf.html", {
         "request": request, "admin": admin,
         "subsystems": subsystems, "traces": traces,
+        "answer_cache": answer_cache,
         "prompt_versions": prompt_versions,
         "prompt_name": "agent_tool_rules",
+        "caches": [embedding_cache_stats(), corpus_cache_stats(), token_cache_stats(), session_vector_cache.stats()],
     })
 
 
@@ -2,12 +2,14 @@
 Phase 2 — Agent 循环（ReAct / Plan-Solve）
 
 入口：run_agent_chat(query, session_id, persona, history_text, ...) → dict
+      run_agent_chat_stream(...) → AsyncIterator[dict]（逐轮进度事件，供 /chat SSE）
 
 设计要点：
   • 5 个工具：search_kb / read_document / list_documents / web_search / search_history
   • 智能路由（needs_agent）：60-70% 的 query 不进 Agent，直接走 RAG 路径
   • 提前退出：system prompt 鼓励 Agent 一旦拿到强证据就立即作答
-  • 并行 tool 调用：同一轮内多 function_call 用 asyncio.gather 同时执行
+  • 并行 tool 调用：同一轮内多 function_call 用 asyncio.gather 同时执行；
+    多个 search_kb / search_history 合并为一次 embedding + 单连接批量检索
   • 完整 trace：每次工具调用都记录到返回值的 agent_trace 字段，便于调教
 
 输出：
@@ -21,21 +23,25 @@ Phase 2 — Agent 循环（ReAct / Plan-Solve）
     "tokens_in":  int,                # 累计输入 token
     "tokens_out": int,                # 累计输出 token
     "iterations": int,                # 实际循环轮数
+    "complete":   bool,               # 模型正常收尾（False 时不写入语义回答缓存）
   }
 """
 import asyncio
 import re
 import time
-from typing import Any
+from typing import Any, AsyncIterator
 
 from google.genai import types
 
 from settings import client, embed_client, logger, settings
-from .db import get_active_prompt, upsert_prompt_version
+from .db import get_active_prompt, upsert_prompt_version, request_connection
 from .rag import (
     get_embedding,
+    get_embeddings_cached,
     query_rag,
+    query_rag_many,
     query_history,
+    query_history_many,
     list_session_documents,
     get_full_document,
 )
@@ -211,6 +217,11 @@ async def _get_cached_rules() -> tuple[str, int]:
     return content, version_id
 
 
+async def current_prompt_version() -> int:
+    """当前 active 的工具规则 version_id（语义回答缓存键的一部分）。"""
+    return (await _get_cached_rules())[1]
+
+
 async def build_system_prompt(persona: str | None) -> tuple[str, int]:
     """
     拼接 persona（若有）+ 当前 active 的工具规则。
@@ -301,25 +312,8 @@ async def _dispatch_tool(name: str, args: dict, session_id: str) -> tuple[str, l
             query = args.get("query", "")
             top_k = int(args.get("top_k", 4))
             embedding = await get_embedding(embed_client, query)
-            results = await query_rag(embedding, session_id=session_id)
-            if top_k and len(results) > top_k:
-                results = results[:top_k]
-            if not results:
-                return "（无匹配片段）", []
-            text = "\n\n".join(
-                f"[{r['source_file']} 第{r['chunk_index']}段, distance={round(r['distance'], 3)}]\n{r['content']}"
-                for r in results
-            )
-            cites = [
-                {
-                    "source": r["source_file"],
-                    "chunk": r["chunk_index"],
-                    "score": round(1 - r["distance"], 3),
-                    "snippet": (r.get("original_content") or r["content"])[:200].strip(),
-                }
-                for r in results
-            ]
-            return text, cites
+            results = await query_rag(embedding, session_id=session_id, query_text=query)
+            return _format_kb_results(results, top_k)
 
         if name == "read_document":
             filename = args.get("filename", "")
@@ -347,13 +341,8 @@ async def _dispatch_tool(name: str, args: dict, session_id: str) -> tuple[str, l
         if name == "search_history":
             query = args.get("query", "")
             embedding = await get_embedding(embed_client, query)
-            results = await query_history(embedding, session_id=session_id, threshold=0.55)
-            if not results:
-                return "（历史对话中无相关内容）", []
-            return "\n\n".join(
-                f"[{r['created_at']}] {r['snippet']}{'…' if len(r['content']) > 300 else ''}"
-                for r in results
-            ), []
+            results = await query_history(embedding, session_id=session_id, threshold=_HISTORY_THRESHOLD)
+            return _format_history_results(results)
 
         return f"[ToolError] 未知工具: {name}", []
 
@@ -362,6 +351,89 @@ async def _dispatch_tool(name: str, args: dict, session_id: str) -> tuple[str, l
         return f"[ToolError] {name}: {exc}", []
 
 
+_HISTORY_THRESHOLD = 0.55
+_RETRIEVAL_TOOLS = ("search_kb", "search_history")
+
+
+def _format_kb_results(results: list, top_k: int) -> tuple[str, list]:
+    if top_k and len(results) > top_k:
+        results = results[:top_k]
+    if not results:
+        return "（无匹配片段）", []
+    text = "\n\n".join(
+        f"[{r['source_file']} 第{r['chunk_index']}段, distance={round(r['distance'], 3)}]\n{r['content']}"
+        for r in results
+    )
+    cites = [
+        {
+            "source": r["source_file"],
+            "chunk": r["chunk_index"],
+            "score": round(1 - r["distance"], 3),
+            "snippet": (r.get("original_content") or r["content"])[:200].strip(),
+        }
+        for r in results
+    ]
+    return text, cites
+
+
+def _format_history_results(results: list) -> tuple[str, list]:
+    if not results:
+        return "（历史对话中无相关内容）", []
+    return "\n\n".join(
+        f"[{r['created_at']}] {r['snippet']}{'…' if len(r['content']) > 300 else ''}"
+        for r in results
+    ), []
+
+
+async def _dispatch_retrieval_batch(calls: list, session_id: str) -> list[tuple[str, list]]:
+    """
+    同一轮的多个 search_kb / search_history 合并执行：所有 query 一次 embed_content，
+    知识库与历史检索各一条批量 SQL（hnsw 大会话为同一连接上依次查询），再按调用顺序分发结果。
+    """
+    queries = [args.get("query", "") for _, args in calls]
+    kb = [i for i, (name, _) in enumerate(calls) if name == "search_kb"]
+    hist = [i for i, (name, _) in enumerate(calls) if name == "search_history"]
+    try:
+        embeddings = await get_embeddings_cached(embed_client, queries)
+        async with request_connection():
+            kb_results = await query_rag_many(
+                [embeddings[i] for i in kb], session_id, query_texts=[queries[i] for i in kb],
+            )
+            hist_results = await query_history_many(
+                [embeddings[i] for i in hist], session_id, threshold=_HISTORY_THRESHOLD,
+            )
+    except Exception as exc:
+        logger.exception("Agent 批量检索失败")
+        return [(f"[ToolError] {name}: {exc}", []) for name, _ in calls]
+
+    out: list = [None] * len(calls)
+    for i, results in zip(kb, kb_results):
+        out[i] = _format_kb_results(results, int(calls[i][1].get("top_k", 4)))
+    for i, results in zip(hist, hist_results):
+        out[i] = _format_history_results(results)
+    return out
+
+
+async def _dispatch_round(function_calls: list, session_id: str) -> list[tuple[str, list]]:
+    """执行一轮全部 function_call：≥ 2 个检索类调用走批量路径，其余工具照常并行，结果保持原顺序。"""
+    calls = [(fc.name, dict(fc.args) if fc.args else {}) for fc in function_calls]
+    batched = [i for i, (name, _) in enumerate(calls) if name in _RETRIEVAL_TOOLS]
+    if len(batched) < 2:
+        return await asyncio.gather(*[_dispatch_tool(name, args, session_id) for name, args in calls])
+
+    others = [i for i in range(len(calls)) if i not in batched]
+    batch_out, *other_out = await asyncio.gather(
+        _dispatch_retrieval_batch([calls[i] for i in batched], session_id),
+        *[_dispatch_tool(*calls[i], session_id) for i in others],
+    )
+    out: list = [None] * len(calls)
+    for i, r in zip(batched, batch_out):
+        out[i] = r
+    for i, r in zip(others, other_out):
+        out[i] = r
+    return out
+
+
 # ── Main Loop ─────────────────────────────────────────────────────────────────
 
 async def run_agent_chat(
@@ -373,12 +445,48 @@ async def run_agent_chat(
     web_info: str = "",
 ) -> dict:
     """
-    Agent 主循环。返回结构化结果，由 main.py 调用方组装最终响应。
+    Agent 主循环（非流式）。返回结构化结果，由 main.py 调用方组装最终响应。
+
+    内部消费 run_agent_chat_stream 的事件流，只保留最后的 final 事件。
+    """
+    result: dict = {}
+    async for event in run_agent_chat_stream(
+        query=query,
+        session_id=session_id,
+        persona=persona,
+        history_text=history_text,
+        web_info=web_info,
+    ):
+        if event["type"] == "final":
+            result = {k: v for k, v in event.items() if k != "type"}
+    return result
+
+
+async def run_agent_chat_stream(
+    *,
+    query: str,
+    session_id: str,
+    persona: str | None,
+    history_text: str,
+    web_info: str = "",
+) -> AsyncIterator[dict]:
+    """
+    Agent 主循环（流式）。边执行边 yield 结构化事件：
+
+      {"type": "round_start", "round": n}
+      {"type": "delta",       "round": n, "text": "..."}          模型文本分块
+      {"type": "tool_call",   "round": n, "tool": ..., "args": {...}}
+      {"type": "tool_result", "round": n, "tool": ..., "result_preview": "..."}
+      {"type": "final", "answer": ..., "citations": [...], "agent_trace": [...],
+       "tokens_in": int, "tokens_out": int, "iterations": int, "prompt_version_id": int}
+
+    某轮 delta 之后若出现 tool_call，说明该轮文本只是中间思考；
+    没有 tool_call 的那一轮的 delta 即最终回答的分块。
 
     流程：
       1. 构造 system_instruction（persona 拼接 + 工具规则）
       2. 启动 contents = [user_message]，每轮：
-         - 调 Gemini，拿到 function_calls 或 final answer
+         - 流式调 Gemini，拿到 function_calls 或 final answer
          - 如有 function_calls → asyncio.gather 并行执行 → 喂回
          - 否则 → 回答完成，break
       3. 累计 tokens、citations、trace
@@ -409,36 +517,50 @@ async def run_agent_chat(
     tokens_out = 0
 
     final_answer = ""
+    complete = False   # 模型正常给出最终回答（非调用失败 / 轮数耗尽兜底）
     iterations = 0
+    text_parts: list = []
 
     for round_num in range(1, settings.agent_max_iterations + 1):
         iterations = round_num
+        yield {"type": "round_start", "round": round_num}
+
+        # 流式拉取本轮输出：文本分块即时下发，所有 part 累积成一条 model content
+        parts: list = []
+        usage = None
         try:
-            response = await client.aio.models.generate_content(
+            stream = await client.aio.models.generate_content_stream(
                 model=settings.generation_model,
                 contents=contents,
                 config=config,
             )
+            async for chunk in stream:
+                if chunk.usage_metadata:
+                    usage = chunk.usage_metadata
+                if not chunk.candidates or not chunk.candidates[0].content:
+                    continue
+                for part in chunk.candidates[0].content.parts or []:
+                    parts.append(part)
+                    if part.text and not part.thought:
+                        yield {"type": "delta", "round": round_num, "text": part.text}
         except Exception as e:
             logger.exception("Agent LLM 调用失败 (round %d): %s", round_num, e)
             final_answer = f"（Agent 调用失败：{e}）"
             break
 
-        usage = response.usage_metadata
         if usage:
             tokens_in  += getattr(usage, "prompt_token_count",     0) or 0
             tokens_out += getattr(usage, "candidates_token_count", 0) or 0
 
-        candidate = response.candidates[0]
-        contents.append(candidate.content)
-        parts = candidate.content.parts or []
+        contents.append(types.Content(role="model", parts=parts))
 
         function_calls = [p.function_call for p in parts if p.function_call]
-        text_parts     = [p.text for p in parts if p.text]
+        text_parts     = [p.text for p in parts if p.text and not p.thought]
 
         if not function_calls:
             # 模型给出最终回答
-            final_answer = "\n".join(text_parts).strip() or "（模型未输出文本）"
+            final_answer = "".join(text_parts).strip() or "（模型未输出文本）"
+            complete = bool(text_parts)
             logger.info("Agent round %d → final answer (%d chars)", round_num, len(final_answer))
             break
 
@@ -449,10 +571,14 @@ async def run_agent_chat(
             len(function_calls),
             [fc.name for fc in function_calls],
         )
-        results = await asyncio.gather(*[
-            _dispatch_tool(fc.name, dict(fc.args) if fc.args else {}, session_id)
-            for fc in function_calls
-        ])
+        for fc in function_calls:
+            yield {
+                "type": "tool_call",
+                "round": round_num,
+                "tool": fc.name,
+                "args": dict(fc.args) if fc.args else {},
+            }
+        results = await _dispatch_round(function_calls, session_id)
 
         tool_response_parts = []
         for fc, (result_text, cites) in zip(function_calls, results):
@@ -464,6 +590,12 @@ async def run_agent_chat(
                 "args": args_dict,
                 "result_preview": result_text[:200],
             })
+            yield {
+                "type": "tool_result",
+                "round": round_num,
+                "tool": fc.name,
+                "result_preview": result_text[:200],
+            }
             tool_response_parts.append(
                 types.Part.from_function_response(
                     name=fc.name,
@@ -476,7 +608,7 @@ async def run_agent_chat(
     else:
         # 循环耗尽未给最终答案：用最后一轮的 text_parts 兜底
         final_answer = (
-            "\n".join(text_parts).strip()
+            "".join(text_parts).strip()
             if text_parts else "（已达最大工具调用上限，未能完整回答）"
         )
 
@@ -489,7 +621,8 @@ async def run_agent_chat(
             seen.add(key)
             deduped.append(c)
 
-    return {
+    yield {
+        "type": "final",
         "answer": final_answer,
         "citations": deduped,
         "agent_trace": trace,
@@ -497,4 +630,5 @@ async def run_agent_chat(
         "tokens_out": tokens_out,
         "iterations": iterations,
         "prompt_version_id": prompt_version_id,
+        "complete": complete,
     }
@@ -0,0 +1,127 @@
+"""
+两级缓存：进程内 TTL-LRU（cachetools）+ 可选 Redis 共享层。
+
+  • 本地层：每个 worker 进程独立，命中零网络开销
+  • 共享层：同一 Redis（REDIS_URL，与 Celery broker 同库）在多进程 / 多机间共享，
+    本地未命中时回查，命中后回填本地层
+  • Redis 不可用时静默降级为纯本地缓存，不影响主流程
+
+值的序列化由调用方提供（dumps → bytes / loads ← bytes），缓存本身不关心类型。
+"""
+import hashlib
+from typing import Any, Callable
+
+from cachetools import TTLCache
+
+from settings import settings, logger
+
+_redis = None
+_redis_failed = False
+
+
+def get_redis():
+    """惰性创建进程级 redis.asyncio 客户端；依赖缺失或初始化失败返回 None。"""
+    global _redis, _redis_failed
+    if _redis is not None or _redis_failed:
+        return _redis
+    try:
+        import redis.asyncio as aioredis
+        _redis = aioredis.from_url(settings.redis_url)
+    except Exception as e:
+        _redis_failed = True
+        logger.warning("Redis 客户端初始化失败，共享缓存层停用: %s", e)
+    return _redis
+
+
+def content_key(*parts: Any) -> str:
+    """把若干字段拼成稳定的 SHA-256 key（字段间用 \\x1f 分隔避免歧义）。"""
+    raw = "\x1f".join(str(p) for p in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    def __init__(
+        self,
+        namespace: str,
+        *,
+        maxsize: int,
+        ttl: int,
+        shared: bool = False,
+        dumps: Callable[[Any], bytes] | None = None,
+        loads: Callable[[bytes], Any] | None = None,
+        getsizeof: Callable[[Any], int] | None = None,
+    ):
+        """
+        namespace: Redis key 前缀（"tsai:<namespace>:<key>"）
+        maxsize:   本地层容量；传 getsizeof 时按其返回值（如字节数）计量，否则按条数
+        shared:    是否启用 Redis 共享层（需同时提供 dumps / loads）
+        """
+        self.namespace = namespace
+        self.ttl = ttl
+        self.shared = shared and dumps is not None and loads is not None
+        self._dumps = dumps
+        self._loads = loads
+        self._local: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl, getsizeof=getsizeof)
+        self._size_unit = "bytes" if getsizeof is not None else "items"
+        self.hits_local = 0
+        self.hits_shared = 0
+        self.misses = 0
+
+    def _redis_key(self, key: str) -> str:
+        return f"tsai:{self.namespace}:{key}"
+
+    async def get(self, key: str):
+        value = self._local.get(key)
+        if value is not None:
+            self.hits_local += 1
+            return value
+        if self.shared and (r := get_redis()) is not None:
+            try:
+                raw = await r.get(self._redis_key(key))
+            except Exception as e:
+                logger.debug("缓存 %s 读取 Redis 失败: %s", self.namespace, e)
+                raw = None
+            if raw is not None:
+                value = self._loads(raw)
+                self._put_local(key, value)
+                self.hits_shared += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value) -> None:
+        self._put_local(key, value)
+        if self.shared and (r := get_redis()) is not None:
+            try:
+                await r.set(self._redis_key(key), self._dumps(value), ex=self.ttl)
+            except Exception as e:
+                logger.debug("缓存 %s 写入 Redis 失败: %s", self.namespace, e)
+
+    async def delete(self, key: str) -> None:
+        self._local.pop(key, None)
+        if self.shared and (r := get_redis()) is not None:
+            try:
+                await r.delete(self._redis_key(key))
+            except Exception as e:
+                logger.debug("缓存 %s 删除 Redis key 失败: %s", self.namespace, e)
+
+    def _put_local(self, key: str, value) -> None:
+        try:
+            self._local[key] = value
+        except ValueError:
+            # 单个值超过本地层总容量（按字节计量时可能发生），只走共享层
+            pass
+
+    def stats(self) -> dict:
+        lookups = self.hits_local + self.hits_shared + self.misses
+        return {
+            "namespace": self.namespace,
+            "hits_local": self.hits_local,
+            "hits_shared": self.hits_shared,
+            "misses": self.misses,
+            "hit_rate": round((self.hits_local + self.hits_shared) / lookups, 3) if lookups else 0.0,
+            "local_size": self._local.currsize,
+            "local_maxsize": self._local.maxsize,
+            "size_unit": self._size_unit,
+            "shared": self.shared,
+        }
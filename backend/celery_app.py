@@ -9,6 +9,10 @@ Celery + Redis 调度框架 — Phase 3a 仅搭骨架，不跑任务。
 启动 worker（开发期）：
     celery -A backend.celery_app worker --loglevel=info
 
+文件解析入库走独立的 ingest 队列（OCR / PDF 解析耗 CPU，与其他任务隔离）：
+    celery -A backend.celery_app worker -Q ingest --concurrency=2 --loglevel=info
+  worker 需与 web 进程共享 static/loads 目录（读取上传文件、写 .md 中间产物）。
+
 启动 beat（周期任务调度，3b 之后才需要）：
     celery -A backend.celery_app beat --loglevel=info
 """
@@ -35,6 +39,9 @@ celery_app.conf.update(
     task_time_limit=600,           # 单任务最多 10 分钟
     task_soft_time_limit=540,      # 9 分钟软限
     worker_prefetch_multiplier=1,  # 每次拉一个任务，避免长任务阻塞
+    task_routes={
+        "ingest_file": {"queue": "ingest"},
+    },
     # beat_schedule 留空，后续阶段添加
     beat_schedule={},
 )
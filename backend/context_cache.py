@@ -0,0 +1,129 @@
+"""
+FULL_CONTEXT 路径的 Gemini 显式上下文缓存（cached content）。
+
+小语料会话（< FULL_CONTEXT_THRESHOLD）每轮 /chat 都把全部文档作为新的输入 token 重发。
+把「persona + 全部文档 + Google Search grounding 工具」建成一个 Gemini cached content，
+之后每轮只发送近期上下文、历史摘录、web 信息与问题，文档部分按缓存 token 计费：
+
+  • 键：(会话, 语料版本)——sessions.corpus_version 随上传 / 重新处理 / 删除 / 挂载 / persona 变化推进，
+    版本或生成模型不一致即重建；句柄登记在 context_caches 表，多个 web / worker 进程共享同一个缓存
+  • TTL：CONTEXT_CACHE_TTL 秒，使用时剩余不足一半即续期；闲置会话自然过期，不长期占用存储计费
+  • 失效：入库完成 / 重新处理 / 删除会话 / 挂载变化时 drop_context_cache() 主动删除远端缓存
+  • 并发：本进程内同一会话的创建只执行一次，并发请求等待同一次创建
+  • 降级：创建 / 续期失败返回 None，调用方退回内联全文的原路径
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from google.genai import types
+
+from settings import settings, client, logger
+from .db import (
+    get_context_cache_entry, save_context_cache_entry, touch_context_cache_entry, delete_context_cache_entry,
+)
+
+# 剩余有效期低于此值的句柄视为即将过期，直接重建（避免请求途中过期）
+_MIN_REMAINING = 60
+
+_creating: dict[str, asyncio.Future] = {}
+
+
+def _ttl() -> str:
+    return f"{settings.context_cache_ttl}s"
+
+
+async def _delete_remote(name: str) -> None:
+    try:
+        await client.aio.caches.delete(name=name)
+    except Exception as e:  # 已过期 / 已删除
+        logger.info("删除 Gemini 上下文缓存 %s 失败（忽略）: %s", name, e)
+
+
+async def drop_context_cache(session_id: str) -> None:
+    """注销会话的上下文缓存并删除远端 cached content（语料变化时调用）。"""
+    name = await delete_context_cache_entry(session_id)
+    if name:
+        await _delete_remote(name)
+
+
+async def _valid_entry(session_id: str, corpus_version: str) -> dict | None:
+    entry = await get_context_cache_entry(session_id)
+    if entry is None:
+        return None
+    remaining = (entry["expire_at"] - datetime.now(timezone.utc)).total_seconds()
+    if (entry["corpus_version"] != corpus_version or entry["model"] != settings.generation_model
+            or remaining < _MIN_REMAINING):
+        await drop_context_cache(session_id)
+        return None
+    if remaining < settings.context_cache_ttl / 2:
+        try:
+            cache = await client.aio.caches.update(
+                name=entry["cache_name"], config=types.UpdateCachedContentConfig(ttl=_ttl()),
+            )
+        except Exception as e:
+            logger.warning("Gemini 上下文缓存续期失败，重建: %s — %s", entry["cache_name"], e)
+            await drop_context_cache(session_id)
+            return None
+        expire_at = cache.expire_time or datetime.now(timezone.utc) + timedelta(seconds=settings.context_cache_ttl)
+        await touch_context_cache_entry(session_id, entry["cache_name"], expire_at)
+    return entry
+
+
+async def _create(session_id: str, corpus_version: str, persona: str,
+                  load_corpus: Callable[[], Awaitable[tuple[str, list]]]) -> dict | None:
+    corpus_section, citations = await load_corpus()
+    if not citations:
+        return None
+    t0 = asyncio.get_running_loop().time()
+    cache = await client.aio.caches.create(
+        model=settings.generation_model,
+        config=types.CreateCachedContentConfig(
+            display_name=f"tsai-{session_id}-{corpus_version}",
+            system_instruction=persona or None,
+            contents=[types.Content(role="user", parts=[types.Part(text=corpus_section)])],
+            tools=[types.Tool(google_search=types.GoogleSearch())],
+            ttl=_ttl(),
+        ),
+    )
+    token_count = getattr(cache.usage_metadata, "total_token_count", 0) or 0
+    expire_at = cache.expire_time or datetime.now(timezone.utc) + timedelta(seconds=settings.context_cache_ttl)
+    replaced = await save_context_cache_entry(
+        session_id, corpus_version, settings.generation_model, cache.name, citations, token_count, expire_at,
+    )
+    if replaced:
+        await _delete_remote(replaced)
+    logger.info("Gemini 上下文缓存已创建: session=%s version=%s tokens=%d (%.1fs)",
+                session_id, corpus_version, token_count, asyncio.get_running_loop().time() - t0)
+    return {"cache_name": cache.name, "citations": citations, "token_count": token_count}
+
+
+async def get_context_cache(session_id: str, corpus_version: str, persona: str,
+                            load_corpus: Callable[[], Awaitable[tuple[str, list]]]) -> dict | None:
+    """
+    返回会话当前语料版本的上下文缓存 {"cache_name", "citations", "token_count", ...}；
+    不可用时返回 None。load_corpus() → (文档全文段落, citations)，仅在需要新建时调用。
+    """
+    try:
+        entry = await _valid_entry(session_id, corpus_version)
+        if entry is not None:
+            return entry
+        key = str(session_id)
+        pending = _creating.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        fut = asyncio.get_running_loop().create_future()
+        _creating[key] = fut
+        try:
+            entry = await _create(session_id, corpus_version, persona, load_corpus)
+            fut.set_result(entry)
+            return entry
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # 标记已取回，无人等待时不告警
+            raise
+        finally:
+            _creating.pop(key, None)
+    except Exception as e:
+        logger.warning("Gemini 上下文缓存不可用，退回内联全文: session=%s — %s", session_id, e)
+        return None
@@ -1,11 +1,93 @@
 import json
 import os
+import uuid
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from databases import Database
 from settings import settings
 from pgvector.asyncpg import register_vector, Vector
 
 DATABASE_URL = settings.database_url
-database = Database(DATABASE_URL)
+
+
+async def _init_connection(conn):
+    # 连接池为每条物理连接执行一次：注册 pgvector codec，之后取连接无需再查 pg_type
+    await register_vector(conn)
+
+
+database = Database(DATABASE_URL, init=_init_connection)
+
+
+# ── 连接复用 ─────────────────────────────────────────────────
+# request_connection() 把当前 task 内的查询固定到同一条连接：databases 的 execute / fetch_*
+# 本就按 task 复用已打开的连接，acquire_conn() 的原生 asyncpg 查询（向量读写）也借用它。
+# 固定连接正被占用时（如 asyncio.gather 并发的另一支）acquire_conn 退回连接池，不排队等待。
+# 注意只包住纯数据库阶段，不要跨 Gemini 调用持有连接，避免占满连接池。
+_pinned_conn: ContextVar = ContextVar("tsai_pinned_conn", default=None)
+
+
+@asynccontextmanager
+async def request_connection():
+    async with database.connection() as conn:
+        token = _pinned_conn.set(conn)
+        try:
+            yield conn
+        finally:
+            _pinned_conn.reset(token)
+
+
+@asynccontextmanager
+async def acquire_conn():
+    """取一条原生 asyncpg 连接（已注册 pgvector）：优先复用 request_connection 固定的连接。"""
+    pinned = _pinned_conn.get()
+    if pinned is not None and not pinned._query_lock.locked():
+        async with pinned._query_lock:
+            yield pinned.raw_connection
+        return
+    async with database._backend._pool.acquire() as conn:
+        yield conn
+
+
+# ── 向量存储精度 ─────────────────────────────────────────────
+# EMBEDDING_STORAGE（halfvec / binary_quantize 需 pgvector ≥ 0.7）：
+#   full    vector(768)，HNSW vector_cosine_ops
+#   half    halfvec(768)：表与索引体积约减半，余弦距离误差在 1e-3 量级
+#   binary  列保持 vector(768) 供重排，HNSW 建在 binary_quantize(embedding) 上（bit_hamming_ops，约 1/32）；
+#           近邻查询先按汉明距离取 limit × BINARY_RERANK_FACTOR 个候选，再按全精度余弦距离重排
+# 查询向量一律以 vector 传入，SQL 中经 vec_param() 转成列类型；写入同理（vector → halfvec 为隐式转换）。
+# 切换模式需执行 scripts/migrate_embedding_storage.py 转换已有数据并重建索引。
+EMBEDDING_STORAGES = ("full", "half", "binary")
+
+
+def embedding_type(storage: str = None) -> str:
+    storage = storage or settings.embedding_storage
+    return f"{'halfvec' if storage == 'half' else 'vector'}({settings.embedding_dim})"
+
+
+def vec_param(ref: str, storage: str = None) -> str:
+    """把 SQL 中的查询向量（参数 / 列引用）转换为与 embedding 列一致的类型。"""
+    storage = storage or settings.embedding_storage
+    if storage == "half":
+        return f"{ref}::vector::halfvec({settings.embedding_dim})"
+    return f"{ref}::vector"
+
+
+def binary_expr(ref: str) -> str:
+    return f"binary_quantize({ref})::bit({settings.embedding_dim})"
+
+
+def hnsw_index_sql(name: str, table: str, where: str = "", storage: str = None,
+                   concurrently: bool = False) -> str:
+    """按存储模式生成 embedding 的 HNSW 索引 DDL（幂等）。"""
+    storage = storage or settings.embedding_storage
+    if storage == "binary":
+        target = f"({binary_expr('embedding')}) bit_hamming_ops"
+    elif storage == "half":
+        target = "embedding halfvec_cosine_ops"
+    else:
+        target = "embedding vector_cosine_ops"
+    return (f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name} "
+            f"ON {table} USING hnsw ({target})" + (f" WHERE {where}" if where else ""))
 
 
 async def init_db():
@@ -13,6 +95,9 @@ async def init_db():
     await database.execute("""
         CREATE EXTENSION IF NOT EXISTS vector
     """)
+    await database.execute("""
+        CREATE EXTENSION IF NOT EXISTS pg_trgm
+    """)
     await init_account_tables()
     # 创建 session 表
     await database.execute("""
@@ -23,14 +108,20 @@ async def init_db():
             persona TEXT,
             system_instruction_origin TEXT,
             system_instruction TEXT,
+            is_library BOOLEAN NOT NULL DEFAULT FALSE,
+            corpus_version BIGINT NOT NULL DEFAULT 0,
             created_at TIMESTAMP DEFAULT NOW()
         )
     """)
     await database.execute("""
         CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions(user_id)
     """)
-    # 创建 messages 表
+    # 每个用户至多一个文档库会话
     await database.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_user_library ON sessions(user_id) WHERE is_library
+    """)
+    # 创建 messages 表
+    await database.execute(f"""
         CREATE TABLE IF NOT EXISTS messages (
             id SERIAL PRIMARY KEY,
             session_id UUID,
@@ -39,18 +130,16 @@ async def init_db():
             tokens_in INTEGER DEFAULT 0,
             tokens_out INTEGER DEFAULT 0,
             tokens_total INTEGER DEFAULT 0,
-            embedding vector(768),
+            embedding {embedding_type()},
             created_at TIMESTAMP DEFAULT NOW()
         )
     """)
     await database.execute("""
         CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id)
     """)
-    await database.execute("""
-        CREATE INDEX IF NOT EXISTS idx_messages_embedding
-          ON messages USING hnsw (embedding vector_cosine_ops)
-          WHERE embedding IS NOT NULL
-    """)
+    await database.execute(
+        hnsw_index_sql("idx_messages_embedding", "messages", where="embedding IS NOT NULL")
+    )
     # 创建 upload_files 表
     await database.execute("""
         CREATE TABLE IF NOT EXISTS upload_files (
@@ -61,6 +150,10 @@ async def init_db():
             status TEXT DEFAULT 'pending',
             total_chunks INTEGER DEFAULT 0,
             processed_chunks INTEGER DEFAULT 0,
+            total_pages INTEGER DEFAULT 0,
+            processed_pages INTEGER DEFAULT 0,
+            parse_stats JSONB,
+            content_hash TEXT,
             error_msg TEXT,
             created_at TIMESTAMP DEFAULT NOW()
         )
@@ -71,7 +164,7 @@ async def init_db():
     # ALTER TABLE upload_files ADD COLUMN IF NOT EXISTS error_msg TEXT;
 
     # 创建 knowledge_base 表，注意 vector 类型
-    await database.execute("""
+    await database.execute(f"""
         CREATE TABLE IF NOT EXISTS knowledge_base (
             id SERIAL PRIMARY KEY,
             session_id UUID REFERENCES sessions(id) ON DELETE CASCADE,
@@ -79,7 +172,9 @@ async def init_db():
             original_content TEXT,
             source_file TEXT,
             chunk_index INTEGER DEFAULT 0,
-            embedding vector(768)
+            content_hash TEXT,
+            token_count INTEGER,
+            embedding {embedding_type()}
         )
     """)
     # 迁移已有库: ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS original_content TEXT;
@@ -89,11 +184,220 @@ async def init_db():
     await database.execute("""
         CREATE INDEX IF NOT EXISTS idx_knowledge_base_session_id ON knowledge_base(session_id)
     """)
-    # HNSW 向量索引（cosine）
+    # 会话 + 文件定位：文档库挂载文件的检索 / 复制 / 删除
+    await database.execute("""
+        CREATE INDEX IF NOT EXISTS idx_knowledge_base_session_source ON knowledge_base(session_id, source_file)
+    """)
+    # 会话按引用挂载的文档库文件
     await database.execute("""
-        CREATE INDEX IF NOT EXISTS idx_knowledge_base_hnsw
-          ON knowledge_base USING hnsw (embedding vector_cosine_ops)
+        CREATE TABLE IF NOT EXISTS session_library_files (
+            session_id UUID REFERENCES sessions(id) ON DELETE CASCADE,
+            library_id UUID REFERENCES sessions(id) ON DELETE CASCADE,
+            source_file TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (session_id, library_id, source_file)
+        )
     """)
+    await database.execute("""
+        CREATE INDEX IF NOT EXISTS idx_session_library_files_library
+          ON session_library_files(library_id, source_file)
+    """)
+    # HNSW 向量索引（cosine；索引类型随 EMBEDDING_STORAGE）
+    await database.execute(hnsw_index_sql("idx_knowledge_base_hnsw", "knowledge_base"))
+    # 内容寻址去重：文件字节哈希 / chunk 规范化文本哈希
+    await database.execute("""
+        CREATE INDEX IF NOT EXISTS idx_upload_files_content_hash ON upload_files(content_hash)
+    """)
+    await database.execute("""
+        CREATE INDEX IF NOT EXISTS idx_knowledge_base_content_hash ON knowledge_base(content_hash)
+    """)
+    # 混合检索的词法通道：original_content 上的三元组索引，加速 ILIKE '%词项%'
+    await database.execute("""
+        CREATE INDEX IF NOT EXISTS idx_knowledge_base_trgm
+          ON knowledge_base USING gin (original_content gin_trgm_ops)
+    """)
+    for _, sql in KNOWLEDGE_STATS_DDL:
+        await database.execute(sql)
+    # 语义回答缓存：按会话 + 语料版本 + persona 哈希 + prompt 版本 + 滚动摘要哈希分区，分区内按 query embedding 精确比对。
+    # 每个分区只有寥寥数条，不建向量索引，embedding 固定全精度 vector（不随 EMBEDDING_STORAGE）
+    await database.execute(f"""
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            id SERIAL PRIMARY KEY,
+            session_id UUID REFERENCES sessions(id) ON DELETE CASCADE,
+            corpus_version TEXT NOT NULL,
+            persona_hash TEXT NOT NULL,
+            prompt_version INTEGER NOT NULL DEFAULT 0,
+            source_filter TEXT NOT NULL DEFAULT '',
+            context_hash TEXT NOT NULL DEFAULT '',
+            route TEXT,
+            query TEXT,
+            embedding {embedding_type("full")},
+            answer TEXT NOT NULL,
+            citations JSONB DEFAULT '[]'::jsonb,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            last_hit_at TIMESTAMPTZ
+        )
+    """)
+    await database.execute("""
+        CREATE INDEX IF NOT EXISTS idx_answer_cache_key
+          ON answer_cache(session_id, corpus_version, persona_hash, prompt_version)
+    """)
+    # FULL_CONTEXT 路径的 Gemini cached content 句柄（每会话至多一个，多进程共享）
+    await database.execute("""
+        CREATE TABLE IF NOT EXISTS context_caches (
+            session_id UUID PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE,
+            corpus_version TEXT NOT NULL,
+            model TEXT NOT NULL,
+            cache_name TEXT NOT NULL,
+            citations JSONB DEFAULT '[]'::jsonb,
+            token_count INTEGER DEFAULT 0,
+            expire_at TIMESTAMPTZ NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    # 滚动对话摘要：id ≤ last_message_id 的消息已折叠进 summary，/chat 只再带其后的原文消息
+    await database.execute("""
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id UUID PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE,
+            summary TEXT NOT NULL DEFAULT '',
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+
+
+# ── 语料规模统计 ─────────────────────────────────────────────
+# knowledge_stats 按 (session_id, source_file) 维护 chunk 数、字符数与 token 数，供 /chat 路由与文档列表 O(1) 读取，
+# 不再对 knowledge_base 全表 SUM(LENGTH())。由 knowledge_base 上的语句级触发器（transition table）
+# 在同一事务内增减：入库、复制、按文件删除、删除会话的级联删除、脚本里的手工 DELETE 都会同步。
+# 字符数口径与 rag.estimate_tokens 一致（COALESCE(original_content, content)）；token 数取入库时
+# count_tokens 得出的 knowledge_base.token_count，缺失（旧数据 / 计数失败）的 chunk 按 2.5 字符/token 估算。
+_CHUNK_TOKENS_SQL = "COALESCE(token_count, CEIL(LENGTH(COALESCE(original_content, content)) / 2.5)::int)"
+
+KNOWLEDGE_STATS_DDL = [
+    ("knowledge_stats", """
+        CREATE TABLE IF NOT EXISTS knowledge_stats (
+            session_id UUID REFERENCES sessions(id) ON DELETE CASCADE,
+            source_file TEXT,
+            chunk_count INTEGER NOT NULL DEFAULT 0,
+            char_count BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+            PRIMARY KEY (session_id, source_file)
+        )
+    """),
+    # updated_at 每次增减都刷新：(SUM(chunk_count), MAX(updated_at)) 作为会话语料版本，供进程内向量缓存校验
+    ("knowledge_stats.updated_at",
+     "ALTER TABLE knowledge_stats ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()"),
+    ("knowledge_stats.token_count",
+     "ALTER TABLE knowledge_stats ADD COLUMN IF NOT EXISTS token_count BIGINT NOT NULL DEFAULT 0"),
+    ("knowledge_base.token_count",
+     "ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS token_count INTEGER"),
+    # 会话语料版本号：knowledge_base 增删（上传 / 重新处理 / 删除文件）、挂载变化、persona 变化时 +1，
+    # 作为语义回答缓存等派生数据的失效键
+    ("sessions.corpus_version",
+     "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS corpus_version BIGINT NOT NULL DEFAULT 0"),
+    ("knowledge_stats_apply()", f"""
+        CREATE OR REPLACE FUNCTION knowledge_stats_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO knowledge_stats (session_id, source_file, chunk_count, char_count, token_count)
+                SELECT session_id, source_file, COUNT(*),
+                       COALESCE(SUM(LENGTH(COALESCE(original_content, content))), 0),
+                       COALESCE(SUM({_CHUNK_TOKENS_SQL}), 0)
+                FROM new_rows
+                WHERE session_id IS NOT NULL AND source_file IS NOT NULL
+                GROUP BY session_id, source_file
+                ON CONFLICT (session_id, source_file) DO UPDATE
+                   SET chunk_count = knowledge_stats.chunk_count + EXCLUDED.chunk_count,
+                       char_count  = knowledge_stats.char_count  + EXCLUDED.char_count,
+                       token_count = knowledge_stats.token_count + EXCLUDED.token_count,
+                       updated_at  = clock_timestamp();
+                UPDATE sessions SET corpus_version = corpus_version + 1
+                WHERE id IN (SELECT DISTINCT session_id FROM new_rows);
+            ELSE
+                WITH d AS (
+                    SELECT session_id, source_file, COUNT(*) AS n,
+                           COALESCE(SUM(LENGTH(COALESCE(original_content, content))), 0) AS c,
+                           COALESCE(SUM({_CHUNK_TOKENS_SQL}), 0) AS t
+                    FROM old_rows
+                    WHERE session_id IS NOT NULL AND source_file IS NOT NULL
+                    GROUP BY session_id, source_file
+                )
+                UPDATE knowledge_stats s
+                   SET chunk_count = s.chunk_count - d.n, char_count = s.char_count - d.c,
+                       token_count = s.token_count - d.t, updated_at = clock_timestamp()
+                FROM d
+                WHERE s.session_id = d.session_id AND s.source_file = d.source_file;
+                -- 只清理本语句涉及的 (会话, 文件)，不扫全表
+                DELETE FROM knowledge_stats s
+                USING (SELECT DISTINCT session_id, source_file FROM old_rows) d
+                WHERE s.session_id = d.session_id AND s.source_file = d.source_file
+                  AND s.chunk_count <= 0;
+                UPDATE sessions SET corpus_version = corpus_version + 1
+                WHERE id IN (SELECT DISTINCT session_id FROM old_rows);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """),
+    ("trg_knowledge_stats_ins.drop",
+     "DROP TRIGGER IF EXISTS trg_knowledge_stats_ins ON knowledge_base"),
+    ("trg_knowledge_stats_ins", """
+        CREATE TRIGGER trg_knowledge_stats_ins AFTER INSERT ON knowledge_base
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE knowledge_stats_apply()
+    """),
+    ("trg_knowledge_stats_del.drop",
+     "DROP TRIGGER IF EXISTS trg_knowledge_stats_del ON knowledge_base"),
+    ("trg_knowledge_stats_del", """
+        CREATE TRIGGER trg_knowledge_stats_del AFTER DELETE ON knowledge_base
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE knowledge_stats_apply()
+    """),
+]
+
+# 由 knowledge_base 全量重算统计（回填历史数据 / 校正漂移），幂等
+KNOWLEDGE_STATS_REBUILD = [
+    ("knowledge_stats.rebuild", f"""
+        INSERT INTO knowledge_stats (session_id, source_file, chunk_count, char_count, token_count)
+        SELECT session_id, source_file, COUNT(*),
+               COALESCE(SUM(LENGTH(COALESCE(original_content, content))), 0),
+               COALESCE(SUM({_CHUNK_TOKENS_SQL}), 0)
+        FROM knowledge_base
+        WHERE session_id IS NOT NULL AND source_file IS NOT NULL
+        GROUP BY session_id, source_file
+        ON CONFLICT (session_id, source_file) DO UPDATE
+           SET chunk_count = EXCLUDED.chunk_count, char_count = EXCLUDED.char_count,
+               token_count = EXCLUDED.token_count
+    """),
+    ("knowledge_stats.prune", """
+        DELETE FROM knowledge_stats s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM knowledge_base k
+            WHERE k.session_id = s.session_id AND k.source_file = s.source_file
+        )
+    """),
+]
+
+
+# 会话检索范围内的 knowledge_stats 行：会话自身 ∪ 挂载的文档库文件（SQL 片段，:sid / $n 由调用方代入）
+_SCOPE_STATS_WHERE = """
+    (ks.session_id = {sid}
+     OR (ks.session_id, ks.source_file) IN (
+         SELECT library_id, source_file FROM session_library_files WHERE session_id = {sid}))
+"""
+
+
+# 会话语料 token 数（全部文件 + 对话摘要 + 挂载的文档库文件），读 knowledge_stats
+async def get_session_corpus_tokens(session_id: str) -> int:
+    value = await database.fetch_val(
+        "SELECT COALESCE(SUM(ks.token_count), 0) FROM knowledge_stats ks WHERE "
+        + _SCOPE_STATS_WHERE.format(sid="CAST(:sid AS uuid)"),
+        values={"sid": session_id},
+    )
+    return int(value or 0)
 
 
 async def init_account_tables():
@@ -108,6 +412,15 @@ async def init_account_tables():
             created_at TIMESTAMP DEFAULT NOW()
         )
     """)
+    # 每用户每日 token 用量汇总（save_message 同语句累加），配额检查 / 后台统计只读此表
+    await database.execute("""
+        CREATE TABLE IF NOT EXISTS user_daily_usage (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            tokens BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
+    """)
     await database.execute("""
         CREATE TABLE IF NOT EXISTS invite_codes (
             code UUID PRIMARY KEY,
@@ -157,6 +470,9 @@ async def init_phase3_tables():
             prompt_version_id INTEGER REFERENCES prompt_versions(id),
             hallucination_rate FLOAT,
             analyzed_at TIMESTAMP,
+            cache_hit BOOLEAN NOT NULL DEFAULT FALSE,
+            tokens_cached INTEGER DEFAULT 0,
+            prompt_budget JSONB,
             created_at TIMESTAMP DEFAULT NOW()
         )
     """)
@@ -190,9 +506,23 @@ async def init_phase3_tables():
 
 
 async def save_message(session_id, role, content, tokens_in=0, tokens_out=0, tokens_total=0) -> int:
-    query = """INSERT INTO messages (session_id, role, content, tokens_in, tokens_out, tokens_total)
-               VALUES (:session_id, :role, :content, :tokens_in, :tokens_out, :tokens_total)
-               RETURNING id"""
+    # 有 token 消耗时同一语句内累加 user_daily_usage（配额检查只需主键查询）
+    query = """
+        WITH ins AS (
+            INSERT INTO messages (session_id, role, content, tokens_in, tokens_out, tokens_total)
+            VALUES (:session_id, :role, :content, :tokens_in, :tokens_out, :tokens_total)
+            RETURNING id, session_id, tokens_total
+        ),
+        usage AS (
+            INSERT INTO user_daily_usage (user_id, day, tokens)
+            SELECT s.user_id, CURRENT_DATE, ins.tokens_total
+            FROM ins JOIN sessions s ON s.id = ins.session_id
+            WHERE ins.tokens_total > 0 AND s.user_id IS NOT NULL
+            ON CONFLICT (user_id, day) DO UPDATE
+               SET tokens = user_daily_usage.tokens + EXCLUDED.tokens
+        )
+        SELECT id FROM ins
+    """
     return await database.execute(query, values={
         "session_id": session_id, "role": role, "content": content,
         "tokens_in": tokens_in, "tokens_out": tokens_out, "tokens_total": tokens_total,
@@ -200,17 +530,18 @@ async def save_message(session_id, role, content, tokens_in=0, tokens_out=0, tok
 
 
 async def update_message_embedding(message_id: int, embedding):
-    async with database._backend._pool.acquire() as conn:
-        await register_vector(conn)
+    async with acquire_conn() as conn:
         await conn.execute(
-            "UPDATE messages SET embedding = $1 WHERE id = $2",
+            "UPDATE messages SET embedding = $1::vector WHERE id = $2",
             Vector(embedding), message_id
         )
 
 
-async def save_file(session_id, filename, filepath):
-    query = "INSERT INTO upload_files (session_id, filename, filepath) VALUES (:session_id, :filename, :filepath)"
-    await database.execute(query, values={"session_id": session_id, "filename": filename, "filepath": filepath})
+async def save_file(session_id, filename, filepath, content_hash: str = None):
+    query = """INSERT INTO upload_files (session_id, filename, filepath, content_hash)
+               VALUES (:session_id, :filename, :filepath, :content_hash)"""
+    await database.execute(query, values={"session_id": session_id, "filename": filename,
+                                          "filepath": filepath, "content_hash": content_hash})
 
 
 async def get_context(session_id, limit=10):
@@ -219,6 +550,78 @@ async def get_context(session_id, limit=10):
     return list(reversed([dict(row) for row in rows]))
 
 
+# /chat 前置查询：一次往返完成 归属校验 + 今日用量 + 配额内写入用户消息 + 滚动摘要 + 近期上下文 + 语料 token 数
+# + persona + 语料版本。use_summary 时近期上下文只取摘要覆盖范围（last_message_id）之后的消息。
+# 用户消息用数据修改型 CTE 写入，仅当会话归属当前用户且未超配额时才插入；
+# 同一语句内的 SELECT 看不到刚插入的行，由 Python 侧把它追加到上下文末尾。
+# 返回 dict；owned=False 表示会话不存在或不属于该用户，message_id=None 表示未写入（无权或超额）。
+async def get_chat_preamble(session_id: str, user_id: int, message: str,
+                            history_limit: int = 10, max_daily_tokens: int = 0,
+                            use_summary: bool = False) -> dict:
+    query = """
+        WITH owner AS (
+            SELECT system_instruction, corpus_version FROM sessions WHERE id = $1::uuid AND user_id = $2
+        ),
+        used AS (
+            SELECT COALESCE((SELECT tokens FROM user_daily_usage
+                             WHERE user_id = $2 AND day = CURRENT_DATE), 0) AS n
+        ),
+        ins AS (
+            INSERT INTO messages (session_id, role, content)
+            SELECT $1::uuid, 'user', $3::text
+            WHERE EXISTS (SELECT 1 FROM owner)
+              AND ($5::int <= 0 OR (SELECT n FROM used) < $5::int)
+            RETURNING id
+        ),
+        summ AS (
+            SELECT summary, last_message_id FROM session_summaries
+            WHERE session_id = $1::uuid AND $6::bool AND EXISTS (SELECT 1 FROM owner)
+        ),
+        recent AS (
+            SELECT id, role, content FROM messages
+            WHERE session_id = $1::uuid AND EXISTS (SELECT 1 FROM owner)
+              AND id > COALESCE((SELECT last_message_id FROM summ), 0)
+            ORDER BY id DESC
+            LIMIT $4
+        )
+        SELECT EXISTS (SELECT 1 FROM owner)             AS owned,
+               (SELECT system_instruction FROM owner)   AS persona,
+               (SELECT n FROM used)                     AS today_tokens,
+               (SELECT id FROM ins)                     AS message_id,
+               (SELECT summary FROM summ)               AS summary,
+               (SELECT COALESCE(json_agg(json_build_object('id', id, 'role', role, 'content', content)
+                                         ORDER BY id), '[]'::json)
+                FROM recent)                            AS context,
+               (SELECT COALESCE(SUM(ks.token_count), 0)
+                FROM knowledge_stats ks
+                WHERE {scope}
+                  AND EXISTS (SELECT 1 FROM owner))     AS corpus_tokens,
+               -- 有挂载文件时拼上文档库的版本号："会话:文档库"
+               (SELECT corpus_version::text FROM owner)
+               || COALESCE((SELECT ':' || MAX(l.corpus_version)
+                            FROM session_library_files a JOIN sessions l ON l.id = a.library_id
+                            WHERE a.session_id = $1::uuid), '')
+                                                        AS corpus_version
+    """.format(scope=_SCOPE_STATS_WHERE.format(sid="$1::uuid"))
+    async with acquire_conn() as conn:
+        row = await conn.fetchrow(query, str(session_id), user_id, message, history_limit, max_daily_tokens,
+                                  use_summary)
+    context = json.loads(row["context"]) if isinstance(row["context"], str) else list(row["context"])
+    if row["message_id"] is not None:
+        context.append({"id": row["message_id"], "role": "user", "content": message})
+        context = context[-history_limit:]
+    return {
+        "owned": row["owned"],
+        "persona": row["persona"] or "",
+        "today_tokens": int(row["today_tokens"]),
+        "message_id": row["message_id"],
+        "summary": row["summary"] or "",
+        "context": context,
+        "corpus_tokens": int(row["corpus_tokens"]),
+        "corpus_version": row["corpus_version"] or "",
+    }
+
+
 # 检查 session 是否存在（已命名）
 async def session_exists(session_id: str) -> bool:
     query = "SELECT 1 FROM sessions WHERE id = :session_id AND name IS NOT NULL LIMIT 1"
@@ -237,31 +640,413 @@ async def session_owned_by(session_id: str, user_id: int) -> bool:
 async def add_knowledge(content, embedding, session_id, source_file: str = None):
     query = """
         INSERT INTO knowledge_base (content, embedding, session_id, source_file)
-        VALUES ($1, $2, $3, $4)
+        VALUES ($1, $2::vector, $3, $4)
     """
     vector = Vector(embedding)
-    async with database._backend._pool.acquire() as conn:
-        await register_vector(conn)
+    async with acquire_conn() as conn:
         await conn.execute(query, content, vector, session_id, source_file)
 
 
-# 批量写入知识库（文件上传专用，单连接 executemany）
+# 批量写入知识库（文件上传专用）：整批一条 INSERT … SELECT FROM unnest(…)。
+# executemany 是逐行 INSERT，语句级触发器会按 chunk 触发，每个 chunk 都更新一次 knowledge_stats、
+# 推进一次 sessions.corpus_version（连带各级缓存失效、并发写入在 sessions 行上排队）；单条语句则每批只变一次。
+# 与 upload_files.processed_chunks 的推进在同一事务内提交：进度永远等于已入库的 chunk 数，
+# 处理中途失败后可从断点续传（见 get_ingest_checkpoint）
 async def add_knowledge_batch(
-    items: list,   # list of (enriched_content, original_content, embedding)
+    items: list,   # list of (enriched_content, original_content, embedding, content_hash)，content_hash 见 tools.chunk_hash
     session_id: str,
-    source_file: str
+    source_file: str,
+    start_index: int = 0,
+    token_counts: list | None = None,   # 各 chunk 原文的 token 数（count_tokens），None = 由统计按字符估算
 ):
+    # 向量以文本形式组成数组传入（'[x,y,…]'），逐个转成 vector（halfvec 列为隐式转换）
     query = """
         INSERT INTO knowledge_base
-          (content, original_content, embedding, session_id, source_file, chunk_index)
-        VALUES ($1, $2, $3, $4, $5, $6)
+          (content, original_content, embedding, session_id, source_file, chunk_index, content_hash, token_count)
+        SELECT u.content, u.original_content, u.embedding::vector, $4::uuid, $5, $6 + (u.n - 1)::int,
+               u.content_hash, u.token_count
+        FROM unnest($1::text[], $2::text[], $3::text[], $7::text[], $8::int[])
+             WITH ORDINALITY AS u(content, original_content, embedding, content_hash, token_count, n)
     """
-    async with database._backend._pool.acquire() as conn:
-        await register_vector(conn)
-        await conn.executemany(query, [
-            (enriched.replace('\x00', ''), original.replace('\x00', ''), Vector(emb), session_id, source_file, idx)
-            for idx, (enriched, original, emb) in enumerate(items)
-        ])
+    token_counts = token_counts or [None] * len(items)
+    async with acquire_conn() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                query,
+                [enriched.replace('\x00', '') for enriched, _, _, _ in items],
+                [original.replace('\x00', '') for _, original, _, _ in items],
+                [Vector(emb).to_text() for _, _, emb, _ in items],
+                session_id, source_file, start_index,
+                [content_hash for _, _, _, content_hash in items],
+                list(token_counts),
+            )
+            await conn.execute(
+                "UPDATE upload_files SET processed_chunks = $1 WHERE session_id = $2 AND filename = $3",
+                start_index + len(items), session_id, source_file,
+            )
+
+
+# ── 内容寻址去重 ─────────────────────────────────────────────
+# 同一文件（字节 SHA-256 相同）在任意会话已入库过时，直接复制其 chunk 行到新会话；
+# 单个 chunk（原文规范化后连同 embedding 模型 / 维度的 SHA-256 相同）已有 embedding 时复用向量，不再调用 Gemini。
+# 复制而非引用：每个会话仍独占自己的 knowledge_base 行，删除会话 / 文件互不影响。
+
+# 同一会话内是否已有相同内容的文件（返回文件名，无则 None）
+async def find_session_file_by_hash(session_id: str, content_hash: str):
+    return await database.fetch_val(
+        "SELECT filename FROM upload_files WHERE session_id = :sid AND content_hash = :h LIMIT 1",
+        values={"sid": session_id, "h": content_hash},
+    )
+
+
+# 查找内容相同且已入库完成的文件（排除自身），作为复制来源
+async def find_ingested_file_by_hash(content_hash: str, session_id: str, filename: str):
+    row = await database.fetch_one(
+        """SELECT session_id, filename, filepath, total_chunks, parse_stats
+           FROM upload_files
+           WHERE content_hash = :h AND status = 'done' AND total_chunks > 0
+             AND NOT (session_id = :sid AND filename = :fname)
+           ORDER BY created_at DESC
+           LIMIT 1""",
+        values={"h": content_hash, "sid": session_id, "fname": filename},
+    )
+    return dict(row) if row else None
+
+
+# 补记文件内容哈希（历史记录上传时未计算）
+async def set_file_content_hash(session_id: str, filename: str, content_hash: str):
+    await database.execute(
+        "UPDATE upload_files SET content_hash = :h WHERE session_id = :sid AND filename = :fname",
+        values={"h": content_hash, "sid": session_id, "fname": filename},
+    )
+
+
+# 把来源文件的全部 chunk 复制为目标会话 / 文件名的新行（同事务更新进度），返回复制条数。
+# 上下文头中的来源文件名替换为新文件名；向量原样复用。content_hash 置空：旧数据的哈希按富化文本计算，
+# 改写上下文头后与内容不再对应；复制行本就与来源行重复，来源行保留哈希即可作为向量复用来源。
+async def copy_file_knowledge(src_session_id: str, src_filename: str,
+                              dst_session_id: str, dst_filename: str) -> int:
+    old_prefix = f"[来源文件：{src_filename}。"
+    new_prefix = f"[来源文件：{dst_filename}。"
+    async with acquire_conn() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "DELETE FROM knowledge_base WHERE session_id = $1 AND source_file = $2",
+                dst_session_id, dst_filename,
+            )
+            status = await conn.execute(
+                """INSERT INTO knowledge_base
+                     (content, original_content, embedding, session_id, source_file, chunk_index, content_hash,
+                      token_count)
+                   SELECT CASE WHEN LEFT(content, LENGTH($3)) = $3
+                               THEN $4 || SUBSTRING(content FROM LENGTH($3) + 1)
+                               ELSE content END,
+                          original_content, embedding, $5, $6, chunk_index, NULL, token_count
+                   FROM knowledge_base
+                   WHERE session_id = $1 AND source_file = $2
+                   ORDER BY chunk_index""",
+                src_session_id, src_filename, old_prefix, new_prefix, dst_session_id, dst_filename,
+            )
+            copied = int(status.split()[-1])
+            await conn.execute(
+                """UPDATE upload_files SET total_chunks = $1, processed_chunks = $1
+                   WHERE session_id = $2 AND filename = $3""",
+                copied, dst_session_id, dst_filename,
+            )
+    return copied
+
+
+# 按 chunk 内容哈希批量查已有 embedding：{content_hash: embedding}
+async def get_embeddings_by_hash(hashes: list) -> dict:
+    if not hashes:
+        return {}
+    async with acquire_conn() as conn:
+        rows = await conn.fetch(
+            """SELECT DISTINCT ON (content_hash) content_hash, embedding::vector AS embedding
+               FROM knowledge_base
+               WHERE content_hash = ANY($1::text[]) AND embedding IS NOT NULL""",
+            list(set(hashes)),
+        )
+    return {r["content_hash"]: r["embedding"] for r in rows}
+
+
+# 断点续传检查点：返回 (已入库 chunk 数, 上次记录的 total_chunks)
+# 已入库 chunk 数取 MAX(chunk_index) + 1——批次按顺序提交，已提交部分总是从 0 开始的连续前缀
+async def get_ingest_checkpoint(session_id: str, filename: str) -> tuple[int, int]:
+    row = await database.fetch_one(
+        """SELECT f.total_chunks,
+                  (SELECT COALESCE(MAX(k.chunk_index) + 1, 0)
+                   FROM knowledge_base k
+                   WHERE k.session_id = f.session_id AND k.source_file = f.filename) AS committed
+           FROM upload_files f
+           WHERE f.session_id = :sid AND f.filename = :fname""",
+        values={"sid": session_id, "fname": filename},
+    )
+    if not row:
+        return 0, 0
+    return int(row["committed"] or 0), int(row["total_chunks"] or 0)
+
+
+# 删除某文件在知识库中的全部 chunk（重建 / 清理用）
+async def delete_file_knowledge(session_id: str, filename: str):
+    await database.execute(
+        "DELETE FROM knowledge_base WHERE session_id = :sid AND source_file = :src",
+        values={"sid": session_id, "src": filename},
+    )
+
+
+# 检索范围或 persona 变化（不经 knowledge_base 触发器）时手动推进会话语料版本
+async def bump_corpus_version(session_id: str):
+    await database.execute(
+        "UPDATE sessions SET corpus_version = corpus_version + 1 WHERE id = :sid",
+        values={"sid": session_id},
+    )
+
+
+# ── 用户文档库 ─────────────────────────────────────────────
+# 文档库是用户名下一个 is_library 会话（不出现在会话列表）：上传 / 解析 / 入库 / 统计 / 部分索引全部沿用会话流程，
+# 每份文档只入库一次。普通会话通过 session_library_files 按引用挂载库中文件，检索范围为「会话自身 ∪ 挂载文件」，
+# 不复制 chunk 与向量。挂载时拒绝与会话内文件重名，保证 (source_file, chunk_index) 在检索结果中仍唯一。
+LIBRARY_NAME = "文档库"
+
+
+# 取用户文档库会话 id，不存在则创建
+async def get_or_create_library(user_id: int) -> str:
+    await database.execute(
+        """INSERT INTO sessions (id, user_id, name, is_library)
+           VALUES (:id, :uid, :name, TRUE)
+           ON CONFLICT (user_id) WHERE is_library DO NOTHING""",
+        values={"id": str(uuid.uuid4()), "uid": user_id, "name": LIBRARY_NAME},
+    )
+    value = await database.fetch_val(
+        "SELECT id FROM sessions WHERE user_id = :uid AND is_library",
+        values={"uid": user_id},
+    )
+    return str(value)
+
+
+async def is_library_session(session_id: str) -> bool:
+    value = await database.fetch_val(
+        "SELECT is_library FROM sessions WHERE id = :sid", values={"sid": session_id},
+    )
+    return bool(value)
+
+
+# 用户文档库中内容相同且已入库完成的文件（上传到普通会话时改为挂载）：(library_id, filename)，无则 None
+async def find_library_file_by_hash(user_id: int, content_hash: str):
+    row = await database.fetch_one(
+        """SELECT u.session_id, u.filename
+           FROM upload_files u JOIN sessions s ON s.id = u.session_id
+           WHERE s.user_id = :uid AND s.is_library
+             AND u.content_hash = :h AND u.status = 'done'
+           ORDER BY u.created_at LIMIT 1""",
+        values={"uid": user_id, "h": content_hash},
+    )
+    return (str(row["session_id"]), row["filename"]) if row else None
+
+
+async def attach_library_file(session_id: str, library_id: str, filename: str):
+    await database.execute(
+        """INSERT INTO session_library_files (session_id, library_id, source_file)
+           VALUES (:sid, :lib, :fname)
+           ON CONFLICT DO NOTHING""",
+        values={"sid": session_id, "lib": library_id, "fname": filename},
+    )
+    await bump_corpus_version(session_id)
+
+
+async def detach_library_file(session_id: str, filename: str):
+    await database.execute(
+        "DELETE FROM session_library_files WHERE session_id = :sid AND source_file = :fname",
+        values={"sid": session_id, "fname": filename},
+    )
+    await bump_corpus_version(session_id)
+
+
+# 会话是否已挂载同名的文档库文件（会话自身文件与挂载文件同名会在检索 / 全文拼接中混为一份）
+async def is_library_file_attached(session_id: str, filename: str) -> bool:
+    value = await database.fetch_val(
+        "SELECT 1 FROM session_library_files WHERE session_id = :sid AND source_file = :fname",
+        values={"sid": session_id, "fname": filename},
+    )
+    return value is not None
+
+
+async def get_session_library_files(session_id: str) -> list:
+    rows = await database.fetch_all(
+        """SELECT a.source_file AS filename, u.status, u.total_chunks
+           FROM session_library_files a
+           LEFT JOIN upload_files u ON u.session_id = a.library_id AND u.filename = a.source_file
+           WHERE a.session_id = :sid
+           ORDER BY a.created_at""",
+        values={"sid": session_id},
+    )
+    return [dict(r) for r in rows]
+
+
+# ── 语义回答缓存 ─────────────────────────────────────────────
+# 缓存键 = (会话, 语料版本, persona 哈希, prompt 版本, 限定文件)，键内按 query embedding 余弦距离取最近一条，
+# 距离低于阈值且未过期即命中（hits +1）。语料版本推进后旧条目不再匹配，并在下次写入时清理。
+async def find_cached_answer(session_id: str, corpus_version: str, persona_hash: str, prompt_version: int,
+                             source_filter: str, context_hash: str, embedding, max_distance: float,
+                             ttl_hours: int) -> dict | None:
+    async with acquire_conn() as conn:
+        row = await conn.fetchrow(
+            """WITH nearest AS (
+                   SELECT id, embedding <=> $6::vector AS distance
+                   FROM answer_cache
+                   WHERE session_id = $1::uuid AND corpus_version = $2 AND persona_hash = $3
+                     AND prompt_version = $4 AND source_filter = $5 AND context_hash = $9
+                     AND created_at > NOW() - make_interval(hours => $8)
+                   ORDER BY distance
+                   LIMIT 1
+               )
+               UPDATE answer_cache c SET hits = c.hits + 1, last_hit_at = NOW()
+               FROM nearest n
+               WHERE c.id = n.id AND n.distance < $7
+               RETURNING c.answer, c.citations, c.route, n.distance""",
+            str(session_id), corpus_version, persona_hash, prompt_version, source_filter,
+            Vector(embedding), max_distance, ttl_hours, context_hash,
+        )
+    if row is None:
+        return None
+    return {
+        "answer": row["answer"],
+        "citations": json.loads(row["citations"]) if row["citations"] else [],
+        "route": row["route"],
+        "distance": float(row["distance"]),
+    }
+
+
+# 写入一条回答缓存；同一事务内删除该会话语料版本已变化或已过期的条目。
+# 生成期间语料版本已推进（如入库完成）时放弃写入：回答基于旧语料，且不能按旧版本删掉新版本的条目。
+# 返回是否写入。
+async def save_cached_answer(session_id: str, corpus_version: str, persona_hash: str, prompt_version: int,
+                             source_filter: str, context_hash: str, query: str, embedding, route: str,
+                             answer: str, citations: list, ttl_hours: int) -> bool:
+    async with acquire_conn() as conn:
+        async with conn.transaction():
+            # 口径与 get_chat_preamble 的 corpus_version 一致；FOR SHARE 使并发的版本推进等本事务提交
+            current = await conn.fetchval(
+                """SELECT s.corpus_version::text
+                          || COALESCE((SELECT ':' || MAX(l.corpus_version)
+                                       FROM session_library_files a JOIN sessions l ON l.id = a.library_id
+                                       WHERE a.session_id = s.id), '')
+                   FROM sessions s WHERE s.id = $1::uuid
+                   FOR SHARE OF s""",
+                str(session_id),
+            )
+            if current != corpus_version:
+                return False
+            await conn.execute(
+                """DELETE FROM answer_cache
+                   WHERE session_id = $1::uuid
+                     AND (corpus_version <> $2 OR created_at <= NOW() - make_interval(hours => $3))""",
+                str(session_id), corpus_version, ttl_hours,
+            )
+            await conn.execute(
+                """INSERT INTO answer_cache (session_id, corpus_version, persona_hash, prompt_version,
+                                             source_filter, context_hash, route, query, embedding, answer, citations)
+                   VALUES ($1::uuid, $2, $3, $4, $5, $6, $7, $8, $9::vector, $10, $11::jsonb)""",
+                str(session_id), corpus_version, persona_hash, prompt_version, source_filter, context_hash,
+                route, query, Vector(embedding), answer, json.dumps(citations or [], ensure_ascii=False),
+            )
+    return True
+
+
+# ── Gemini 上下文缓存句柄 ─────────────────────────────────────
+async def get_context_cache_entry(session_id: str) -> dict | None:
+    row = await database.fetch_one(
+        "SELECT * FROM context_caches WHERE session_id = :sid", values={"sid": session_id},
+    )
+    if row is None:
+        return None
+    entry = dict(row)
+    entry["citations"] = json.loads(entry["citations"]) if entry["citations"] else []
+    return entry
+
+
+# 登记会话的 cached content 句柄，返回被替换掉的旧句柄名（需由调用方删除远端缓存），无则 None
+async def save_context_cache_entry(session_id: str, corpus_version: str, model: str, cache_name: str,
+                                   citations: list, token_count: int, expire_at) -> str | None:
+    return await database.fetch_val(
+        """WITH old AS (
+               SELECT cache_name FROM context_caches WHERE session_id = :sid FOR UPDATE
+           ),
+           up AS (
+               INSERT INTO context_caches (session_id, corpus_version, model, cache_name,
+                                           citations, token_count, expire_at)
+               VALUES (:sid, :ver, :model, :name, CAST(:cit AS jsonb), :tokens, :exp)
+               ON CONFLICT (session_id) DO UPDATE
+                  SET corpus_version = EXCLUDED.corpus_version, model = EXCLUDED.model,
+                      cache_name = EXCLUDED.cache_name, citations = EXCLUDED.citations,
+                      token_count = EXCLUDED.token_count, expire_at = EXCLUDED.expire_at,
+                      created_at = NOW()
+               RETURNING 1
+           )
+           SELECT (SELECT cache_name FROM old WHERE cache_name <> :name) FROM up""",
+        values={"sid": session_id, "ver": corpus_version, "model": model, "name": cache_name,
+                "cit": json.dumps(citations or [], ensure_ascii=False), "tokens": token_count,
+                "exp": expire_at},
+    )
+
+
+async def touch_context_cache_entry(session_id: str, cache_name: str, expire_at):
+    await database.execute(
+        "UPDATE context_caches SET expire_at = :exp WHERE session_id = :sid AND cache_name = :name",
+        values={"sid": session_id, "name": cache_name, "exp": expire_at},
+    )
+
+
+# 注销会话的 cached content 句柄，返回句柄名（需由调用方删除远端缓存），无则 None
+async def delete_context_cache_entry(session_id: str) -> str | None:
+    return await database.fetch_val(
+        "DELETE FROM context_caches WHERE session_id = :sid RETURNING cache_name",
+        values={"sid": session_id},
+    )
+
+
+# ── 滚动对话摘要 ─────────────────────────────────────────────
+# 取会话摘要状态与待折叠的消息：摘要之后、最近 keep 条之前的消息，按 id 升序最多 limit 条。
+# 返回 (summary, last_message_id, rows)；无摘要时 ("", 0, rows)。
+async def get_summary_fold(session_id: str, keep: int, limit: int) -> tuple[str, int, list]:
+    async with acquire_conn() as conn:
+        state = await conn.fetchrow(
+            "SELECT summary, last_message_id FROM session_summaries WHERE session_id = $1::uuid",
+            str(session_id),
+        )
+        summary, after = (state["summary"], state["last_message_id"]) if state else ("", 0)
+        rows = await conn.fetch(
+            """WITH tail AS (
+                   SELECT id FROM messages WHERE session_id = $1::uuid ORDER BY id DESC LIMIT $3
+               )
+               SELECT id, role, content FROM messages
+               WHERE session_id = $1::uuid AND id > $2
+                 AND id < (SELECT MIN(id) FROM tail)
+               ORDER BY id
+               LIMIT $4""",
+            str(session_id), after, max(keep, 1), limit,
+        )
+    return summary, after, [dict(r) for r in rows]
+
+
+# 写入折叠后的摘要（比较并交换：仅当 last_message_id 仍为 prev_last_id 时生效，并发折叠只保留一份）。
+# 返回是否写入。
+async def save_session_summary(session_id: str, summary: str, prev_last_id: int,
+                               last_message_id: int, folded: int) -> bool:
+    saved = await database.fetch_val(
+        """INSERT INTO session_summaries (session_id, summary, last_message_id, message_count)
+           VALUES (:sid, :summary, :last, :n)
+           ON CONFLICT (session_id) DO UPDATE
+              SET summary = EXCLUDED.summary, last_message_id = EXCLUDED.last_message_id,
+                  message_count = session_summaries.message_count + EXCLUDED.message_count,
+                  updated_at = NOW()
+              WHERE session_summaries.last_message_id = :prev
+           RETURNING 1""",
+        values={"sid": session_id, "summary": summary, "last": last_message_id, "n": folded,
+                "prev": prev_last_id},
+    )
+    return saved is not None
 
 
 # 更新文件处理状态
@@ -282,10 +1067,40 @@ async def update_file_status(session_id: str, filename: str, status: str,
     await database.execute(query, values=values)
 
 
+# 更新扫描版 PDF 的 OCR 页进度（回调可能乱序到达，processed_pages 只增不减）
+async def update_file_pages(session_id: str, filename: str, total: int, done: int):
+    await database.execute(
+        """UPDATE upload_files
+           SET total_pages = :total, processed_pages = GREATEST(COALESCE(processed_pages, 0), :done)
+           WHERE session_id = :session_id AND filename = :filename""",
+        values={"session_id": session_id, "filename": filename, "total": total, "done": done},
+    )
+
+
+# 记录文件解析统计（各提取方式页数、OCR / 解析 / embedding 耗时），便于定位入库耗时
+async def update_file_parse_stats(session_id: str, filename: str, stats: dict):
+    await database.execute(
+        """UPDATE upload_files SET parse_stats = CAST(:stats AS jsonb)
+           WHERE session_id = :session_id AND filename = :filename""",
+        values={"session_id": session_id, "filename": filename,
+                "stats": json.dumps(stats, ensure_ascii=False)},
+    )
+
+
+# 查询单个文件的处理状态，记录不存在返回 None
+async def get_file_status(session_id: str, filename: str) -> str | None:
+    row = await database.fetch_one(
+        "SELECT status FROM upload_files WHERE session_id = :sid AND filename = :fname",
+        values={"sid": session_id, "fname": filename},
+    )
+    return row["status"] if row else None
+
+
 # 查询文件处理状态列表
 async def get_file_statuses(session_id: str) -> list:
     query = """
-        SELECT filename, status, total_chunks, processed_chunks, error_msg
+        SELECT filename, status, total_chunks, processed_chunks,
+               total_pages, processed_pages, error_msg
         FROM upload_files
         WHERE session_id = :session_id
         ORDER BY created_at DESC
@@ -297,27 +1112,29 @@ async def get_file_statuses(session_id: str) -> list:
 # ── Admin 相关查询 ─────────────────────────────────────────────
 
 async def get_user_today_tokens(user_id: int) -> int:
-    query = """
-        SELECT COALESCE(SUM(m.tokens_total), 0)
-        FROM messages m
-        JOIN sessions s ON m.session_id = s.id
-        WHERE s.user_id = :user_id AND DATE(m.created_at) = CURRENT_DATE
-    """
-    row = await database.fetch_one(query, values={"user_id": user_id})
-    return int(row[0]) if row else 0
+    value = await database.fetch_val(
+        "SELECT tokens FROM user_daily_usage WHERE user_id = :user_id AND day = CURRENT_DATE",
+        values={"user_id": user_id},
+    )
+    return int(value or 0)
 
 
 async def get_all_users_with_stats() -> list:
     query = """
         SELECT u.id, u.username, u.is_admin, u.max_daily_tokens, u.created_at,
-               COUNT(DISTINCT CASE WHEN s.name IS NOT NULL THEN s.id END) AS session_count,
-               COALESCE(SUM(m.tokens_total), 0) AS total_tokens,
-               COALESCE(SUM(CASE WHEN DATE(m.created_at) = CURRENT_DATE THEN m.tokens_total ELSE 0 END), 0) AS today_tokens
+               (SELECT COUNT(*) FROM sessions s
+                WHERE s.user_id = u.id AND s.name IS NOT NULL) AS session_count,
+               COALESCE(d.total_tokens, 0) AS total_tokens,
+               COALESCE(d.today_tokens, 0) AS today_tokens
         FROM users u
-        LEFT JOIN sessions s ON s.user_id = u.id
-        LEFT JOIN messages m ON m.session_id = s.id
+        LEFT JOIN (
+            SELECT user_id,
+                   SUM(tokens) AS total_tokens,
+                   SUM(tokens) FILTER (WHERE day = CURRENT_DATE) AS today_tokens
+            FROM user_daily_usage
+            GROUP BY user_id
+        ) d ON d.user_id = u.id
         WHERE u.is_admin = FALSE
-        GROUP BY u.id
         ORDER BY u.id
     """
     rows = await database.fetch_all(query)
@@ -352,18 +1169,10 @@ async def get_user_daily_tokens(user_id: int) -> list:
                 CURRENT_DATE,
                 '1 day'::interval
             )::date AS date
-        ),
-        daily AS (
-            SELECT DATE(m.created_at) AS date,
-                   SUM(m.tokens_total) AS tokens
-            FROM messages m
-            JOIN sessions s ON m.session_id = s.id
-            WHERE s.user_id = :user_id
-            GROUP BY DATE(m.created_at)
         )
-        SELECT d.date, COALESCE(daily.tokens, 0) AS tokens
+        SELECT d.date, COALESCE(u.tokens, 0) AS tokens
         FROM dates d
-        LEFT JOIN daily ON d.date = daily.date
+        LEFT JOIN user_daily_usage u ON u.user_id = :user_id AND u.day = d.date
         ORDER BY d.date DESC
     """
     rows = await database.fetch_all(query, values={"user_id": user_id})
@@ -371,14 +1180,11 @@ async def get_user_daily_tokens(user_id: int) -> list:
 
 
 async def get_user_total_tokens(user_id: int) -> int:
-    query = """
-        SELECT COALESCE(SUM(m.tokens_total), 0)
-        FROM messages m
-        JOIN sessions s ON m.session_id = s.id
-        WHERE s.user_id = :user_id
-    """
-    row = await database.fetch_one(query, values={"user_id": user_id})
-    return int(row[0]) if row else 0
+    value = await database.fetch_val(
+        "SELECT COALESCE(SUM(tokens), 0) FROM user_daily_usage WHERE user_id = :user_id",
+        values={"user_id": user_id},
+    )
+    return int(value or 0)
 
 
 async def get_session_messages_detail(session_id: str) -> list:
@@ -394,13 +1200,20 @@ async def get_session_messages_detail(session_id: str) -> list:
 
 async def get_session_files(session_id: str) -> list:
     query = """
-        SELECT filename, filepath, status, total_chunks, processed_chunks, error_msg, created_at
+        SELECT filename, filepath, status, total_chunks, processed_chunks,
+               total_pages, processed_pages, parse_stats, error_msg, created_at
         FROM upload_files
         WHERE session_id = :session_id
         ORDER BY created_at
     """
     rows = await database.fetch_all(query, values={"session_id": session_id})
-    return [dict(r) for r in rows]
+    files = []
+    for r in rows:
+        f = dict(r)
+        if isinstance(f.get("parse_stats"), str):  # asyncpg 未注册 jsonb codec 时返回字符串
+            f["parse_stats"] = json.loads(f["parse_stats"])
+        files.append(f)
+    return files
 
 
 async def get_session_daily_tokens(session_id: str) -> list:
@@ -467,7 +1280,8 @@ async def get_session_persona_origin(session_id: str) -> str:
 async def update_session_persona(session_id: str, user_id: int, origin: str, processed: str):
     await database.execute(
         """UPDATE sessions
-           SET system_instruction_origin = :origin, system_instruction = :processed
+           SET system_instruction_origin = :origin, system_instruction = :processed,
+               corpus_version = corpus_version + 1
            WHERE id = :sid AND user_id = :uid""",
         values={
             "origin": origin or None,
@@ -487,9 +1301,9 @@ async def save_persona_origin(session_id: str, user_id: int, origin: str):
 
 
 async def update_session_instruction(session_id: str, instruction: str):
-    """仅更新 AI 处理后的 system_instruction。"""
+    """仅更新 AI 处理后的 system_instruction（推进语料版本，使语义回答缓存失效）。"""
     await database.execute(
-        "UPDATE sessions SET system_instruction = :v WHERE id = :sid",
+        "UPDATE sessions SET system_instruction = :v, corpus_version = corpus_version + 1 WHERE id = :sid",
         values={"v": instruction or None, "sid": session_id}
     )
 
@@ -601,17 +1415,22 @@ async def record_trace(
     tokens_out: int = 0,
     duration_ms: int = 0,
     prompt_version_id: int | None = None,
+    cache_hit: bool = False,
+    tokens_cached: int = 0,
+    prompt_budget: dict | None = None,
 ) -> int:
     """异步落盘一次 /chat 调用的完整 trace。返回 trace id。"""
     new_id = await database.fetch_val(
         """INSERT INTO agent_traces (
                 session_id, user_id, message_id, query, route,
                 tools_called, iterations, citations,
-                tokens_in, tokens_out, duration_ms, prompt_version_id
+                tokens_in, tokens_out, duration_ms, prompt_version_id, cache_hit, tokens_cached,
+                prompt_budget
             ) VALUES (
                 :sid, :uid, :mid, :q, :r,
                 CAST(:tc AS jsonb), :it, CAST(:cit AS jsonb),
-                :ti, :to, :dur, :pv
+                :ti, :to, :dur, :pv, :ch, :tcached,
+                CAST(:pb AS jsonb)
             ) RETURNING id""",
         values={
             "sid": session_id,
@@ -626,6 +1445,9 @@ async def record_trace(
             "to": tokens_out,
             "dur": duration_ms,
             "pv": prompt_version_id,
+            "ch": cache_hit,
+            "tcached": tokens_cached,
+            "pb": json.dumps(prompt_budget) if prompt_budget is not None else None,
         },
     )
     return new_id
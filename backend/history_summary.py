@@ -0,0 +1,69 @@
+"""
+会话滚动摘要。
+
+长会话里近期原文消息（尤其是长回答）是每轮 prompt 的主要开销。后台任务把较早的消息增量折叠进
+每个会话一份的摘要，/chat 只带「摘要 + 摘要之后的少量原文消息」，prompt 规模不随会话变长而增长：
+
+  • 增量：session_summaries 记录摘要与已折叠到的 last_message_id，每次只把 已有摘要 + 新增消息
+    交给模型改写，不重读整段对话；每轮回答后投递一次，单次折叠最多 _FOLD_LIMIT 条（历史长会话逐轮追上）
+  • 窗口：最近 HISTORY_KEEP_MESSAGES 条消息始终保留原文；其前未折叠的消息攒够 HISTORY_SUMMARY_BATCH 条才折叠
+  • 并发：写入按 last_message_id 比较并交换，同一会话的并发折叠只有一份生效
+  • 降级：摘要缺失或滞后时 /chat 仍最多带 MAX_HISTORY_TURNS 条原文
+"""
+import asyncio
+
+from settings import settings, client, logger
+from .db import get_summary_fold, save_session_summary
+
+# 单次折叠的最多消息数 / 每条消息交给模型的最大字符数
+_FOLD_LIMIT = 20
+_MESSAGE_CHARS = 2000
+
+_FOLD_PROMPT = (
+    "你在维护一段对话的滚动摘要。下面是已有摘要和其后新增的对话消息。\n"
+    "请把新增消息合并进摘要，输出更新后的完整摘要：\n"
+    "- 保留用户的身份背景、偏好、提出的要求与约束、已确认的结论和事实、尚未解决的问题\n"
+    "- 保留关键名称、数字、文件名；省略寒暄与重复内容，较早且已不重要的细节可以压缩\n"
+    "- 使用中文，不超过 {max_chars} 字，只输出摘要正文\n\n"
+    "已有摘要：\n\"\"\"\n{summary}\n\"\"\"\n\n"
+    "新增消息：\n\"\"\"\n{transcript}\n\"\"\""
+)
+
+
+async def summarize_session(session_id: str) -> int:
+    """把会话摘要之后、保留窗口之前的消息折叠进摘要，返回折叠的消息数（无需折叠或并发落败为 0）。"""
+    summary, last_id, rows = await get_summary_fold(session_id, settings.history_keep_messages, _FOLD_LIMIT)
+    if len(rows) < max(settings.history_summary_batch, 1):
+        return 0
+    transcript = "\n".join(f"{r['role']}: {r['content'][:_MESSAGE_CHARS]}" for r in rows)
+    resp = await client.aio.models.generate_content(
+        model=settings.history_summary_model,
+        contents=_FOLD_PROMPT.format(
+            max_chars=settings.history_summary_max_chars, summary=summary or "（无）", transcript=transcript,
+        ),
+    )
+    updated = (resp.text or "").strip()
+    if not updated:
+        logger.warning("对话摘要生成为空，跳过: session=%s", session_id)
+        return 0
+    if not await save_session_summary(session_id, updated, last_id, rows[-1]["id"], len(rows)):
+        return 0
+    logger.info("对话摘要已更新: session=%s 折叠 %d 条消息 (id ≤ %d)", session_id, len(rows), rows[-1]["id"])
+    return len(rows)
+
+
+async def schedule_summary(session_id: str) -> None:
+    """回答落库后调用：投递 Celery 摘要任务；未启用或 broker 不可达时在当前进程内执行。"""
+    if not settings.history_summary_enabled:
+        return
+    if settings.summary_via_celery:
+        try:
+            from .tasks import summarize_session_task  # 避免循环导入（tasks 引用本模块）
+            await asyncio.to_thread(summarize_session_task.apply_async, args=(str(session_id),))
+            return
+        except Exception as e:
+            logger.warning("Celery 投递摘要任务失败，进程内执行: %s — %s", session_id, e)
+    try:
+        await summarize_session(session_id)
+    except Exception as e:
+        logger.warning("对话摘要更新失败 (session=%s): %s", session_id, e)
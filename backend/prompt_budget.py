@@ -0,0 +1,216 @@
+"""
+/chat 提示词的 token 预算规划。
+
+按真实 tokenizer 计数组装 prompt，取代 2.5 字符/token 的启发式估算：
+
+  • 计数：知识库 chunk 的 token 数在入库时由 count_tokens 算好存进 knowledge_base.token_count；
+    近期对话与 web 信息这类大段可变文本按内容哈希缓存计数（同一条消息每轮都会重发，只在首次出现时计数），
+    未命中的条目合并为一次 count_tokens、与检索同时发出，检索结束后最多再等 TOKEN_COUNT_WAIT 秒，
+    迟到 / 失败的条目按字符估算（迟到的结果仍写入缓存供下一轮使用）；persona、指令、问题与历史摘录
+    体量小，直接按字符估算，不为它们多一次远程调用
+  • 分配：PROMPT_BUDGET_TOKENS 扣除固定部分（persona、指令、问题、上下文缓存中的文档）后，
+    先按份额给各段保底（近期对话 / 历史摘录 / 文档 / web），再把余量按优先级 文档 → 近期对话 → 历史摘录 → web 补给仍不够的段
+  • 裁剪：各段按条目优先级（最相关 / 最新在前）保留前缀；可截断段（web、全量文档）放不下的条目按比例截取开头
+  • 留痕：plan_prompt() 返回各段的额度 / 实际用量 / 保留与丢弃条数，写入 agent_traces.prompt_budget
+"""
+import asyncio
+
+from settings import settings, client, logger
+from .cache import TieredCache, content_key
+from .rag import estimate_tokens
+
+_token_cache = TieredCache(
+    "tok",
+    maxsize=settings.token_cache_size,
+    ttl=settings.embed_cache_ttl,
+    shared=settings.embed_cache_shared,
+    dumps=lambda v: str(v).encode(),
+    loads=lambda b: int(b),
+)
+
+# 各段保底份额与余量补给顺序
+_SHARES = {"history": 0.15, "recall": 0.05, "docs": 0.70, "web": 0.10}
+_PRIORITY = ("docs", "history", "recall", "web")
+
+# 可截断段剩余额度低于此值时不再截取（半句残文没有价值）
+_MIN_TRUNCATE_TOKENS = 64
+
+# 尚未完成的 /chat 计数任务
+_pending: set[asyncio.Task] = set()
+
+
+def token_cache_stats() -> dict:
+    """文本 token 计数缓存命中统计（admin 性能页展示用）。"""
+    return _token_cache.stats()
+
+
+async def _count_remote(contents) -> int:
+    resp = await asyncio.wait_for(
+        client.aio.models.count_tokens(model=settings.generation_model, contents=contents),
+        timeout=settings.token_count_timeout,
+    )
+    return resp.total_tokens or 0
+
+
+def _apportion(total: int, texts: list[str]) -> list[int]:
+    """一次 count_tokens 只返回总数：按各条字符数比例分摊。"""
+    chars = sum(len(t) for t in texts) or 1
+    return [round(total * len(t) / chars) for t in texts]
+
+
+async def count_tokens(texts: list[str]) -> list[int]:
+    """
+    逐条文本的 token 数：缓存命中直接取，未命中的合并为一次 count_tokens 按字符数分摊
+    （单条未命中即为精确值），失败的条目按字符估算，估算值不进缓存。
+    """
+    counts = [estimate_tokens(t) if t else 0 for t in texts]
+    if not settings.token_count_api:
+        return counts
+    keys = [content_key(settings.generation_model, t) if t else None for t in texts]
+    cached = iter(await asyncio.gather(*(_token_cache.get(k) for k in keys if k)))
+    missing = []
+    for i, key in enumerate(keys):
+        if key is None:
+            continue
+        value = next(cached)
+        if value is None:
+            missing.append(i)
+        else:
+            counts[i] = value
+    if not missing:
+        return counts
+    batch = [texts[i] for i in missing]
+    try:
+        total = await _count_remote(batch)
+    except Exception as e:
+        logger.debug("count_tokens 失败，按字符估算: %s", e)
+        return counts
+    for i, tokens in zip(missing, _apportion(total, batch)):
+        counts[i] = tokens
+    await asyncio.gather(*(_token_cache.set(keys[i], counts[i]) for i in missing))
+    return counts
+
+
+def start_counting(texts: list[str]) -> asyncio.Task:
+    """与检索同时发出计数；结果用 settle_counts() 取。"""
+    task = asyncio.ensure_future(count_tokens(texts))
+    # 请求结束后仍可能在跑（迟到结果要写缓存），保留强引用防止被回收
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+    return task
+
+
+async def settle_counts(task: asyncio.Task, texts: list[str]) -> list[int]:
+    """
+    检索结束后取计数：最多再等 TOKEN_COUNT_WAIT 秒，仍未返回则本轮按字符估算。
+    任务不取消，迟到的结果照常写入缓存，下一轮同样的消息直接命中。
+    """
+    done, _ = await asyncio.wait({task}, timeout=settings.token_count_wait)
+    if done:
+        try:
+            return task.result()
+        except Exception as e:
+            logger.debug("token 计数任务失败，按字符估算: %s", e)
+    return [estimate_tokens(t) if t else 0 for t in texts]
+
+
+async def count_chunk_tokens(texts: list[str]) -> list[int] | None:
+    """
+    入库用：一次 count_tokens 计算整批 chunk 的总 token 数，按各 chunk 字符数比例分摊。
+    失败返回 None（该批 token_count 留空，统计与规划退回字符估算）。
+    """
+    if not texts or not settings.token_count_api:
+        return None
+    try:
+        total = await _count_remote(texts)
+    except Exception as e:
+        logger.warning("入库 count_tokens 失败，token 数留空: %s", e)
+        return None
+    return _apportion(total, texts)
+
+
+def chunk_tokens(row: dict) -> int:
+    """
+    检索结果 chunk 放进 prompt 的 token 数：原文取入库时的计数（旧数据按字符估算），
+    上下文增强加上的文件 / 章节前缀按字符估算。
+    """
+    content = row["content"]
+    original = row.get("original_content") or content
+    tokens = row.get("token_count")
+    if tokens is None:
+        tokens = estimate_tokens(original)
+    return tokens + estimate_tokens(content[:max(len(content) - len(original), 0)])
+
+
+class Section:
+    """prompt 中的一段：items 按优先级排列的 (文本, token 数)，规划后 kept 为保留的文本。"""
+    __slots__ = ("name", "items", "truncatable", "cap", "used", "kept", "truncated")
+
+    def __init__(self, name: str, items: list[tuple[str, int]], truncatable: bool = False):
+        self.name = name
+        self.items = items
+        self.truncatable = truncatable
+        self.cap = 0
+        self.used = 0
+        self.kept: list[str] = []
+        self.truncated = False
+
+    @property
+    def need(self) -> int:
+        return sum(tokens for _, tokens in self.items)
+
+    def fill(self, cap: int) -> None:
+        """在额度 cap 内从头保留条目；可截断段对第一个放不下的条目按比例截取开头。"""
+        self.cap = cap
+        self.used = 0
+        self.kept = []
+        self.truncated = False
+        for text, tokens in self.items:
+            if self.used + tokens <= cap:
+                self.kept.append(text)
+                self.used += tokens
+                continue
+            room = cap - self.used
+            if self.truncatable and tokens and room >= _MIN_TRUNCATE_TOKENS:
+                self.kept.append(text[:int(len(text) * room / tokens)])
+                self.used = cap
+                self.truncated = True
+            break
+
+    def report(self) -> dict:
+        return {
+            "cap": self.cap, "need": self.need, "tokens": self.used,
+            "kept": len(self.kept), "dropped": len(self.items) - len(self.kept),
+            "truncated": self.truncated,
+        }
+
+
+def plan_prompt(sections: list[Section], fixed_tokens: int) -> dict:
+    """
+    按 PROMPT_BUDGET_TOKENS 规划各段（原地写入 Section.kept），返回写入 trace 的预算报告。
+    fixed_tokens：不参与裁剪的部分（persona、指令、问题、上下文缓存中的文档）。
+    """
+    budget = settings.prompt_budget_tokens
+    available = max(budget - fixed_tokens, 0)
+    by_name = {s.name: s for s in sections}
+    # 第一轮：按份额保底，不超过实际需要
+    caps = {s.name: min(s.need, int(available * _SHARES.get(s.name, 0))) for s in sections}
+    # 第二轮：余量按优先级补给仍不够的段
+    spare = available - sum(caps.values())
+    for name in _PRIORITY:
+        s = by_name.get(name)
+        if s is None or spare <= 0:
+            continue
+        extra = min(s.need - caps[name], spare)
+        caps[name] += extra
+        spare -= extra
+    for s in sections:
+        s.fill(caps[s.name])
+    report = {
+        "budget": budget,
+        "fixed": fixed_tokens,
+        "sections": {s.name: s.report() for s in sections},
+    }
+    report["total"] = fixed_tokens + sum(s.used for s in sections)
+    report["trimmed"] = any(s.used < s.need for s in sections)
+    return report
@@ -1,9 +1,20 @@
+import array
 import asyncio
+import json
+import random
+import re
+import time
+import uuid
+import zlib
+from collections import deque
+from typing import AsyncIterator
 from google import genai
 from google.genai import types
-from .db import database
+from .db import database, acquire_conn, get_session_corpus_tokens, vec_param, binary_expr
+from .cache import TieredCache, content_key
+from .vector_cache import session_vector_cache
 from settings import settings, logger
-from pgvector.asyncpg import register_vector, Vector
+from pgvector.asyncpg import Vector
 
 
 # 动态 TOP_K 选择：
@@ -34,74 +45,457 @@ def _dynamic_select(candidates: list, min_k: int, max_k: int,
     return candidates[:final_cut]
 
 
-# 异步查询向量表，返回含溯源信息的 dict 列表
-# 先取 top_k_max 候选，再用距离间隔算法动态决定实际返回数量
-async def query_rag(query_embedding, session_id: str, source_files: list = None) -> list:
-    source_filter = "AND source_file = ANY($5)" if source_files else ""
+# ── 会话感知向量检索 ─────────────────────────────────────────────────────────
+# 全局 HNSW 索引 + WHERE session_id 过滤时，索引先按全局近邻取 ef_search 个候选再过滤，
+# 会话多时大部分候选属于其他会话，召回塌缩。按会话规模（knowledge_stats 计数）选择策略：
+#   exact  小会话：MATERIALIZED CTE 先按 session_id（btree）取出会话全部 chunk 再精确排序，
+#          不经 HNSW，结果即真实 top-k
+#   hnsw   大会话：会话 id 以字面量内联，若已由 scripts/build_session_indexes.py 建了该会话的
+#          部分 HNSW 索引，planner 会直接选它；会话内候选不足 limit 时按 4 倍放大 ef_search 重查
+#          （至 HNSW_EF_SEARCH_MAX），pgvector ≥ 0.8 可另开 HNSW_ITERATIVE_SCAN
+# 距离阈值在 Python 侧过滤，SQL 只取会话内最近的 limit 条，才能区分「会话内候选不足」与「阈值外」。
+_RAG_COLUMNS = "content, original_content, source_file, chunk_index, token_count"
+
+
+def _knn_sql(table: str, columns: str, where: str, qvec: str, limit: str, storage: str = None) -> str:
+    """
+    索引近邻查询：返回 columns + distance，按余弦距离升序取 limit 条。
+    binary 存储下 HNSW 建在二值量化向量上：先按汉明距离取 limit × BINARY_RERANK_FACTOR 个候选，
+    再按全精度余弦距离重排截断。qvec 为 vector 类型的 SQL 表达式（参数或列引用）。
+    """
+    storage = storage or settings.embedding_storage
+    vec = vec_param(qvec, storage)
+    if storage != "binary":
+        return f"""
+            SELECT {columns}, (embedding <=> {vec}) AS distance
+            FROM {table}
+            WHERE {where}
+            ORDER BY embedding <=> {vec}
+            LIMIT {limit}
+        """
+    return f"""
+        SELECT {columns}, (embedding <=> {vec}) AS distance
+        FROM {table}
+        WHERE id IN (
+            SELECT id FROM {table}
+            WHERE {where}
+            ORDER BY {binary_expr('embedding')} <~> {binary_expr(qvec + '::vector')}
+            LIMIT ({limit}) * {settings.binary_rerank_factor}
+        )
+        ORDER BY embedding <=> {vec}
+        LIMIT {limit}
+    """
+
+
+def _rag_strategy(chunk_count: int) -> str:
+    return "exact" if chunk_count <= settings.rag_exact_max_chunks else "hnsw"
+
+
+def _scope_where(args: list, session_ref: str, source_files: list = None, library: tuple = None) -> str:
+    """
+    检索范围的 WHERE 条件：会话自身 chunk（可按 source_files 限定）∪ 挂载的文档库文件。
+    library = (文档库会话 id, 挂载文件名列表)；新增参数追加到 args，按位置编号引用。
+    两支各自命中 (session_id, source_file) 索引，planner 以 BitmapOr 合并。
+    """
+    own = f"session_id = {session_ref} AND source_file IS NOT NULL"
+    if source_files:
+        args.append(source_files)
+        own += f" AND source_file = ANY(${len(args)})"
+    if not library:
+        return own
+    args.extend(library)
+    return f"(({own}) OR (session_id = ${len(args) - 1} AND source_file = ANY(${len(args)})))"
+
+
+async def _search_exact(conn, vector, session_id: str, limit: int,
+                        source_files: list = None, table: str = "knowledge_base",
+                        library: tuple = None) -> list:
+    args = [session_id, vector, limit]
+    where = _scope_where(args, "$1", source_files, library)
+    # 只物化 (id, distance)，取出 top-k 后再回表取正文，避免复制整个会话的文本
     query = f"""
-        SELECT content, original_content, source_file, chunk_index,
-               (embedding <=> $2) AS distance
-        FROM knowledge_base
-        WHERE session_id = $1
-          AND source_file IS NOT NULL
-          AND (embedding <=> $2) < $3
-          {source_filter}
-        ORDER BY embedding <=> $2
-        LIMIT $4
+        WITH s AS MATERIALIZED (
+            SELECT id, (embedding <=> {vec_param("$2")}) AS distance
+            FROM {table}
+            WHERE {where}
+        ),
+        top AS (SELECT id, distance FROM s ORDER BY distance LIMIT $3)
+        SELECT k.content, k.original_content, k.source_file, k.chunk_index, k.token_count, top.distance
+        FROM top JOIN {table} k ON k.id = top.id
+        ORDER BY top.distance
     """
-    vector = Vector(query_embedding)
-    async with database._backend._pool.acquire() as conn:
-        await register_vector(conn)
-        await conn.execute(f"SET LOCAL hnsw.ef_search = {settings.hnsw_ef_search}")
-        args = [session_id, vector, settings.rag_distance_threshold, settings.top_k_max]
-        if source_files:
-            args.append(source_files)
-        rows = await conn.fetch(query, *args)
-    candidates = [dict(r) for r in rows]
+    return await conn.fetch(query, *args)
+
+
+async def _search_hnsw(conn, vector, session_id: str, limit: int, chunk_count: int,
+                       source_files: list = None, table: str = "knowledge_base",
+                       adaptive: bool = True, storage: str = None,
+                       library: tuple = None) -> tuple[list, int]:
+    """返回 (rows, 最终 ef_search)。adaptive=False 时只按 HNSW_EF_SEARCH 查一次（对照基线）。"""
+    storage = storage or settings.embedding_storage
+    sid = uuid.UUID(str(session_id))   # 校验后内联为字面量，部分索引谓词才能在计划时匹配
+    args = [vector, limit]
+    own_where = f"session_id = '{sid}'::uuid AND source_file IS NOT NULL"
+    if source_files:
+        args.append(source_files)
+        own_where += f" AND source_file = ANY(${len(args)})"
+    query = _knn_sql(table, _RAG_COLUMNS, own_where, "$1", "$2", storage)
+    if library:
+        # 文档库一支单独内联 id（同样可命中文档库的部分索引），两支各取 limit 条后合并
+        lib_id = uuid.UUID(str(library[0]))
+        args.append(library[1])
+        lib_query = _knn_sql(
+            table, _RAG_COLUMNS,
+            f"session_id = '{lib_id}'::uuid AND source_file = ANY(${len(args)})",
+            "$1", "$2", storage,
+        )
+        query = f"SELECT * FROM (({query}) UNION ALL ({lib_query})) u ORDER BY distance LIMIT $2"
+    want = min(limit, chunk_count)
+    # binary 需要 limit × 重排倍数个候选，ef_search 不能低于它
+    fetch = limit * settings.binary_rerank_factor if storage == "binary" else limit
+    ef = max(settings.hnsw_ef_search, fetch)
+    async with conn.transaction():
+        if settings.hnsw_iterative_scan != "off":
+            await conn.execute(f"SET LOCAL hnsw.iterative_scan = {settings.hnsw_iterative_scan}")
+        while True:
+            await conn.execute(f"SET LOCAL hnsw.ef_search = {ef}")
+            rows = await conn.fetch(query, *args)
+            if not adaptive or len(rows) >= want or ef >= settings.hnsw_ef_search_max:
+                break
+            ef = min(ef * 4, settings.hnsw_ef_search_max)
+    return sorted(rows, key=lambda r: r["distance"]), ef
+
+
+async def _search_exact_many(conn, embeddings: list, session_id: str, limit: int,
+                             source_files: list = None, library: tuple = None) -> list[list]:
+    """
+    一条 SQL 完成多条查询的会话内精确检索：查询向量展开为行，与会话范围内的 chunk 逐对计算距离，
+    row_number() 按查询各取 top-k。与 _search_exact 相同，距离在 MATERIALIZED CTE 中算好，
+    planner 无法改用全局 HNSW 索引再按会话过滤（那样会话内候选不足、召回塌缩）。
+    """
+    args = [session_id, [_vector_literal(e) for e in embeddings], limit]
+    where = _scope_where(args, "$1", source_files, library)
+    query = f"""
+        WITH q AS MATERIALIZED (
+            SELECT ord, vec::vector AS vec
+            FROM unnest($2::text[]) WITH ORDINALITY AS q(vec, ord)
+        ),
+        s AS MATERIALIZED (
+            SELECT q.ord, id, (embedding <=> {vec_param("q.vec")}) AS distance
+            FROM q CROSS JOIN knowledge_base
+            WHERE {where}
+        ),
+        top AS (
+            SELECT ord, id, distance
+            FROM (SELECT ord, id, distance,
+                         row_number() OVER (PARTITION BY ord ORDER BY distance) AS rn
+                  FROM s) r
+            WHERE rn <= $3
+        )
+        SELECT top.ord, k.content, k.original_content, k.source_file, k.chunk_index, k.token_count, top.distance
+        FROM top JOIN knowledge_base k ON k.id = top.id
+        ORDER BY top.ord, top.distance
+    """
+    grouped: list[list] = [[] for _ in embeddings]
+    for r in await conn.fetch(query, *args):
+        grouped[r["ord"] - 1].append(r)
+    return grouped
+
+
+def _vector_literal(embedding) -> str:
+    # pgvector 文本格式，批量查询以 text[] 传参后在 SQL 中逐个转换为 vector
+    return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
+
+class _RagScope:
+    """一次检索的范围：会话自身 chunk（可按 source_files 限定）∪ 挂载的文档库文件，及各自的缓存版本。"""
+    __slots__ = ("own_total", "own_version", "library", "library_total", "library_version", "chunk_count")
+
+
+async def _rag_scope(session_id: str, source_files: list = None) -> _RagScope:
+    # 会话自身与其文档库的全部 knowledge_stats 行（文档库整体的版本用于向量缓存，挂载标记用于限定范围）
+    async with acquire_conn() as conn:
+        rows = await conn.fetch(
+            """SELECT ks.session_id, ks.source_file, ks.chunk_count, ks.updated_at,
+                      ks.session_id = $1 AS own, a.library_id IS NOT NULL AS attached
+               FROM knowledge_stats ks
+               LEFT JOIN session_library_files a
+                 ON a.session_id = $1 AND a.library_id = ks.session_id AND a.source_file = ks.source_file
+               WHERE ks.session_id = $1
+                  OR ks.session_id IN (SELECT library_id FROM session_library_files WHERE session_id = $1)""",
+            session_id,
+        )
+    wanted = set(source_files) if source_files else None
+    own = [r for r in rows if r["own"]]
+    lib = [r for r in rows if not r["own"]]
+    lib_files = [r for r in lib if r["attached"] and (wanted is None or r["source_file"] in wanted)]
+
+    scope = _RagScope()
+    scope.own_total = sum(r["chunk_count"] for r in own)
+    scope.own_version = (scope.own_total, max((r["updated_at"] for r in own), default=None))
+    scope.library_total = sum(r["chunk_count"] for r in lib)
+    scope.library_version = (scope.library_total, max((r["updated_at"] for r in lib), default=None))
+    scope.library = (str(lib[0]["session_id"]), [r["source_file"] for r in lib_files]) if lib_files else None
+    scope.chunk_count = (
+        sum(r["chunk_count"] for r in own if wanted is None or r["source_file"] in wanted)
+        + sum(r["chunk_count"] for r in lib_files)
+    )
+    return scope
+
+
+async def _cache_search(session_id: str, scope: _RagScope, query_embedding, limit: int,
+                        source_files: list = None) -> list | None:
+    """会话与文档库各自走进程内向量缓存（文档库缓存被该用户所有会话共享），任一不可缓存时返回 None。"""
+    rows = []
+    if scope.own_total:
+        rows = await session_vector_cache.search(
+            session_id, scope.own_version, scope.own_total, query_embedding, limit, source_files,
+        )
+        if rows is None:
+            return None
+    if scope.library:
+        lib_id, lib_files = scope.library
+        lib_rows = await session_vector_cache.search(
+            lib_id, scope.library_version, scope.library_total, query_embedding, limit, lib_files,
+        )
+        if lib_rows is None:
+            return None
+        rows = sorted(rows + lib_rows, key=lambda r: r["distance"])[:limit]
+    return rows
+
+
+async def _rag_finish(rows, vector, session_id: str, source_files: list, query_text: str,
+                      strategy: str, ef, scope: _RagScope) -> list:
+    """距离阈值 + 动态 Top-K，开启混合检索时再与词法命中做 RRF 融合。"""
+    candidates = [dict(r) for r in rows if r["distance"] < settings.rag_distance_threshold]
     selected = _dynamic_select(
         candidates, settings.top_k, settings.top_k_max,
         settings.top_k_margin, settings.top_k_gap
     )
     distances = [round(r['distance'], 3) for r in candidates]
-    logger.info("RAG: %d候选%s → 选取%d条 (margin=%.2f, gap=%.2f)",
+    logger.info("RAG[%s%s, %d chunks%s]: %d候选%s → 选取%d条 (margin=%.2f, gap=%.2f)",
+                strategy, f" ef={ef}" if ef else "", scope.chunk_count,
+                f", 文档库 {len(scope.library[1])} 个文件" if scope.library else "",
                 len(candidates), distances, len(selected),
                 settings.top_k_margin, settings.top_k_gap)
+
+    # 混合检索：精确词项（编号、型号、引号内名称）命中的 chunk 与向量结果做 RRF 融合
+    terms = lexical_terms(query_text) if settings.rag_hybrid and query_text else []
+    if terms:
+        lexical = await _search_lexical(vector, session_id, terms, settings.rag_lexical_k,
+                                        source_files, scope.library)
+        if lexical:
+            fused = _rrf_fuse([selected, lexical], settings.rag_rrf_k)[:settings.top_k_max]
+            logger.info("RAG 词法 %s: %d 条命中 → 融合后 %d 条（新增 %d）",
+                        terms, len(lexical), len(fused), len(fused) - len(selected))
+            return fused
     return selected
 
 
+# 异步查询向量表，返回含溯源信息的 dict 列表（范围 = 会话自身 ∪ 挂载的文档库文件）
+# 先取 top_k_max 候选，再用距离间隔算法动态决定实际返回数量
+async def query_rag(query_embedding, session_id: str, source_files: list = None,
+                    query_text: str = None) -> list:
+    vector = Vector(query_embedding)
+    limit = settings.top_k_max
+    scope = await _rag_scope(session_id, source_files)
+    if not scope.chunk_count:
+        return []
+
+    # 热点会话：进程内向量缓存命中则不回 Postgres（版本 = knowledge_stats 的 chunk 数 + 最后更新时间）
+    ef = None
+    rows = await _cache_search(session_id, scope, query_embedding, limit, source_files)
+    if rows is not None:
+        strategy = "cache"
+    else:
+        strategy = _rag_strategy(scope.chunk_count)
+        async with acquire_conn() as conn:
+            if strategy == "exact":
+                rows = await _search_exact(conn, vector, session_id, limit, source_files,
+                                           library=scope.library)
+            else:
+                rows, ef = await _search_hnsw(conn, vector, session_id, limit, scope.chunk_count,
+                                              source_files, library=scope.library)
+    return await _rag_finish(rows, vector, session_id, source_files, query_text, strategy, ef, scope)
+
+
+async def query_rag_many(query_embeddings: list, session_id: str, query_texts: list = None,
+                         source_files: list = None) -> list[list]:
+    """
+    同一会话的多条查询一次完成（Agent 同一轮的多个 search_kb），结果与逐条调用 query_rag 一致、顺序对应。
+    会话统计只查一次；exact 策略合并为一条 SQL（与 _search_exact 同样以 MATERIALIZED 隔离索引），hnsw 策略在同一连接上依次执行
+    （各查询的 ef_search 自适应互不影响）；调用方用 request_connection() 包住即全程只占一条连接。
+    """
+    if not query_embeddings:
+        return []
+    query_texts = query_texts or [None] * len(query_embeddings)
+    vectors = [Vector(e) for e in query_embeddings]
+    limit = settings.top_k_max
+    scope = await _rag_scope(session_id, source_files)
+    if not scope.chunk_count:
+        return [[] for _ in query_embeddings]
+
+    efs = [None] * len(query_embeddings)
+    # 向量缓存须对整批都命中（中途失效 / 被淘汰时返回 None），否则整批回 Postgres，避免个别查询静默无结果
+    grouped = []
+    for e in query_embeddings:
+        rows = await _cache_search(session_id, scope, e, limit, source_files)
+        if rows is None:
+            grouped = None
+            break
+        grouped.append(rows)
+    if grouped is not None:
+        strategy = "cache"
+    else:
+        strategy = _rag_strategy(scope.chunk_count)
+        async with acquire_conn() as conn:
+            if strategy == "exact":
+                grouped = await _search_exact_many(conn, query_embeddings, session_id, limit,
+                                                   source_files, library=scope.library)
+            else:
+                grouped = []
+                for i, vector in enumerate(vectors):
+                    rows, efs[i] = await _search_hnsw(conn, vector, session_id, limit, scope.chunk_count,
+                                                      source_files, library=scope.library)
+                    grouped.append(rows)
+    return [
+        await _rag_finish(rows, vector, session_id, source_files, text, strategy, ef, scope)
+        for rows, vector, text, ef in zip(grouped, vectors, query_texts, efs)
+    ]
+
+
+# ── 词法检索 + RRF 融合 ─────────────────────────────────────────────────────────
+# 向量检索对编号 / 型号 / 专有名词不敏感，这里抽取查询里的「精确词项」在 original_content 上做
+# 子串匹配（pg_trgm GIN 索引加速 ILIKE，按字符三元组切分，中文无需分词）：
+#   • 引号 / 书名号内的内容    “不可抗力”「张三丰」《劳动合同法》
+#   • 含数字的标识符           GB/T-7714、A3-0012、v2.5、ISO9001
+#   • 条款编号                 第十二条、第3.2节
+#   • 全大写缩写（≥ 2 字母）   GDPR、SLA
+#   • 整个查询很短（≤ 12 字）时作为一个词项（用户直接输入人名 / 编号）
+# ASCII 撇号 ' 不算引号：英文缩写（don't、what's）会把中间的整段文字误当作引用词项
+_QUOTED_RE = re.compile(r'[“"「『《‘](.{2,40}?)[”"」』》’]')
+_IDENT_RE = re.compile(r'[A-Za-z0-9][A-Za-z0-9_\-./]*\d[A-Za-z0-9_\-./]*|\d+[A-Za-z][A-Za-z0-9_\-]*')
+_CLAUSE_RE = re.compile(r'第[0-9一二三四五六七八九十百千零〇.]+[条章节款项篇]')
+_ACRONYM_RE = re.compile(r'\b[A-Z]{2,}\b')
+_SHORT_QUERY_CHARS = 12
+
+
+def lexical_terms(text: str, max_terms: int = 6) -> list[str]:
+    """抽取适合精确匹配的词项（去重保序）；没有可用词项时返回空列表。"""
+    text = (text or "").strip()
+    found = [m.group(1).strip() for m in _QUOTED_RE.finditer(text)]
+    found += _CLAUSE_RE.findall(text)
+    found += [t.strip("-./_") for t in _IDENT_RE.findall(text)]
+    found += _ACRONYM_RE.findall(text)
+    if not found and 2 <= len(text) <= _SHORT_QUERY_CHARS:
+        found.append(text.strip("？?。.!！ "))
+    terms: list[str] = []
+    for t in found:
+        # 已被更长词项包含的不再单列（GB/T-7714 中的 GB）
+        if len(t) >= 2 and not any(t in kept for kept in terms):
+            terms.append(t)
+    return terms[:max_terms]
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+async def _search_lexical(vector, session_id: str, terms: list, limit: int,
+                          source_files: list = None, library: tuple = None) -> list:
+    """按命中词项数排序返回 chunk，附带向量距离（供引用分数与后续融合使用）。"""
+    # 各词项展开为 OR，planner 可对 GIN 索引做 BitmapOr（ILIKE ANY(array) 用不上 GIN）
+    first = 4
+    patterns = [_like_pattern(t) for t in terms]
+    likes = " OR ".join(f"original_content ILIKE ${first + i}" for i in range(len(patterns)))
+    hits = " + ".join(f"(original_content ILIKE ${first + i})::int" for i in range(len(patterns)))
+    args = [session_id, vector, limit, *patterns]
+    where = _scope_where(args, "$1", source_files, library)
+    query = f"""
+        SELECT content, original_content, source_file, chunk_index, token_count,
+               (embedding <=> {vec_param("$2")}) AS distance, ({hits}) AS lexical_hits
+        FROM knowledge_base
+        WHERE {where}
+          AND ({likes})
+        ORDER BY lexical_hits DESC, distance
+        LIMIT $3
+    """
+    async with acquire_conn() as conn:
+        rows = await conn.fetch(query, *args)
+    return [dict(r) for r in rows]
+
+
+def _rrf_fuse(ranked_lists: list, k: int) -> list:
+    """Reciprocal Rank Fusion：score = Σ 1 / (k + rank)，按 (source_file, chunk_index) 去重合并。"""
+    scores: dict[tuple, float] = {}
+    items: dict[tuple, dict] = {}
+    for ranked in ranked_lists:
+        for rank, r in enumerate(ranked, start=1):
+            key = (r["source_file"], r["chunk_index"])
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            items.setdefault(key, r)
+    return [items[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
 # 语义检索历史消息（仅 assistant，用于回答「我们聊过 X 吗」类问题）
 async def query_history(query_embedding, session_id: str,
                         limit: int = 3, threshold: float = 0.4,
                         before_id: int = None) -> list:
     before_filter = "AND id < $5" if before_id is not None else ""
-    query = f"""
-        SELECT id, content, created_at,
-               (embedding <=> $2) AS distance
-        FROM messages
-        WHERE session_id = $1
-          AND role = 'assistant'
-          AND embedding IS NOT NULL
-          AND (embedding <=> $2) < $3
-          {before_filter}
-        ORDER BY embedding <=> $2
-        LIMIT $4
-    """
+    # 先取最近的 limit 条再按阈值过滤，与「阈值内取前 limit 条」结果相同
+    knn = _knn_sql(
+        "messages", "id, content, created_at",
+        f"session_id = $1 AND role = 'assistant' AND embedding IS NOT NULL {before_filter}",
+        "$2", "$4",
+    )
+    query = f"SELECT * FROM ({knn}) n WHERE distance < $3 ORDER BY distance"
     vector = Vector(query_embedding)
-    async with database._backend._pool.acquire() as conn:
-        await register_vector(conn)
+    async with acquire_conn() as conn:
         args = [session_id, vector, threshold, limit]
         if before_id is not None:
             args.append(before_id)
         rows = await conn.fetch(query, *args)
-    return [
-        {
-            "content": row["content"],
-            "snippet": row["content"][:300].strip(),
-            "created_at": row["created_at"],
-            "distance": round(row["distance"], 3),
-        }
-        for row in rows
-    ]
+    return [_history_item(row) for row in rows]
+
+
+async def query_history_many(query_embeddings: list, session_id: str,
+                             limit: int = 3, threshold: float = 0.4) -> list[list]:
+    """多条查询的历史回忆合并为一条 LATERAL SQL，结果与逐条调用 query_history 一致、顺序对应。"""
+    if not query_embeddings:
+        return []
+    knn = _knn_sql(
+        "messages", "id, content, created_at",
+        "session_id = $1 AND role = 'assistant' AND embedding IS NOT NULL",
+        "q.vec", "$4",
+    )
+    query = f"""
+        WITH q AS (
+            SELECT ord, vec::vector AS vec
+            FROM unnest($2::text[]) WITH ORDINALITY AS q(vec, ord)
+        )
+        SELECT q.ord, h.id, h.content, h.created_at, h.distance
+        FROM q
+        CROSS JOIN LATERAL ({knn}) h
+        WHERE h.distance < $3
+        ORDER BY q.ord, h.distance
+    """
+    async with acquire_conn() as conn:
+        rows = await conn.fetch(query, session_id, [_vector_literal(e) for e in query_embeddings],
+                                threshold, limit)
+    grouped: list[list] = [[] for _ in query_embeddings]
+    for row in rows:
+        grouped[row["ord"] - 1].append(_history_item(row))
+    return grouped
+
+
+def _history_item(row) -> dict:
+    return {
+        "content": row["content"],
+        "snippet": row["content"][:300].strip(),
+        "created_at": row["created_at"],
+        "distance": round(row["distance"], 3),
+    }
 
 
 # ── 全量上下文支持 ─────────────────────────────────────────────────────────────
@@ -115,40 +509,98 @@ def estimate_tokens(text: str) -> int:
     return int(len(text) / _CHARS_PER_TOKEN) if text else 0
 
 
-# 估算 session 全部知识库语料的 token 总量
+def chars_to_tokens(chars: int) -> int:
+    """按字符数估算 token 数（与 estimate_tokens 同一比例）。"""
+    return int(chars / _CHARS_PER_TOKEN)
+
+
+# session 全部知识库语料的 token 总量（读 knowledge_stats 计数，不扫描 chunk）
 async def estimate_session_tokens(session_id: str) -> int:
-    row = await database.fetch_one(
-        "SELECT COALESCE(SUM(LENGTH(COALESCE(original_content, content))), 0) AS total_chars "
-        "FROM knowledge_base "
-        "WHERE session_id = :sid AND source_file IS NOT NULL",
-        {"sid": session_id},
-    )
-    total_chars = int(row["total_chars"]) if row else 0
-    return int(total_chars / _CHARS_PER_TOKEN)
+    return await get_session_corpus_tokens(session_id)
+
+
+# ── 全量上下文语料缓存 ─────────────────────────────────────────────────────────
+# FULL_CONTEXT 路径每轮都要读出会话全部 chunk 并按文件拼接成数 MB 的全文。按 (会话, 语料版本) 缓存拼好的
+# 全文与文件级引用：本地层按字节计量（CORPUS_CACHE_MB），可选 Redis 共享层（zlib 压缩的 JSON）。
+# sessions.corpus_version 随入库 / 删除 / 挂载推进，旧版本不再命中，由 LRU / TTL 自然淘汰。
+def _corpus_dumps(value: tuple) -> bytes:
+    return zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+def _corpus_loads(raw: bytes) -> tuple:
+    text, citations, tokens = json.loads(zlib.decompress(raw))
+    return text, citations, tokens
+
+
+_corpus_cache = TieredCache(
+    "corpus",
+    maxsize=settings.corpus_cache_mb * 1024 * 1024,
+    ttl=settings.corpus_cache_ttl,
+    shared=settings.corpus_cache_shared,
+    dumps=_corpus_dumps,
+    loads=_corpus_loads,
+    getsizeof=lambda v: len(v[0]) * 2 + 256 * len(v[1]),
+)
+
+
+def corpus_cache_stats() -> dict:
+    """全量上下文语料缓存命中统计（admin 性能页展示用）。"""
+    return _corpus_cache.stats()
+
 
+# 缓存值格式版本（Redis 共享层跨部署存活），值结构变化时递增
+_CORPUS_FORMAT = 2
 
-# 拉取 session 全部 chunk，按 (source_file, chunk_index) 排序保留文档原顺序
-async def get_all_session_chunks(session_id: str) -> list:
+# chunk 的 token 数：入库时 count_tokens 的结果，旧数据（NULL）按字符估算
+_CHUNK_TOKENS = f"COALESCE(k.token_count, CEIL(LENGTH(COALESCE(k.original_content, k.content)) / {_CHARS_PER_TOKEN})::int)"
+
+
+async def get_session_corpus(session_id: str, corpus_version: str) -> tuple[str, list, int]:
+    """
+    会话全部文档（含挂载的文档库文件）按文件分组、带文件头拼接的全文、文件级 citations 及全文 token 数。
+    未命中缓存时由 Postgres 按文件 string_agg（chunk_index 升序）聚合，Python 侧只做文件级拼接。
+    """
+    key = content_key(session_id, corpus_version, _CORPUS_FORMAT)
+    cached = await _corpus_cache.get(key)
+    if cached is not None:
+        return cached
     rows = await database.fetch_all(
-        "SELECT source_file, chunk_index, "
-        "       COALESCE(original_content, content) AS content "
-        "FROM knowledge_base "
-        "WHERE session_id = :sid AND source_file IS NOT NULL "
-        "ORDER BY source_file, chunk_index",
+        "SELECT source_file, string_agg(content, E'\\n' ORDER BY chunk_index) AS content, "
+        "       SUM(tokens) AS tokens "
+        "FROM ("
+        f"    SELECT k.source_file, k.chunk_index, COALESCE(k.original_content, k.content) AS content, "
+        f"           {_CHUNK_TOKENS} AS tokens "
+        "    FROM knowledge_base k "
+        "    WHERE k.session_id = :sid AND k.source_file IS NOT NULL "
+        "    UNION ALL "
+        f"    SELECT k.source_file, k.chunk_index, COALESCE(k.original_content, k.content) AS content, "
+        f"           {_CHUNK_TOKENS} AS tokens "
+        "    FROM session_library_files a "
+        "    JOIN knowledge_base k ON k.session_id = a.library_id AND k.source_file = a.source_file "
+        "    WHERE a.session_id = :sid"
+        ") c "
+        "GROUP BY source_file ORDER BY source_file",
         {"sid": session_id},
     )
-    return [dict(r) for r in rows]
+    text = "\n\n".join(f"=== 文件：{r['source_file']} ===\n{r['content']}" for r in rows)
+    citations = [{"source": r["source_file"], "chunk": None, "score": 1.0, "snippet": ""} for r in rows]
+    # 文件头与分隔符未计入 chunk 统计，按字符估算补上
+    tokens = sum(int(r["tokens"] or 0) for r in rows) + estimate_tokens(
+        "\n\n".join(f"=== 文件：{r['source_file']} ===\n" for r in rows))
+    value = (text, citations, tokens)
+    await _corpus_cache.set(key, value)
+    return value
 
 
-# Agent tool 用：列出 session 内所有上传文档（含 chunk 数）
+# Agent tool 用：列出 session 内所有上传文档（含 chunk 数，含挂载的文档库文件）
 async def list_session_documents(session_id: str) -> list:
     rows = await database.fetch_all(
-        "SELECT source_file, COUNT(*) AS chunk_count, "
-        "       SUM(LENGTH(COALESCE(original_content, content))) AS total_chars "
-        "FROM knowledge_base "
-        "WHERE session_id = :sid AND source_file IS NOT NULL "
-        "GROUP BY source_file "
-        "ORDER BY source_file",
+        "SELECT ks.source_file, ks.chunk_count, ks.char_count AS total_chars "
+        "FROM knowledge_stats ks "
+        "WHERE ks.session_id = :sid "
+        "   OR (ks.session_id, ks.source_file) IN ("
+        "       SELECT library_id, source_file FROM session_library_files WHERE session_id = :sid) "
+        "ORDER BY ks.source_file",
         {"sid": session_id},
     )
     return [dict(r) for r in rows]
@@ -160,7 +612,9 @@ async def get_full_document(session_id: str, filename: str, max_chars: int = 30_
     rows = await database.fetch_all(
         "SELECT chunk_index, COALESCE(original_content, content) AS content "
         "FROM knowledge_base "
-        "WHERE session_id = :sid AND source_file = :fn "
+        "WHERE source_file = :fn "
+        "  AND (session_id = :sid OR session_id IN ("
+        "       SELECT library_id FROM session_library_files WHERE session_id = :sid AND source_file = :fn)) "
         "ORDER BY chunk_index",
         {"sid": session_id, "fn": filename},
     )
@@ -175,44 +629,163 @@ async def get_full_document(session_id: str, filename: str, max_chars: int = 30_
 _embed_config = types.EmbedContentConfig(output_dimensionality=settings.embedding_dim)
 
 
-# 异步获取单条文本嵌入
-async def get_embedding(client, text: str):
+# query embedding 缓存：key = sha256(模型名, 维度, 文本)，换模型或维度自动失效
+# 共享层以 float32 紧凑存储（与 pgvector vector 类型精度一致）
+_embedding_cache = TieredCache(
+    "emb",
+    maxsize=settings.embed_cache_size,
+    ttl=settings.embed_cache_ttl,
+    shared=settings.embed_cache_shared,
+    dumps=lambda v: array.array("f", v).tobytes(),
+    loads=lambda b: array.array("f", b).tolist(),
+)
+
+
+def embedding_cache_stats() -> dict:
+    """query embedding 缓存命中统计（admin 性能页展示用）。"""
+    return _embedding_cache.stats()
+
+
+# ── Embedding 限速 ─────────────────────────────────────────────────────────────
+# 进程级令牌桶：按每分钟配额匀速补充，桶容量 = 一分钟配额。
+# 无锁"预扣 + 欠账"实现：调用方先扣减，余额为负则睡眠到补足为止，
+# 不依赖 asyncio.Lock，因此可跨事件循环使用（Celery 任务内每次 asyncio.run 都是新循环）。
+class _TokenBucket:
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        if self.per_minute <= 0:
+            return
+        amount = min(amount, self.per_minute)
+        now = time.monotonic()
+        self._tokens = min(
+            self.per_minute,
+            self._tokens + (now - self._updated) * self.per_minute / 60,
+        )
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            try:
+                await asyncio.sleep(-self._tokens * 60 / self.per_minute)
+            except asyncio.CancelledError:
+                # 等待中被取消（如同一流水线的其它批次失败）：没发出的请求把预扣的额度退回
+                self._tokens += amount
+                raise
+
+
+_embed_rpm_bucket = _TokenBucket(settings.embed_rpm)
+_embed_tpm_bucket = _TokenBucket(settings.embed_tpm)
+
+
+async def _embed_rate_limit(texts: list) -> None:
+    await _embed_rpm_bucket.acquire(1)
+    await _embed_tpm_bucket.acquire(sum(estimate_tokens(t) for t in texts))
+
+
+def _is_retryable(e: Exception) -> bool:
+    msg = str(e)
+    return any(k in msg for k in ("429", "RESOURCE_EXHAUSTED", "503", "UNAVAILABLE"))
+
+
+# 异步获取单条文本嵌入；cache=False 用于一次性文本（如回答回写），避免挤占缓存
+async def get_embedding(client, text: str, cache: bool = True):
+    key = content_key(settings.embedding_model, settings.embedding_dim, text)
+    if cache:
+        cached = await _embedding_cache.get(key)
+        if cached is not None:
+            return cached
+    await _embed_rate_limit([text])
     resp = await asyncio.to_thread(
             client.models.embed_content,
             model=settings.embedding_model,
             contents=text,
             config=_embed_config,
         )
-    return resp.embeddings[0].values
+    values = resp.embeddings[0].values
+    if cache:
+        await _embedding_cache.set(key, values)
+    return values
 
 
-# 顺序批量获取文本嵌入，遇到 429 限流时指数退避重试
-async def get_embeddings_batch(client, texts: list, batch_size: int = 50, max_retries: int = 6) -> list:
-    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
-    all_embeddings = []
+# 多条短文本（同一轮 Agent 的检索 query）合并为一次 embed_content：逐条查缓存，未命中的去重后整批请求
+async def get_embeddings_cached(client, texts: list) -> list:
+    keys = [content_key(settings.embedding_model, settings.embedding_dim, t) for t in texts]
+    values = [await _embedding_cache.get(k) for k in keys]
+    missing = list(dict.fromkeys(t for t, v in zip(texts, values) if v is None))
+    if missing:
+        fresh = dict(zip(missing, await get_embeddings_batch(client, missing)))
+        for t in missing:
+            await _embedding_cache.set(content_key(settings.embedding_model, settings.embedding_dim, t), fresh[t])
+        values = [fresh[t] if v is None else v for t, v in zip(texts, values)]
+    return values
 
-    for idx, batch in enumerate(batches):
-        for attempt in range(max_retries):
-            try:
-                resp = await asyncio.to_thread(
-                    client.models.embed_content,
-                    model=settings.embedding_model,
-                    contents=batch,
-                    config=_embed_config,
-                )
-                all_embeddings.extend(e.values for e in resp.embeddings)
-                break
-            except Exception as e:
-                if '429' in str(e) or 'RESOURCE_EXHAUSTED' in str(e):
-                    wait = 30 * (2 ** attempt)  # 30s, 60s, 120s, ...
-                    logger.warning(
-                        "Embedding batch %d/%d 触发限流，%ds 后重试 (第 %d 次)",
-                        idx + 1, len(batches), wait, attempt + 1
-                    )
-                    await asyncio.sleep(wait)
-                else:
-                    raise
-        else:
-            raise RuntimeError(f"Embedding batch {idx + 1} 超过最大重试次数 ({max_retries})")
 
+# 单批 embedding：先过令牌桶，遇 429 / 503 仅本批做带抖动的指数退避重试（2s, 4s, 8s … 上限 60s）
+async def _embed_batch(client, batch: list, idx: int, total: int, max_retries: int) -> list:
+    for attempt in range(max_retries):
+        await _embed_rate_limit(batch)
+        try:
+            resp = await asyncio.to_thread(
+                client.models.embed_content,
+                model=settings.embedding_model,
+                contents=batch,
+                config=_embed_config,
+            )
+            return [e.values for e in resp.embeddings]
+        except Exception as e:
+            if not _is_retryable(e):
+                raise
+            wait = min(60.0, 2.0 * (2 ** attempt)) * random.uniform(0.5, 1.5)
+            logger.warning(
+                "Embedding batch %d/%d 触发限流，%.1fs 后重试 (第 %d 次)",
+                idx + 1, total, wait, attempt + 1
+            )
+            await asyncio.sleep(wait)
+    raise RuntimeError(f"Embedding batch {idx + 1} 超过最大重试次数 ({max_retries})")
+
+
+# 流水线批量 embedding：最多 embed_concurrency 个批次同时在途，按输入顺序逐批 yield (offset, embeddings)
+# 滑动窗口：消费方取走一批后才补发下一批，已完成未消费的结果不会无限堆积
+async def iter_embedding_batches(client, texts: list, batch_size: int = None,
+                                 max_retries: int = None) -> AsyncIterator[tuple[int, list]]:
+    batch_size = batch_size or settings.embed_batch_size
+    max_retries = max_retries or settings.embed_max_retries
+    offsets = list(range(0, len(texts), batch_size))
+    total = len(offsets)
+    upcoming = iter(enumerate(offsets))
+    in_flight: deque = deque()
+
+    def _launch() -> None:
+        nxt = next(upcoming, None)
+        if nxt is not None:
+            idx, offset = nxt
+            task = asyncio.create_task(
+                _embed_batch(client, texts[offset:offset + batch_size], idx, total, max_retries)
+            )
+            in_flight.append((offset, task))
+
+    for _ in range(max(1, settings.embed_concurrency)):
+        _launch()
+    try:
+        while in_flight:
+            offset, task = in_flight.popleft()
+            embeddings = await task
+            _launch()
+            yield offset, embeddings
+    finally:
+        # 提前结束（某批失败 / 消费方退出）：取消其余在途批次并等它们收尾，
+        # 避免 "Task exception was never retrieved"，令牌桶的预扣额度也在取消时退回
+        for _, task in in_flight:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in in_flight), return_exceptions=True)
+
+
+# 并发批量获取文本嵌入，返回顺序与输入一致
+async def get_embeddings_batch(client, texts: list, batch_size: int = None, max_retries: int = None) -> list:
+    all_embeddings = []
+    async for _, embeddings in iter_embedding_batches(client, texts, batch_size, max_retries):
+        all_embeddings.extend(embeddings)
     return all_embeddings
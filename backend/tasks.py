@@ -1,12 +1,24 @@
 """
-Celery 任务定义 — Phase 3a 仅一个 ping 任务用于联调验证。
+Celery 任务定义。
+
+  ping                 Phase 3a 联调验证
+  ingest_file          文件解析 → 分块 → embedding → 入库（ingest 队列）
+  summarize_session    把较早的对话消息增量折叠进会话滚动摘要（默认队列）
 
 后续阶段添加：
   bot_run_daily_queries        Phase 3b
   agent_b_analyze_pending_traces Phase 3c
   agent_c_verify_prompt_change Phase 3d
 """
+import asyncio
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+from settings import settings, logger
+from .cache import content_key, get_redis
 from .celery_app import celery_app
+from .db import database, get_file_status, update_file_status
+from .history_summary import summarize_session
 
 
 @celery_app.task(name="ping")
@@ -21,3 +33,127 @@ def ping() -> str:
         celery -A backend.celery_app call ping
     """
     return "pong"
+
+
+# ── 异步代码桥接 ──────────────────────────────────────────────────────────────
+# 业务代码（databases / asyncpg / genai aio）都是 async 的。每个 worker 子进程维持一个
+# 常驻事件循环，数据库连接池在首次使用时建立并跨任务复用（fork 之后才创建，避免继承父进程连接）。
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _run_async(coro):
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop.run_until_complete(coro)
+
+
+async def _ensure_db():
+    if not database.is_connected:
+        await database.connect()
+
+
+# ── 文件入库 ─────────────────────────────────────────────────────────────────
+# 幂等键 = (session_id, filename)：
+#   • Redis 锁（SET NX EX）保证同一文件同时只有一个 worker 在处理，重复投递直接跳过
+#   • status 已为 done 的文件不再处理（acks_late 重投、重复点击都安全）
+#   • 中途失败的重试依赖 ingest_file 的断点续传，已入库的 chunk 不会重复 embedding
+_INGEST_LOCK_TTL = 3600
+
+
+def _ingest_lock_key(session_id: str, filename: str) -> str:
+    return f"tsai:ingest-lock:{content_key(session_id, filename)}"
+
+
+async def _ingest(task, session_id: str, filename: str, filepath: str, force: bool) -> str:
+    from midware.upload import ingest_file  # 避免循环导入（upload 投递任务时引用本模块）
+
+    await _ensure_db()
+
+    redis = get_redis()
+    lock_key = _ingest_lock_key(session_id, filename)
+    token = task.request.id or "local"
+    if redis is not None:
+        try:
+            if not await redis.set(lock_key, token, nx=True, ex=_INGEST_LOCK_TTL):
+                logger.info("ingest 跳过（同一文件已有任务在处理）: %s/%s", session_id, filename)
+                return "locked"
+        except Exception as e:
+            logger.warning("ingest 锁不可用，继续处理: %s", e)
+            redis = None
+
+    try:
+        status = await get_file_status(session_id, filename)
+        if status is None:
+            logger.info("ingest 跳过（上传记录已删除）: %s/%s", session_id, filename)
+            return "missing"
+        if status == "done":
+            return "done"
+
+        try:
+            await ingest_file(settings.base_dir / filepath, session_id, force=force)
+            return "done"
+        except Exception as e:
+            error_msg = str(e) or f"{type(e).__name__}"
+            retries = task.request.retries
+            if retries < task.max_retries and not isinstance(e, SoftTimeLimitExceeded):
+                countdown = 30 * (2 ** retries)
+                logger.warning("ingest 失败，%ds 后第 %d 次重试: %s — %s",
+                               countdown, retries + 1, filename, error_msg)
+                await update_file_status(
+                    session_id, filename, 'pending',
+                    error=f"{error_msg}（{countdown}s 后自动重试 {retries + 1}/{task.max_retries}）",
+                )
+                raise task.retry(exc=e, countdown=countdown)
+            await update_file_status(session_id, filename, 'failed', error=error_msg)
+            logger.exception("处理文件 %s 出错: %s", filename, e)
+            return "failed"
+    finally:
+        if redis is not None:
+            try:
+                if (await redis.get(lock_key)) == token.encode():
+                    await redis.delete(lock_key)
+            except Exception:
+                pass
+
+
+@celery_app.task(
+    name="ingest_file",
+    bind=True,
+    acks_late=True,                 # worker 崩溃 / 重启时任务回到队列，不再丢失
+    reject_on_worker_lost=True,
+    max_retries=3,
+    soft_time_limit=3300,           # 大体积扫描件 OCR 可能较久，单独放宽全局 10 分钟上限
+    time_limit=3600,
+)
+def ingest_file_task(self, session_id: str, filename: str, filepath: str, force: bool = False) -> str:
+    """
+    解析并入库一个上传文件。filepath 为相对项目根目录的路径（upload_files.filepath）；
+    force=True（/upload/reprocess）时不复用同内容文件的 chunk 与已有向量。
+    返回 "done" / "failed" / "locked" / "missing"。
+    用法：
+        ingest_file_task.delay(session_id, filename, filepath)
+    """
+    return _run_async(_ingest(self, session_id, filename, filepath, force))
+
+
+# ── 滚动对话摘要 ─────────────────────────────────────────────────────────────
+# 每轮回答后投递；重复 / 并发投递安全（无待折叠消息直接返回，写入按 last_message_id 比较并交换）。
+async def _summarize(session_id: str) -> int:
+    await _ensure_db()
+    try:
+        return await summarize_session(session_id)
+    except Exception as e:
+        logger.warning("对话摘要更新失败 (session=%s): %s", session_id, e)
+        return 0
+
+
+@celery_app.task(name="summarize_session", ignore_result=True, soft_time_limit=120, time_limit=180)
+def summarize_session_task(session_id: str) -> int:
+    """
+    折叠会话中摘要之后、保留窗口之前的消息，返回折叠条数。
+    用法：
+        summarize_session_task.delay(session_id)
+    """
+    return _run_async(_summarize(session_id))
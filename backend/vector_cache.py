@@ -0,0 +1,167 @@
+"""
+进程内热点会话向量缓存（FAISS / NumPy）。
+
+Agent 多轮 search_kb、同一会话连续提问时，query_rag 反复回 Postgres 做相同会话的向量检索。
+首次查询某会话时把它的全部 chunk（向量 + 文本）载入内存，之后在本进程内精确计算余弦距离：
+
+  • 索引：faiss.IndexFlatIP（归一化向量的内积 = 1 - 余弦距离）；faiss 不可用时退回 NumPy 矩阵乘
+  • 容量：按字节计量的 LRU（VECTOR_CACHE_MB，0 = 关闭），超出预算的单个会话不缓存
+  • 失效：每次查询带上 knowledge_stats 的会话版本 (chunk 数, 最后更新时间)，与缓存时不一致即重载——
+    上传 / 重新处理 / 删除发生在 Celery worker 等其他进程时同样能感知；本进程内的删除路径另外显式 invalidate
+  • 并发：同一会话的首次加载只执行一次，并发查询等待同一次加载
+
+结果格式与 SQL 检索一致（content / original_content / source_file / chunk_index / token_count / distance），
+调用方照常应用距离阈值与 _dynamic_select。
+"""
+import asyncio
+from collections import OrderedDict
+
+import numpy as np
+
+from settings import settings, logger
+from .db import acquire_conn
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu 可选，缺失时用 NumPy
+    faiss = None
+
+
+class _SessionIndex:
+    __slots__ = ("version", "matrix", "index", "rows", "sources", "nbytes")
+
+    def __init__(self, version, rows: list):
+        self.version = version
+        self.rows = [
+            {"content": r["content"], "original_content": r["original_content"],
+             "source_file": r["source_file"], "chunk_index": r["chunk_index"], "token_count": r["token_count"]}
+            for r in rows
+        ]
+        matrix = np.asarray([r["embedding"] for r in rows], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix = np.ascontiguousarray(matrix / norms)
+        self.sources = np.asarray([r["source_file"] for r in rows], dtype=object)
+        self.index = None
+        if faiss is not None:
+            self.index = faiss.IndexFlatIP(self.matrix.shape[1])
+            self.index.add(self.matrix)
+        text_bytes = sum(len(r["content"] or "") + len(r["original_content"] or "") for r in rows) * 2
+        self.nbytes = self.matrix.nbytes * (2 if self.index is not None else 1) + text_bytes
+
+    def search(self, query: np.ndarray, limit: int, source_files: list = None) -> list:
+        q = query.astype(np.float32)
+        q /= (np.linalg.norm(q) or 1.0)
+        if source_files:
+            mask = np.isin(self.sources, source_files)
+            idx = np.flatnonzero(mask)
+            if not len(idx):
+                return []
+            sims = self.matrix[idx] @ q
+            order = np.argsort(-sims)[:limit]
+            hits = [(int(idx[i]), float(sims[i])) for i in order]
+        elif self.index is not None:
+            sims, ids = self.index.search(q.reshape(1, -1), min(limit, len(self.rows)))
+            hits = [(int(i), float(s)) for i, s in zip(ids[0], sims[0]) if i >= 0]
+        else:
+            sims = self.matrix @ q
+            k = min(limit, len(sims))
+            top = np.argpartition(-sims, k - 1)[:k]
+            hits = [(int(i), float(sims[i])) for i in top[np.argsort(-sims[top])]]
+        return [{**self.rows[i], "distance": 1.0 - s} for i, s in hits]
+
+
+class SessionVectorCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _SessionIndex] = OrderedDict()
+        self._loading: dict[str, asyncio.Future] = {}
+        self._oversize: dict[str, object] = {}   # 会话 → 载入后超预算时的版本，版本不变不再重试
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def invalidate(self, session_id: str) -> None:
+        self._oversize.pop(str(session_id), None)
+        entry = self._entries.pop(str(session_id), None)
+        if entry is not None:
+            self.size -= entry.nbytes
+
+    async def search(self, session_id: str, version, chunk_count: int, query_embedding, limit: int,
+                     source_files: list = None) -> list | None:
+        """命中（或成功载入）返回结果列表；会话超出预算 / 缓存关闭时返回 None，由调用方回退 SQL。"""
+        if not self.enabled:
+            return None
+        key = str(session_id)
+        # 仅向量就超出预算的会话不尝试载入
+        if chunk_count * settings.embedding_dim * 4 > self.max_bytes or self._oversize.get(key) == version:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and entry.version == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = await self._load(key, version)
+            if entry is None:
+                return None
+        return entry.search(np.asarray(query_embedding, dtype=np.float32), limit, source_files)
+
+    async def _load(self, key: str, version) -> _SessionIndex | None:
+        pending = self._loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[key] = fut
+        try:
+            async with acquire_conn() as conn:
+                rows = await conn.fetch(
+                    """SELECT content, original_content, source_file, chunk_index, token_count,
+                              embedding::vector AS embedding
+                       FROM knowledge_base
+                       WHERE session_id = $1 AND source_file IS NOT NULL AND embedding IS NOT NULL""",
+                    key,
+                )
+            entry = await asyncio.to_thread(_SessionIndex, version, rows) if rows else None
+            if entry is not None and entry.nbytes > self.max_bytes:
+                logger.info("向量缓存：会话 %s 约 %.1fMB 超出预算，不缓存", key, entry.nbytes / 2**20)
+                self._oversize[key] = version
+                entry = None
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes
+            if entry is not None:
+                self._entries[key] = entry
+                self.size += entry.nbytes
+                while self.size > self.max_bytes and self._entries:
+                    _, old = self._entries.popitem(last=False)
+                    self.size -= old.nbytes
+            fut.set_result(entry)
+            return entry
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # 标记已取回，无人等待时不告警
+            raise
+        finally:
+            self._loading.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "namespace": "vec (faiss)" if faiss is not None else "vec (numpy)",
+            "hits_local": self.hits,
+            "hits_shared": 0,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "local_size": self.size,
+            "local_maxsize": self.max_bytes,
+            "size_unit": "bytes",
+            "shared": False,
+        }
+
+
+session_vector_cache = SessionVectorCache(settings.vector_cache_mb * 1024 * 1024)
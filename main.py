@@ -1,12 +1,12 @@
 from fastapi import FastAPI, Request, Form, Query, Depends, HTTPException, BackgroundTasks
 from starlette.exceptions import HTTPException as StarletteHTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from google import genai
 from google.genai import types
-from pgvector.asyncpg import register_vector, Vector
 import asyncio
+import json
 import re
 import time
 import uuid
@@ -20,17 +20,24 @@ _RECALL_PATTERNS = re.compile(
 )
 from settings import settings, client, embed_client, logger
 from account import router as account_router, get_current_user
-from backend.db import database, init_db, save_message, update_message_embedding, get_context, session_exists, session_owned_by, add_knowledge, get_user_today_tokens, get_session_persona, get_session_persona_origin, update_session_persona, save_persona_origin, update_session_instruction, record_trace
-from backend.rag import get_embedding, query_rag, query_history, estimate_session_tokens, get_all_session_chunks
-from backend.agent_chat import needs_agent, run_agent_chat
+from backend.db import database, request_connection, init_db, save_message, update_message_embedding, get_chat_preamble, session_exists, session_owned_by, add_knowledge, get_session_persona_origin, update_session_persona, save_persona_origin, update_session_instruction, record_trace, find_cached_answer, save_cached_answer
+from backend.rag import get_embedding, query_rag, query_history, get_session_corpus, estimate_tokens
+from backend.prompt_budget import Section, start_counting, settle_counts, chunk_tokens, plan_prompt
+from backend.cache import content_key
+from backend.vector_cache import session_vector_cache
+from backend.context_cache import get_context_cache, drop_context_cache
+from backend.history_summary import schedule_summary
+from backend.agent_chat import needs_agent, run_agent_chat, run_agent_chat_stream, current_prompt_version
 from midware.tools import fetch_from_web
 from midware.upload import router as upload_router, upload_file
+from midware.library import router as library_router
 from admin import admin_router
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.include_router(account_router, prefix="/account", tags=["account"])
 app.include_router(upload_router, prefix="/upload", tags=["upload"])
+app.include_router(library_router, prefix="/library", tags=["library"])
 app.include_router(admin_router, prefix="/admin", tags=["admin"])
 templates = Jinja2Templates(directory="templates")
 
@@ -42,8 +49,6 @@ async def startup():
     # Phase 3a 表是幂等的（IF NOT EXISTS），可安全在每次启动时执行
     from backend.db import init_phase3_tables
     await init_phase3_tables()
-    async with database._backend._pool.acquire() as conn:
-        await register_vector(conn)
 
 
 @app.on_event("shutdown")
@@ -87,30 +92,302 @@ async def ping():
     return {"status": "ok"}
 
 
+# ── SSE 流式输出 ──────────────────────────────────────────────────────────────
+# 客户端带 Accept: text/event-stream 时 /chat 以 SSE 逐块推送回答，否则保持原 JSON 响应。
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",   # 关闭 nginx 代理缓冲，保证逐块下发
+}
+
+
+def _wants_event_stream(request: Request) -> bool:
+    return "text/event-stream" in request.headers.get("accept", "")
+
+
+def _sse(event: str, data: dict) -> str:
+    """编码一条 SSE 事件（data 为单行 JSON）。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+# 后台异步为 assistant 消息计算并存储 embedding，供历史检索使用
+async def _save_answer_embedding(msg_id: int, answer: str):
+    try:
+        emb = await get_embedding(embed_client, answer[:2000], cache=False)
+        await update_message_embedding(msg_id, emb)
+    except Exception as e:
+        logger.warning("历史消息 embedding 存储失败 (id=%s): %s", msg_id, e)
+
+
+_FULL_CONTEXT_HEADER = "All uploaded documents in this session (full content):\n"
+_RAG_HEADER = "Relevant info from uploaded documents:\n"
+_HISTORY_HEADER = "Relevant excerpts from past conversation in this session:\n"
+_SUMMARY_HEADER = "Summary of earlier conversation in this session:\n"
+_WEB_HEADER = "Latest info from web:\n"
+_CITE_INSTRUCTION = "如果回答引用了上传文档的原文或观点，请在该句末尾用括号标注来源，格式为（来源：文件名，第N段）。直接引用原文时请加引号。\n"
+
+
+async def _full_corpus_section(session_id: str, corpus_version: str) -> tuple[str, list]:
+    """上下文缓存的内容：带段落标题的文档全文 + citations。"""
+    rag_text, citations, _ = await get_session_corpus(session_id, corpus_version)
+    return f"{_FULL_CONTEXT_HEADER}{rag_text}", citations
+
+
+def _history_line(r: dict) -> str:
+    created = r["created_at"]
+    day = created.strftime('%Y-%m-%d') if hasattr(created, 'strftime') else str(created)[:10]
+    return f"[{day}] {r['snippet']}{'…' if len(r['content']) > 300 else ''}"
+
+
+def _usage_tokens(usage) -> tuple[int, int, int, int]:
+    """usage_metadata → (tokens_in, tokens_out, tokens_total, tokens_cached)；tokens_in 含缓存命中部分。"""
+    return (
+        getattr(usage, "prompt_token_count",         0) or 0,
+        getattr(usage, "candidates_token_count",     0) or 0,
+        getattr(usage, "total_token_count",          0) or 0,
+        getattr(usage, "cached_content_token_count", 0) or 0,
+    )
+
+
+# 后台写入语义回答缓存
+async def _save_answer_cache(cache_key: dict, *, route: str, answer: str, citations: list):
+    try:
+        await save_cached_answer(**cache_key, route=route, answer=answer, citations=citations,
+                                 ttl_hours=settings.answer_cache_ttl_hours)
+    except Exception as e:
+        logger.warning("语义回答缓存写入失败 (session=%s): %s", cache_key["session_id"], e)
+
+
+def _schedule_post_answer(background_tasks: BackgroundTasks, *, msg_id: int, answer: str,
+                          cache_key: dict | None = None, **trace):
+    """
+    回答落库后的收尾：embedding 回写 + Phase 3a trace 落盘 + 投递滚动摘要任务（均在响应结束后执行）；
+    传入 cache_key（本次未命中语义缓存）时顺带写入回答缓存。
+    """
+    background_tasks.add_task(_save_answer_embedding, msg_id, answer)
+    background_tasks.add_task(record_trace, message_id=msg_id, **trace)
+    background_tasks.add_task(schedule_summary, trace["session_id"])
+    if cache_key is not None and answer:
+        background_tasks.add_task(
+            _save_answer_cache, cache_key,
+            route=trace["route"], answer=answer, citations=trace.get("citations") or [],
+        )
+
+
+def _web_grounded(resp) -> bool:
+    """回答（或流式分块）是否用到了 Google Search grounding：这类回答有时效性，不写入语义缓存。"""
+    for cand in getattr(resp, "candidates", None) or []:
+        meta = getattr(cand, "grounding_metadata", None)
+        if meta is not None and (meta.web_search_queries or meta.grounding_chunks):
+            return True
+    return False
+
+
+def _answer_cacheable(message: str) -> bool:
+    """语义回答缓存只处理自足的提问：过短的追问与回忆型提问依赖上下文，不查不存。"""
+    return (
+        settings.answer_cache_enabled
+        and len(message.strip()) >= settings.answer_cache_min_chars
+        and not _RECALL_PATTERNS.search(message)
+    )
+
+
+async def _lookup_answer_cache(*, session_id: str, message: str, corpus_version: str, persona: str,
+                               use_agent: bool, source_list: list | None, context_hash: str):
+    """
+    查语义回答缓存，返回 (cache_key, query_embedding, cached)。
+    cached 非 None 即命中；未命中时 cache_key 供生成后写入，query_embedding 供后续检索复用。
+    embedding / 查询失败时降级为不使用缓存，返回 (None, None, None)。
+    """
+    try:
+        query_embedding = await get_embedding(embed_client, message)
+        cache_key = {
+            "session_id": session_id,
+            "corpus_version": corpus_version,
+            "persona_hash": content_key(persona),
+            "prompt_version": await current_prompt_version() if use_agent else 0,
+            "source_filter": ",".join(sorted(source_list)) if source_list else "",
+            "context_hash": context_hash,
+        }
+        cached = await find_cached_answer(
+            **cache_key, embedding=query_embedding,
+            max_distance=settings.answer_cache_max_distance, ttl_hours=settings.answer_cache_ttl_hours,
+        )
+    except Exception as e:
+        logger.warning("语义回答缓存查询失败，按未命中处理: %s", e)
+        return None, None, None
+    cache_key.update(query=message, embedding=query_embedding)
+    return cache_key, query_embedding, cached
+
+
+async def _cached_answer_response(request: Request, background_tasks: BackgroundTasks, cached: dict, *,
+                                  session_id: str, user_id: int, message: str, prompt_version: int,
+                                  chat_t0: float):
+    """语义缓存命中：不调用模型，按请求方式返回 JSON 或一次性的 SSE（delta → citations → done）。"""
+    answer, citations = cached["answer"], cached["citations"]
+    msg_id = await save_message(session_id, "assistant", answer)
+    _schedule_post_answer(
+        background_tasks, msg_id=msg_id, answer=answer,
+        session_id=session_id, user_id=user_id,
+        query=message, route=cached["route"],
+        tools_called=[], iterations=0,
+        citations=citations,
+        tokens_in=0, tokens_out=0,
+        duration_ms=int((time.monotonic() - chat_t0) * 1000),
+        prompt_version_id=prompt_version or None,
+        cache_hit=True,
+    )
+    if _wants_event_stream(request):
+        async def _events():
+            yield _sse("delta", {"text": answer})
+            yield _sse("citations", {"citations": citations})
+            yield _sse("done", {"message_id": msg_id, "cached": True})
+        return StreamingResponse(_events(), media_type="text/event-stream", headers=_SSE_HEADERS)
+    return JSONResponse({"answer": answer, "citations": citations, "cached": True})
+
+
+async def _stream_answer(background_tasks: BackgroundTasks, *, prompt: str,
+                         config: types.GenerateContentConfig, session_id: str, user_id: int,
+                         message: str, route: str, citations: list, chat_t0: float,
+                         cache_key: dict | None = None, prompt_budget: dict | None = None):
+    """
+    转发 Gemini generate_content_stream 的分块为 SSE：
+      delta     {"text": ...}          每个文本分块
+      citations {"citations": [...]}   回答结束后的引用列表
+      done      {"message_id": ...}    落库完成
+      error     {"detail": ...}        模型调用失败
+    消息保存在流结束后进行；embedding 与 trace 挂到 background_tasks，随响应关闭后执行。
+    """
+    parts: list[str] = []
+    usage = None
+    grounded = False
+    try:
+        stream = await client.aio.models.generate_content_stream(
+            model=settings.generation_model, contents=prompt, config=config,
+        )
+        async for chunk in stream:
+            if chunk.usage_metadata:
+                usage = chunk.usage_metadata
+            grounded = grounded or _web_grounded(chunk)
+            text = chunk.text
+            if text:
+                parts.append(text)
+                yield _sse("delta", {"text": text})
+    except Exception as e:
+        logger.exception("Gemini 流式调用失败: %s", e)
+        yield _sse("error", {"detail": "AI 服务暂时不可用，请稍后重试"})
+        return
+
+    answer = "".join(parts)
+    tokens_in, tokens_out, tokens_total, tokens_cached = _usage_tokens(usage)
+    msg_id = await save_message(session_id, "assistant", answer,
+                                tokens_in=tokens_in, tokens_out=tokens_out, tokens_total=tokens_total)
+    _schedule_post_answer(
+        background_tasks, msg_id=msg_id, answer=answer, cache_key=None if grounded else cache_key,
+        session_id=session_id, user_id=user_id,
+        query=message, route=route,
+        tools_called=[], iterations=1,
+        citations=citations,
+        tokens_in=tokens_in, tokens_out=tokens_out, tokens_cached=tokens_cached,
+        duration_ms=int((time.monotonic() - chat_t0) * 1000),
+        prompt_version_id=None,
+        prompt_budget=prompt_budget,
+    )
+    yield _sse("citations", {"citations": citations})
+    yield _sse("done", {"message_id": msg_id})
+
+
+async def _save_agent_answer(background_tasks: BackgroundTasks, agent_result: dict, *,
+                             session_id: str, user_id: int, message: str, chat_t0: float,
+                             cache_key: dict | None = None) -> int:
+    """保存 Agent 最终回答并挂上 embedding / trace（/ 回答缓存）收尾任务，返回 message id。"""
+    answer = agent_result["answer"]
+    # 调用过 web_search 的回答有时效性，不写入语义缓存
+    used_web = any(t.get("tool") == "web_search" for t in agent_result["agent_trace"])
+    a_tokens_in   = agent_result["tokens_in"]
+    a_tokens_out  = agent_result["tokens_out"]
+    a_tokens_total = a_tokens_in + a_tokens_out
+    msg_id = await save_message(
+        session_id, "assistant", answer,
+        tokens_in=a_tokens_in, tokens_out=a_tokens_out, tokens_total=a_tokens_total,
+    )
+    # embedding 回写 + Phase 3a trace 落盘（异步，不阻塞响应）
+    _schedule_post_answer(
+        background_tasks, msg_id=msg_id, answer=answer,
+        cache_key=cache_key if agent_result.get("complete") and not used_web else None,
+        session_id=session_id, user_id=user_id,
+        query=message, route="agent",
+        tools_called=agent_result["agent_trace"],
+        iterations=agent_result["iterations"],
+        citations=agent_result["citations"],
+        tokens_in=a_tokens_in, tokens_out=a_tokens_out,
+        duration_ms=int((time.monotonic() - chat_t0) * 1000),
+        prompt_version_id=agent_result.get("prompt_version_id"),
+    )
+    return msg_id
+
+
+async def _stream_agent(background_tasks: BackgroundTasks, *, session_id: str, user_id: int,
+                        message: str, persona: str, history_text: str, chat_t0: float,
+                        web_task: asyncio.Future, cache_key: dict | None = None):
+    """
+    Agent 路径的 SSE：run_agent_chat_stream 的每个事件按其 type 作为 SSE event 名下发
+    （round_start / delta / tool_call / tool_result），final 事件转为 citations + done。
+    web 预抓（web_task，与语义缓存查询并行发出）放在流内等待，响应头无需等待它。
+    """
+    web_info = await web_task
+    if web_info:
+        cache_key = None   # 带 web 信息的回答有时效性，不写入语义缓存
+    async for event in run_agent_chat_stream(
+        query=message,
+        session_id=session_id,
+        persona=persona,
+        history_text=history_text,
+        web_info=web_info,
+    ):
+        kind = event.pop("type")
+        if kind != "final":
+            yield _sse(kind, event)
+            continue
+        msg_id = await _save_agent_answer(
+            background_tasks, event,
+            session_id=session_id, user_id=user_id, message=message, chat_t0=chat_t0,
+            cache_key=cache_key,
+        )
+        yield _sse("citations", {"citations": event["citations"]})
+        yield _sse("done", {
+            "message_id": msg_id,
+            "answer": event["answer"],
+            "agent_trace": event["agent_trace"],
+            "iterations": event["iterations"],
+        })
+
+
 @app.post("/chat")
-async def chat(background_tasks: BackgroundTasks,
+async def chat(request: Request, background_tasks: BackgroundTasks,
                session_id: str = Form(...), message: str = Form(...),
                source_files: str = Form(""), user=Depends(get_current_user)):
-    if not await session_owned_by(session_id, user["id"]):
-        raise HTTPException(status_code=403, detail="无权访问该会话")
     _chat_t0 = time.monotonic()
-    # 检查每日 Token 配额
+    # 前置数据一次往返取回：归属、今日用量、写入用户消息（有权且未超额时）、滚动摘要与近期上下文、语料规模、persona
     max_tokens = user["max_daily_tokens"] or 0
-    if max_tokens > 0:
-        today_used = await get_user_today_tokens(user["id"])
-        if today_used >= max_tokens:
-            raise HTTPException(status_code=429, detail=f"今日 Token 配额已用完（上限 {max_tokens}）")
-
-    # 保存用户消息
-    await save_message(session_id, "user", message)
-    # print('message: ', message)
-
-    # 获取历史上下文
-    context = await get_context(session_id, limit=settings.max_history_turns)
+    pre = await get_chat_preamble(
+        session_id, user["id"], message,
+        history_limit=settings.max_history_turns, max_daily_tokens=max_tokens,
+        use_summary=settings.history_summary_enabled,
+    )
+    if not pre["owned"]:
+        raise HTTPException(status_code=403, detail="无权访问该会话")
+    # 检查每日 Token 配额（超额时用户消息未写入）
+    if max_tokens > 0 and pre["today_tokens"] >= max_tokens:
+        raise HTTPException(status_code=429, detail=f"今日 Token 配额已用完（上限 {max_tokens}）")
+
+    persona = pre["persona"]
+    context = pre["context"]
+    # 较早的消息已折叠进滚动摘要，context 只含摘要之后的原文消息
+    summary_section = f"{_SUMMARY_HEADER}{pre['summary']}\n\n" if pre["summary"] else ""
     context_text = "\n".join([f"{c['role']}: {c['content']}" for c in context])
 
-    # 判断 session 语料规模：小语料走全量上下文路径，大语料走 RAG 路径
-    session_tokens = await estimate_session_tokens(session_id)
+    # 判断 session 语料规模（入库时 count_tokens 的计数）：小语料走全量上下文路径，大语料走 RAG 路径
+    session_tokens = pre["corpus_tokens"]
     use_full_context = 0 < session_tokens < settings.full_context_threshold
 
     # Phase 2 Agent 路由：大语料 + 开关开启 + 复杂查询 → Agent 循环
@@ -129,63 +406,76 @@ async def chat(background_tasks: BackgroundTasks,
         else ("RAG" if session_tokens > 0 else "EMPTY_KB"),
     )
 
+    source_list = [s.strip() for s in source_files.split(',') if s.strip()] if source_files else None
+
+    # web 信息各路径都要用，与语义缓存查询 / embedding 并行抓取（命中缓存时取消）
+    web_task = asyncio.ensure_future(fetch_from_web(message))
+
+    # ── 语义回答缓存：语料 / persona / prompt 未变时近似重复的提问直接复用回答，跳过检索与生成 ──
+    # 只处理自足的提问，键只含稳定状态：近期消息每轮都变，纳入键会让缓存永不命中；
+    # 滚动摘要（用户背景、偏好、约束）影响回答，按其哈希分区
+    cache_key = query_embedding = None
+    if _answer_cacheable(message):
+        cache_key, query_embedding, cached = await _lookup_answer_cache(
+            session_id=session_id, message=message, corpus_version=pre["corpus_version"],
+            persona=persona, use_agent=use_agent, source_list=source_list,
+            context_hash=content_key(pre["summary"] or ""),
+        )
+        if cached is not None:
+            web_task.cancel()
+            logger.info("/chat session=%s 语义缓存命中 (distance=%.4f, route=%s)",
+                        session_id, cached["distance"], cached["route"])
+            return await _cached_answer_response(
+                request, background_tasks, cached,
+                session_id=session_id, user_id=user["id"], message=message,
+                prompt_version=cache_key["prompt_version"], chat_t0=_chat_t0,
+            )
+
     # ── Phase 2 Agent 分支：独立完整流程，提前 return ─────────────────────────
     if use_agent:
-        persona = await get_session_persona(session_id)
+        if _wants_event_stream(request):
+            return StreamingResponse(
+                _stream_agent(
+                    background_tasks, session_id=session_id, user_id=user["id"],
+                    message=message, persona=persona, history_text=summary_section + context_text,
+                    chat_t0=_chat_t0,
+                    cache_key=cache_key,
+                    web_task=web_task,
+                ),
+                media_type="text/event-stream",
+                headers=_SSE_HEADERS,
+            )
         # 预抓 web 信息，作为 Agent 的免费上下文（减少 web_search 工具调用）
-        web_info = await fetch_from_web(message)
+        web_info = await web_task
+        if web_info:
+            cache_key = None   # 带 web 信息的回答有时效性，不写入语义缓存
         agent_result = await run_agent_chat(
             query=message,
             session_id=session_id,
             persona=persona,
-            history_text=context_text,
+            history_text=summary_section + context_text,
             web_info=web_info,
         )
-        answer = agent_result["answer"]
-        a_tokens_in   = agent_result["tokens_in"]
-        a_tokens_out  = agent_result["tokens_out"]
-        a_tokens_total = a_tokens_in + a_tokens_out
-        msg_id = await save_message(
-            session_id, "assistant", answer,
-            tokens_in=a_tokens_in, tokens_out=a_tokens_out, tokens_total=a_tokens_total,
-        )
-
-        async def _agent_save_embedding():
-            try:
-                emb = await get_embedding(embed_client, answer[:2000])
-                await update_message_embedding(msg_id, emb)
-            except Exception as e:
-                logger.warning("历史消息 embedding 存储失败 (id=%s): %s", msg_id, e)
-
-        background_tasks.add_task(_agent_save_embedding)
-
-        # Phase 3a — 落盘 trace（异步，不阻塞响应）
-        background_tasks.add_task(
-            record_trace,
-            session_id=session_id, user_id=user["id"], message_id=msg_id,
-            query=message, route="agent",
-            tools_called=agent_result["agent_trace"],
-            iterations=agent_result["iterations"],
-            citations=agent_result["citations"],
-            tokens_in=a_tokens_in, tokens_out=a_tokens_out,
-            duration_ms=int((time.monotonic() - _chat_t0) * 1000),
-            prompt_version_id=agent_result.get("prompt_version_id"),
+        await _save_agent_answer(
+            background_tasks, agent_result,
+            session_id=session_id, user_id=user["id"], message=message, chat_t0=_chat_t0,
+            cache_key=cache_key,
         )
-
         return JSONResponse({
-            "answer": answer,
+            "answer": agent_result["answer"],
             "citations": agent_result["citations"],
             "agent_trace": agent_result["agent_trace"],
             "iterations": agent_result["iterations"],
         })
 
     # ── 否则继续 Phase 1 既有路径 ────────────────────────────────────────────
-    # embedding、RAG 查询、Web 搜索并发执行
-    source_list = [s.strip() for s in source_files.split(',') if s.strip()] if source_files else None
-    query_embedding, web_info = await asyncio.gather(
-        get_embedding(embed_client, message),
-        fetch_from_web(message),
-    )
+    # embedding 与 Web 搜索并发执行（查过语义缓存时 embedding 已就绪，web 抓取早已在途）
+    if query_embedding is None:
+        query_embedding, web_info = await asyncio.gather(get_embedding(embed_client, message), web_task)
+    else:
+        web_info = await web_task
+    if web_info:
+        cache_key = None   # 带 web 信息的回答有时效性，不写入语义缓存
 
     # 近期消息中最旧的 ID，历史检索排除这些消息（避免重复）
     oldest_recent_id = context[0]["id"] if context else None
@@ -196,78 +486,138 @@ async def chat(background_tasks: BackgroundTasks,
     history_embedding = await get_embedding(embed_client, recall_query) if is_recall else query_embedding
     history_threshold = 0.55 if is_recall else 0.4
 
-    if use_full_context:
-        # 小语料：全量加载所有 chunk，按文档分组带文件头
-        all_chunks, history_results = await asyncio.gather(
-            get_all_session_chunks(session_id),
-            query_history(history_embedding, session_id=session_id,
-                          before_id=oldest_recent_id, threshold=history_threshold),
+    # 近期对话（最新在前，预算不足时先丢最旧的）与 web 信息的 token 计数与检索同时发出（一次批量调用）
+    context_lines = [f"{c['role']}: {c['content']}" for c in reversed(context)]
+    web_items = [web_info] if web_info else []
+    counted_texts = [*context_lines, *web_items]
+    counting = start_counting(counted_texts)
+
+    # 小语料且规模值得缓存：全部文档放进 Gemini cached content（按 (会话, 语料版本) 复用），本轮只发上下文与问题。
+    # 创建缓存涉及 Gemini 调用，放在固定连接之外
+    context_cache = None
+    if use_full_context and settings.context_cache_enabled and session_tokens >= settings.context_cache_min_tokens:
+        context_cache = await get_context_cache(
+            session_id, pre["corpus_version"], persona,
+            lambda: _full_corpus_section(session_id, pre["corpus_version"]),
         )
-        by_file: dict[str, list[str]] = {}
-        for c in all_chunks:
-            by_file.setdefault(c["source_file"], []).append(c["content"])
-        rag_text = "\n\n".join(
-            f"=== 文件：{src} ===\n" + "\n".join(parts)
-            for src, parts in by_file.items()
-        )
-        rag_citations = [
-            {"source": src, "chunk": None, "score": 1.0, "snippet": ""}
-            for src in by_file
-        ]
-        has_kb = bool(by_file)
+
+    # 检索阶段同样固定一条连接；gather 的并发分支拿不到时自动退回连接池
+    async with request_connection():
+        if context_cache is not None:
+            history_results = await query_history(history_embedding, session_id=session_id,
+                                                  before_id=oldest_recent_id, threshold=history_threshold)
+            rag_text, rag_citations, corpus_tokens = "", context_cache["citations"], 0
+            has_kb = True
+        elif use_full_context:
+            # 小语料：全部文档按文件分组带文件头（按语料版本缓存拼接结果）
+            (rag_text, rag_citations, corpus_tokens), history_results = await asyncio.gather(
+                get_session_corpus(session_id, pre["corpus_version"]),
+                query_history(history_embedding, session_id=session_id,
+                              before_id=oldest_recent_id, threshold=history_threshold),
+            )
+            has_kb = bool(rag_citations)
+        else:
+            # 大语料 / 空知识库：走 RAG 检索
+            rag_results, history_results = await asyncio.gather(
+                query_rag(query_embedding, session_id=session_id, source_files=source_list,
+                          query_text=message),
+                query_history(history_embedding, session_id=session_id,
+                              before_id=oldest_recent_id, threshold=history_threshold),
+            )
+            rag_text = "\n".join([r["content"] for r in rag_results])
+            rag_citations = [
+                {
+                    "source": r["source_file"],
+                    "chunk": r["chunk_index"],
+                    "score": round(1 - r["distance"], 3),
+                    "snippet": (r.get("original_content") or "")[:200].strip(),
+                }
+                for r in rag_results
+            ]
+            has_kb = bool(rag_results)
+
+    # ── 按 token 预算规划各段：近期对话 / 历史摘录 / 文档 / web，超出按优先级裁剪 ──
+    history_lines = [_history_line(r) for r in history_results]
+    history_counts = [estimate_tokens(line) for line in history_lines]
+    counts = await settle_counts(counting, counted_texts)
+    context_counts = counts[:len(context_lines)]
+    web_counts = counts[len(context_lines):]
+    # persona、指令与问题体量小，本地估算
+    fixed_frame = (f"{summary_section}Context:\n{_HISTORY_HEADER}{_RAG_HEADER}{_WEB_HEADER}{_CITE_INSTRUCTION}"
+                   f"User: {message}\nAI:")
+    if context_cache is not None:
+        doc_items = []   # 文档全文已在 cached content 中，计入固定部分
+    elif use_full_context and has_kb:
+        doc_items = [(rag_text, corpus_tokens)]
     else:
-        # 大语料 / 空知识库：走 RAG 检索
-        rag_results, history_results = await asyncio.gather(
-            query_rag(query_embedding, session_id=session_id, source_files=source_list),
-            query_history(history_embedding, session_id=session_id,
-                          before_id=oldest_recent_id, threshold=history_threshold),
-        )
-        rag_text = "\n".join([r["content"] for r in rag_results])
-        rag_citations = [
-            {
-                "source": r["source_file"],
-                "chunk": r["chunk_index"],
-                "score": round(1 - r["distance"], 3),
-                "snippet": (r.get("original_content") or "")[:200].strip(),
-            }
-            for r in rag_results
-        ]
-        has_kb = bool(rag_results)
-
-    # 构建提示词 prompt
-    if use_full_context and has_kb:
-        rag_section = f"All uploaded documents in this session (full content):\n{rag_text}\n\n"
+        doc_items = [(r["content"], chunk_tokens(r)) for r in rag_results] if has_kb else []
+    sections = [
+        Section("history", list(zip(context_lines, context_counts))),
+        Section("recall", list(zip(history_lines, history_counts))),
+        Section("docs", doc_items, truncatable=use_full_context),
+        Section("web", list(zip(web_items, web_counts)), truncatable=True),
+    ]
+    fixed_tokens = (estimate_tokens(persona or "") + estimate_tokens(fixed_frame)
+                    + (context_cache["token_count"] if context_cache else 0))
+    prompt_budget = plan_prompt(sections, fixed_tokens)
+    history_sec, recall_sec, docs_sec, web_sec = sections
+    if prompt_budget["trimmed"]:
+        logger.info("/chat session=%s prompt 超出预算裁剪: %s", session_id, prompt_budget["sections"])
+
+    context_text = "\n".join(reversed(history_sec.kept))
+    if context_cache is not None:
+        rag_section = ""   # 文档全文已在 cached content 中
+    elif use_full_context and has_kb:
+        rag_text = docs_sec.kept[0] if docs_sec.kept else ""
+        if docs_sec.truncated:
+            rag_citations = [c for c in rag_citations if f"=== 文件：{c['source']} ===" in rag_text]
+        rag_section = f"{_FULL_CONTEXT_HEADER}{rag_text}\n\n"
     elif has_kb:
-        rag_section = f"Relevant info from uploaded documents:\n{rag_text}\n\n"
+        rag_text = "\n".join(docs_sec.kept)
+        rag_citations = rag_citations[:len(docs_sec.kept)]
+        rag_section = f"{_RAG_HEADER}{rag_text}\n\n"
     else:
-        rag_section = "Relevant info from uploaded documents:\n（当前问题在知识库中未找到相关文档内容）\n\n"
-    web_section = f"Latest info from web:\n{web_info}\n\n" if web_info else ""
-    if history_results:
-        history_items = "\n".join([
-            f"[{r['created_at'].strftime('%Y-%m-%d') if hasattr(r['created_at'], 'strftime') else str(r['created_at'])[:10]}] "
-            f"{r['snippet']}{'…' if len(r['content']) > 300 else ''}"
-            for r in history_results
-        ])
-        history_section = f"Relevant excerpts from past conversation in this session:\n{history_items}\n\n"
+        rag_section = f"{_RAG_HEADER}（当前问题在知识库中未找到相关文档内容）\n\n"
+    web_section = f"{_WEB_HEADER}{web_sec.kept[0]}\n\n" if web_sec.kept else ""
+    if recall_sec.kept:
+        history_items = "\n".join(recall_sec.kept)
+        history_section = f"{_HISTORY_HEADER}{history_items}\n\n"
     else:
         history_section = ""
     prompt = (
+        f"{summary_section}"
         f"Context:\n{context_text}\n\n"
         f"{history_section}"
         f"{rag_section}"
         f"{web_section}"
-        f"如果回答引用了上传文档的原文或观点，请在该句末尾用括号标注来源，格式为（来源：文件名，第N段）。直接引用原文时请加引号。\n"
+        f"{_CITE_INSTRUCTION}"
         f"User: {message}\nAI:"
     )
     # print('prompt: ', prompt)
 
-    # 设置前置的Grounding with Google Search
-    grounding_tool = types.Tool(google_search=types.GoogleSearch())
-    persona = await get_session_persona(session_id)
-    config = types.GenerateContentConfig(
-        tools=[grounding_tool],
-        system_instruction=persona if persona else None,
-    )
+    # 设置前置的Grounding with Google Search（使用上下文缓存时 persona 与工具已在 cached content 中）
+    if context_cache is not None:
+        config = types.GenerateContentConfig(cached_content=context_cache["cache_name"])
+    else:
+        grounding_tool = types.Tool(google_search=types.GoogleSearch())
+        config = types.GenerateContentConfig(
+            tools=[grounding_tool],
+            system_instruction=persona if persona else None,
+        )
+    _route = "full_context" if use_full_context else ("rag" if has_kb else "empty_kb")
+
+    # 流式模式：首个分块即可下发，落库 / trace / embedding 推迟到流结束
+    if _wants_event_stream(request):
+        return StreamingResponse(
+            _stream_answer(
+                background_tasks, prompt=prompt, config=config,
+                session_id=session_id, user_id=user["id"], message=message,
+                route=_route, citations=rag_citations, chat_t0=_chat_t0,
+                cache_key=cache_key, prompt_budget=prompt_budget,
+            ),
+            media_type="text/event-stream",
+            headers=_SSE_HEADERS,
+        )
 
     # 调用 Gemini 生成回答
     chat = client.aio.chats.create(model=settings.generation_model, config=config)
@@ -277,34 +627,23 @@ async def chat(background_tasks: BackgroundTasks,
         logger.exception("Gemini API 调用失败: %s", e)
         raise HTTPException(status_code=502, detail="AI 服务暂时不可用，请稍后重试")
     answer = resp.text
-    usage = resp.usage_metadata
-    tokens_in  = getattr(usage, "prompt_token_count",     0) or 0
-    tokens_out = getattr(usage, "candidates_token_count", 0) or 0
-    tokens_total = getattr(usage, "total_token_count",    0) or 0
+    if _web_grounded(resp):
+        cache_key = None
+    tokens_in, tokens_out, tokens_total, tokens_cached = _usage_tokens(resp.usage_metadata)
     msg_id = await save_message(session_id, "assistant", answer,
                                 tokens_in=tokens_in, tokens_out=tokens_out, tokens_total=tokens_total)
 
-    # 后台异步为该条消息计算并存储 embedding，供历史检索使用
-    async def _save_embedding():
-        try:
-            emb = await get_embedding(embed_client, answer[:2000])
-            await update_message_embedding(msg_id, emb)
-        except Exception as e:
-            logger.warning("历史消息 embedding 存储失败 (id=%s): %s", msg_id, e)
-
-    background_tasks.add_task(_save_embedding)
-
-    # Phase 3a — 落盘 trace（异步，不阻塞响应）
-    _route = "full_context" if use_full_context else ("rag" if has_kb else "empty_kb")
-    background_tasks.add_task(
-        record_trace,
-        session_id=session_id, user_id=user["id"], message_id=msg_id,
+    # embedding 回写 + Phase 3a trace 落盘（异步，不阻塞响应）
+    _schedule_post_answer(
+        background_tasks, msg_id=msg_id, answer=answer, cache_key=cache_key,
+        session_id=session_id, user_id=user["id"],
         query=message, route=_route,
         tools_called=[], iterations=1,
         citations=rag_citations,
-        tokens_in=tokens_in, tokens_out=tokens_out,
+        tokens_in=tokens_in, tokens_out=tokens_out, tokens_cached=tokens_cached,
         duration_ms=int((time.monotonic() - _chat_t0) * 1000),
         prompt_version_id=None,
+        prompt_budget=prompt_budget,
     )
 
     return JSONResponse({"answer": answer, "citations": rag_citations})
@@ -337,7 +676,10 @@ async def change_session(session_id: str = Form(...), name: str = Form(...), use
 async def del_session(session_id: str = Form(...), user=Depends(get_current_user)):
     query = "DELETE FROM sessions WHERE id = :id AND user_id = :user_id"
     try:
+        if await session_owned_by(session_id, user["id"]):
+            await drop_context_cache(session_id)
         await database.execute(query, values={"id": session_id, "user_id": user["id"]})
+        session_vector_cache.invalidate(session_id)
         return {"id": session_id, "success": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -389,6 +731,7 @@ async def set_persona(background_tasks: BackgroundTasks,
     async def _extract():
         processed = await _process_persona(raw) if raw else ""
         await update_session_instruction(session_id, processed)
+        await drop_context_cache(session_id)   # persona 在 cached content 中
     background_tasks.add_task(_extract)
     return JSONResponse({"success": True})
 
@@ -401,7 +744,7 @@ async def save_to_rag(
 ):
     if not await session_exists(session_id):
         raise HTTPException(status_code=403, detail="仅命名会话可保存到知识库")
-    embedding = await get_embedding(embed_client, content)
+    embedding = await get_embedding(embed_client, content, cache=False)
     await add_knowledge(content, embedding, session_id, source_file="对话摘要")
     return JSONResponse({"success": True})
 
@@ -414,7 +757,8 @@ async def new_null_session(session_id: str, user_id: int):
 
 @app.get("/sessions")
 async def get_sessions(user=Depends(get_current_user)):
-    query = "SELECT id, name FROM sessions WHERE user_id = :uid AND name IS NOT NULL ORDER BY created_at DESC"
+    query = ("SELECT id, name FROM sessions WHERE user_id = :uid AND name IS NOT NULL AND NOT is_library "
+             "ORDER BY created_at DESC")
     rows = await database.fetch_all(query, values={"uid": user["id"]})
     return [{"id": r["id"], "name": r["name"]} for r in rows]
 
@@ -0,0 +1,50 @@
+from fastapi import APIRouter, Depends, HTTPException, Form
+from fastapi.responses import JSONResponse
+from account import get_current_user
+from backend.context_cache import drop_context_cache
+from backend.db import (
+    session_owned_by, is_library_session, get_or_create_library, get_file_status, get_file_statuses,
+    attach_library_file, detach_library_file, get_session_library_files,
+)
+
+# 用户文档库：文档上传到文档库会话（POST /upload/，session_id 取 GET /library/ 返回的 id）只入库一次，
+# 各会话按引用挂载，检索时与会话自身知识库合并
+router = APIRouter()
+
+
+@router.get("/")
+async def get_library(user=Depends(get_current_user)):
+    library_id = await get_or_create_library(user["id"])
+    return JSONResponse({"id": library_id, "files": await get_file_statuses(library_id)})
+
+
+@router.get("/attached/{session_id}")
+async def get_attached(session_id: str, user=Depends(get_current_user)):
+    if not await session_owned_by(session_id, user["id"]):
+        raise HTTPException(status_code=403, detail="无权访问该会话")
+    return JSONResponse(await get_session_library_files(session_id))
+
+
+@router.post("/attach")
+async def attach(session_id: str = Form(...), filename: str = Form(...), user=Depends(get_current_user)):
+    if not await session_owned_by(session_id, user["id"]):
+        raise HTTPException(status_code=403, detail="无权访问该会话")
+    if await is_library_session(session_id):
+        raise HTTPException(status_code=400, detail="文档库不能挂载到自身")
+    library_id = await get_or_create_library(user["id"])
+    if await get_file_status(library_id, filename) is None:
+        raise HTTPException(status_code=404, detail="文档库中不存在该文件")
+    if await get_file_status(session_id, filename) is not None:
+        raise HTTPException(status_code=409, detail="会话内已有同名文件")
+    await attach_library_file(session_id, library_id, filename)
+    await drop_context_cache(session_id)
+    return JSONResponse({"success": True})
+
+
+@router.post("/detach")
+async def detach(session_id: str = Form(...), filename: str = Form(...), user=Depends(get_current_user)):
+    if not await session_owned_by(session_id, user["id"]):
+        raise HTTPException(status_code=403, detail="无权访问该会话")
+    await detach_library_file(session_id, filename)
+    await drop_context_cache(session_id)
+    return JSONResponse({"success": True})
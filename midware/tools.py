@@ -1,16 +1,19 @@
 import asyncio
 import aiohttp
+import hashlib
 import os
 import io
 import re
 import tempfile
+import time
+import unicodedata
 from pathlib import Path
 from fastapi import UploadFile, HTTPException
 from docx import Document
 import pdfplumber
 import docx2txt
 from settings import settings, logger
-from typing import List
+from typing import Awaitable, Callable, List
 
 
 # ── PDF OCR 标题检测（参考 PDFconvert）────────────────────────
@@ -48,50 +51,186 @@ def _text_to_markdown(text: str) -> str:
     return "\n\n".join(md)
 
 
-def _pdf_to_markdown_sync(pdf_path: Path) -> str:
+# ── 并行 OCR ─────────────────────────────────────────────────
+_OCR_DPI = 150
+_OCR_LANG = "chi_sim+eng"
+# 每个 OCR 任务渲染的最大连续页数：一次 pdftoppm 渲染整段，省去逐页启动进程与重复打开 PDF
+_OCR_RANGE_PAGES = 4
+
+
+def _ocr_range(pdf_path: str, first: int, last: int) -> dict[int, str]:
+    """
+    在 OCR 线程内一次渲染连续页 first..last 并逐页 OCR，返回 {页码: 文本}。
+    单页 tesseract 失败记为空文本，不影响同段其它页；渲染失败由调用方按整段失败处理。
     """
-    同步 PDF → Markdown 转换。
-    优先用 pdfplumber 直接提取文字（速度快、省内存）；
-    若提取内容不足（扫描版 PDF），降级为逐页 OCR（150 DPI）。
+    from pdf2image import convert_from_path
+    import pytesseract
+    images = convert_from_path(pdf_path, dpi=_OCR_DPI, first_page=first, last_page=last)
+    texts: dict[int, str] = {}
+    for page_no, img in enumerate(images, start=first):
+        try:
+            texts[page_no] = pytesseract.image_to_string(img, lang=_OCR_LANG)
+        except Exception:
+            texts[page_no] = ""
+        finally:
+            img.close()
+    return texts
+
+
+def _page_ranges(page_numbers: list[int], size: int) -> list[tuple[int, int]]:
+    """把升序页码切成连续段，每段不超过 size 页。"""
+    ranges: list[tuple[int, int]] = []
+    for page_no in page_numbers:
+        if ranges and page_no == ranges[-1][1] + 1 and page_no - ranges[-1][0] < size:
+            ranges[-1] = (ranges[-1][0], page_no)
+        else:
+            ranges.append((page_no, page_no))
+    return ranges
+
+
+def _ocr_pages_parallel(pdf_path: Path, page_numbers: list[int],
+                        on_progress: Callable[[int, int], None] | None = None) -> dict[int, str]:
+    """
+    多核并行 OCR 指定页面（页码从 1 开始），返回 {页码: 文本}。
+    用线程池：pdftoppm / tesseract 都是外部进程，线程只负责等待，同样能跑满多核；
+    不在多线程的 web / worker 进程里 fork 进程池（fork 时持有的线程锁 / 事件循环锁会让子进程死锁）。
+    连续页按段（≤ _OCR_RANGE_PAGES 页，页数少时缩小段长以占满 workers）提交，每段只启动一次 pdftoppm；
+    滑动窗口：同时在途的段数不超过 2 × workers，同一时刻最多 workers 段的渲染图在内存中。
+    OCR 失败（pdftoppm / tesseract / 语言包缺失等）的页记为空文本，由调用方保留该页文字层。
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    total = len(page_numbers)
+    if not total:
+        return {}
+    workers = settings.ocr_workers or os.cpu_count() or 1
+    workers = max(1, min(workers, total))
+    window = workers * 2
+    size = max(1, min(_OCR_RANGE_PAGES, -(-total // workers)))
+    results: dict[int, str] = {}
+    failed = 0
+    pending = iter(_page_ranges(sorted(page_numbers), size))
+    logger.info("OCR 开始: %s (%d 页, %d workers)", pdf_path.name, total, workers)
+    # 多段并行时限制 tesseract 自身的 OpenMP 线程（由子进程继承），避免核数超订反而变慢
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr") as pool:
+        in_flight: dict = {}
+        exhausted = False
+        while not exhausted or in_flight:
+            while not exhausted and len(in_flight) < window:
+                page_range = next(pending, None)
+                if page_range is None:
+                    exhausted = True
+                    break
+                in_flight[pool.submit(_ocr_range, str(pdf_path), *page_range)] = page_range
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                first, last = in_flight.pop(fut)
+                try:
+                    texts = fut.result()
+                except Exception as e:
+                    if not failed:
+                        logger.warning("OCR 失败，保留文字层: %s 第 %d-%d 页 — %s", pdf_path.name, first, last, e)
+                    texts = {}
+                for page_no in range(first, last + 1):
+                    text = texts.get(page_no, "")
+                    failed += not text
+                    results[page_no] = text
+                if on_progress:
+                    on_progress(len(results), total)
+    if failed:
+        logger.warning("OCR 完成: %s 共 %d/%d 页失败或无文字", pdf_path.name, failed, total)
+    return results
+
+
+# 单页文字层不足此字符数则视为疑似扫描页，送 OCR（空白页 / 标题页 / 插图页同样会被送去，
+# 因此 OCR 结果只在比文字层更长时采用，OCR 失败或不可用时保留文字层）
+_MIN_PAGE_TEXT_CHARS = 50
+
+
+def _pdf_to_markdown_sync(pdf_path: Path,
+                          on_progress: Callable[[int, int], None] | None = None) -> tuple[str, dict]:
+    """
+    同步 PDF → Markdown 转换，逐页决定提取方式：
+      • 文字层充足的页直接用 pdfplumber 文本（快、省内存）
+      • 文字层不足的页（疑似扫描页）多核并行 OCR（150 DPI），取 OCR 文本与文字层中较长者；
+        OCR 依赖缺失或单页失败时保留文字层，只有整份文档都没有文字层时才报错
+    混合 PDF（如正文为排版文字、附录为扫描件）只对扫描页 OCR。
+    on_progress(done, total) 在每个 OCR 页完成后回调（在调用线程中执行），total 为需 OCR 的页数。
+    返回 (markdown, stats)，stats 含各方式页数与耗时，写入 upload_files.parse_stats。
     在线程池中调用，避免阻塞事件循环。
     """
-    # ── 尝试 pdfplumber 直接提取文字 ──────────────────────────────
+    t0 = time.monotonic()
+    # ── pdfplumber 逐页提取文字层 ─────────────────────────────────
     try:
         with pdfplumber.open(str(pdf_path)) as pdf:
-            pages_text = [p.extract_text() or "" for p in pdf.pages]
-        full_text = "\n".join(pages_text).replace('\x00', '').strip()
-        avg_chars = len(full_text) / max(len(pages_text), 1)
-        if avg_chars >= 50:   # 每页至少 50 字符，认为是文字型 PDF
-            logger.info("PDF 文字提取成功（均 %.0f 字/页）: %s", avg_chars, pdf_path.name)
-            return _text_to_markdown(full_text)
-        logger.info("PDF 文字提取内容不足（均 %.0f 字/页），改用 OCR: %s", avg_chars, pdf_path.name)
+            pages_text = [(p.extract_text() or "").replace('\x00', '') for p in pdf.pages]
     except Exception as e:
-        logger.warning("pdfplumber 提取失败，改用 OCR: %s — %s", pdf_path.name, e)
-
-    # ── 降级：逐页 OCR，150 DPI，避免全量加载占用过多内存 ────────
-    try:
-        from pdf2image import convert_from_path
-        import pytesseract
-    except ImportError as e:
-        raise RuntimeError(
-            f"PDF OCR 依赖未安装: {e}。请运行: pip install pdf2image pytesseract"
-        ) from e
+        logger.warning("pdfplumber 提取失败，全部页改用 OCR: %s — %s", pdf_path.name, e)
+        from pdf2image import pdfinfo_from_path
+        pages_text = [""] * int(pdfinfo_from_path(str(pdf_path))["Pages"])
+
+    ocr_pages = [i + 1 for i, t in enumerate(pages_text) if len(t.strip()) < _MIN_PAGE_TEXT_CHARS]
+    stats = {
+        "pages": len(pages_text),
+        "text_pages": len(pages_text) - len(ocr_pages),
+        "ocr_pages": len(ocr_pages),
+        "ocr_seconds": 0.0,
+        "ocr_used_pages": 0,
+    }
 
-    with pdfplumber.open(str(pdf_path)) as pdf:
-        page_count = len(pdf.pages)
+    # ── 扫描页：并行 OCR ─────────────────────────────────────────
+    if ocr_pages:
+        try:
+            import pdf2image  # noqa: F401
+            import pytesseract  # noqa: F401
+            ocr_available = True
+        except ImportError as e:
+            if not any(t.strip() for t in pages_text):
+                raise RuntimeError(
+                    f"PDF OCR 依赖未安装: {e}。请运行: pip install pdf2image pytesseract"
+                ) from e
+            logger.warning("PDF OCR 依赖未安装，%d 页保留文字层: %s — %s", len(ocr_pages), pdf_path.name, e)
+            ocr_available = False
+        if ocr_available:
+            ocr_t0 = time.monotonic()
+            for page_no, text in _ocr_pages_parallel(pdf_path, ocr_pages, on_progress).items():
+                if len(text.strip()) > len(pages_text[page_no - 1].strip()):
+                    pages_text[page_no - 1] = text
+                    stats["ocr_used_pages"] += 1
+            stats["ocr_seconds"] = round(time.monotonic() - ocr_t0, 1)
+
+    stats["parse_seconds"] = round(time.monotonic() - t0, 1)
+    logger.info("PDF 提取完成: %s — 文字层 %d 页，OCR %d 页（OCR 耗时 %.1fs，总 %.1fs）",
+                pdf_path.name, stats["text_pages"], stats["ocr_pages"],
+                stats["ocr_seconds"], stats["parse_seconds"])
+    return _text_to_markdown("\n".join(pages_text).strip()), stats
+
+
+async def pdf_to_markdown(pdf_path: Path,
+                          on_progress: Callable[[int, int], Awaitable[None]] | None = None) -> tuple[str, dict]:
+    """
+    异步包装：在线程池中执行 PDF → Markdown 转换，返回 (Markdown 文本, 解析统计)。
+    on_progress 为异步回调 (done_pages, total_ocr_pages)，节流为每秒最多一次（最后一页必定回调）。
+    """
+    if on_progress is None:
+        return await asyncio.to_thread(_pdf_to_markdown_sync, pdf_path)
 
-    text = ""
-    for i in range(1, page_count + 1):
-        images = convert_from_path(str(pdf_path), dpi=150, first_page=i, last_page=i)
-        for img in images:
-            text += pytesseract.image_to_string(img, lang="chi_sim+eng") + "\n"
-        del images  # 释放当页图片内存
-    return _text_to_markdown(text)
+    loop = asyncio.get_running_loop()
+    last_report = 0.0
 
+    def _report(done: int, total: int) -> None:
+        nonlocal last_report
+        now = time.monotonic()
+        if done < total and now - last_report < 1.0:
+            return
+        last_report = now
+        asyncio.run_coroutine_threadsafe(on_progress(done, total), loop)
 
-async def pdf_to_markdown(pdf_path: Path) -> str:
-    """异步包装：在线程池中执行 PDF OCR 转换，返回 Markdown 文本。"""
-    return await asyncio.to_thread(_pdf_to_markdown_sync, pdf_path)
+    return await asyncio.to_thread(_pdf_to_markdown_sync, pdf_path, _report)
 
 
 def _epub_to_markdown_sync(epub_path: Path) -> str:
@@ -288,6 +427,26 @@ def enrich_chunks_with_context(doc_text: str, filename: str, chunks: List[str])
     return enriched
 
 
+def chunk_hash(text: str) -> str:
+    """
+    原始 chunk（不含上下文头）的内容哈希，用于复用已有 embedding：NFKC 规范化 + 折叠空白后，
+    连同 embedding 模型与维度取 SHA-256。同一段落出现在改名文件或其它文档中也能命中；
+    换模型 / 维度后旧向量不再复用。
+    """
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    key = f"{settings.embedding_model}\x1f{settings.embedding_dim}\x1f{normalized}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def file_sha256(path: Path, block_size: int = 1 << 20) -> str:
+    """按块读取文件计算 SHA-256（同步，放线程池调用）。"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
 # ── 旧版接口（保留兼容性）────────────────────────────────────
 
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
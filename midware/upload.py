@@ -1,15 +1,31 @@
 import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import time
 from fastapi import APIRouter, Depends, HTTPException, Form
 from fastapi import UploadFile, File, BackgroundTasks
 from fastapi.responses import JSONResponse
 from pathlib import Path
 from settings import settings, embed_client, logger
 from account import get_current_user
-from backend.db import session_exists, session_owned_by, save_file, add_knowledge_batch, update_file_status, get_file_statuses
-from backend.rag import get_embeddings_batch
+from backend.db import (
+    session_exists, session_owned_by, save_file, add_knowledge_batch, update_file_status,
+    get_file_statuses, get_ingest_checkpoint, delete_file_knowledge, update_file_pages,
+    update_file_parse_stats, find_session_file_by_hash, find_ingested_file_by_hash,
+    set_file_content_hash, copy_file_knowledge, get_embeddings_by_hash,
+    is_library_session, find_library_file_by_hash, attach_library_file, get_file_status,
+    is_library_file_attached,
+)
+from backend.rag import iter_embedding_batches
+from backend.prompt_budget import count_chunk_tokens
+from backend.vector_cache import session_vector_cache
+from backend.context_cache import drop_context_cache
 from midware.tools import (
     parse_document, split_into_paragraphs, group_paragraphs,
     enrich_chunks_with_context, pdf_to_markdown, epub_to_markdown, split_markdown_chunks,
+    chunk_hash, file_sha256,
 )
 
 router = APIRouter()
@@ -32,24 +48,42 @@ async def upload_file(
     file_path: Path = upload_dir / Path(file.filename).name
     if file_path.exists():
         return JSONResponse({"status": "success", "message": f"{file.filename} 已存在，无需重复上传"})
+    if await is_library_file_attached(session_id, file_path.name):
+        raise HTTPException(status_code=409, detail=f"会话已挂载文档库中的同名文件 {file_path.name}，请先取消挂载或改名后上传")
 
-    # 异步读取文件内容
-    content = await file.read()
-
-    # 检查文件大小限制（0 表示不限制）
+    # 流式落盘：边读边校验大小 / 计算哈希，内存占用与文件大小无关
     max_mb = user["max_file_size_mb"] if user["max_file_size_mb"] is not None else 10
-    if max_mb > 0 and len(content) > max_mb * 1024 * 1024:
-        size_mb = round(len(content) / 1024 / 1024, 1)
+    tmp_path, size, content_hash = await _stream_to_temp(file, upload_dir, max_mb * 1024 * 1024 if max_mb > 0 else 0)
+    if tmp_path is None:
         raise HTTPException(
             status_code=413,
-            detail=f"文件大小 {size_mb}MB 超过上限 {max_mb}MB"
+            detail=f"文件大小超过上限 {max_mb}MB"
         )
 
-    await asyncio.to_thread(file_path.write_bytes, content)
+    try:
+        # 同一会话内内容相同（仅文件名不同）的文件不重复入库
+        same = await find_session_file_by_hash(session_id, content_hash)
+        if same:
+            return JSONResponse({"status": "success", "message": f"{file.filename} 与已上传的 {same} 内容相同，无需重复上传"})
+        # 文档库中已有相同内容的文件：按引用挂载到会话，不再落盘 / 入库
+        in_library = None
+        if not await is_library_session(session_id):
+            in_library = await find_library_file_by_hash(user["id"], content_hash)
+        if in_library and await get_file_status(session_id, in_library[1]) is None:
+            library_id, library_file = in_library
+            await attach_library_file(session_id, library_id, library_file)
+            await drop_context_cache(session_id)
+            return JSONResponse({"status": "success",
+                                 "message": f"{file.filename} 与文档库中的 {library_file} 内容相同，已直接挂载到当前会话"})
+        # 同目录原子重命名：其他请求 / worker 只会看到完整文件
+        await asyncio.to_thread(os.replace, tmp_path, file_path)
+    finally:
+        await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
+    logger.info("上传完成: %s (%.1fMB)", file_path.name, size / 1024 / 1024)
 
     relative_file_path: Path = Path("static") / "loads" / user["username"] / session_id / file.filename
-    await save_file(session_id, file.filename, str(relative_file_path))
-    background_tasks.add_task(process_file_and_insert, file_path, session_id)
+    await save_file(session_id, file.filename, str(relative_file_path), content_hash=content_hash)
+    await schedule_ingest(background_tasks, session_id, file.filename, str(relative_file_path))
     return JSONResponse({
         "status": "success",
         "message": f"{file.filename} 上传成功，后台解析中，请稍后查看状态",
@@ -58,56 +92,206 @@ async def upload_file(
     })
 
 
-async def process_file_and_insert(file_path: Path, session_id: str):
+_UPLOAD_BLOCK_SIZE = 1 << 20   # 1MB
+
+
+async def _stream_to_temp(file: UploadFile, upload_dir: Path, max_bytes: int) -> tuple[Path | None, int, str]:
+    """
+    按块把上传内容写入 upload_dir 下的临时文件，同时累计大小、计算 SHA-256。
+    超过 max_bytes（0 = 不限）时立即停止读取并删除临时文件，返回 (None, 已读字节, "")；
+    成功返回 (临时文件路径, 总字节数, 十六进制哈希)，由调用方 rename 或删除。
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=upload_dir, prefix=".upload-", suffix=".part")
+    tmp_path = Path(tmp_name)
+    h = hashlib.sha256()
+    size = 0
     try:
-        await update_file_status(session_id, file_path.name, 'processing')
+        with os.fdopen(fd, "wb") as out:
+            while block := await file.read(_UPLOAD_BLOCK_SIZE):
+                size += len(block)
+                if max_bytes and size > max_bytes:
+                    out.close()
+                    tmp_path.unlink(missing_ok=True)
+                    return None, size, ""
+                h.update(block)
+                await asyncio.to_thread(out.write, block)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path, size, h.hexdigest()
+
 
-        suffix = file_path.suffix.lower()
+async def _parse_and_chunk(file_path: Path, session_id: str,
+                           reuse_markdown: bool = False) -> tuple[str, list, dict]:
+    """
+    解析文件并分块，返回 (全文, raw_chunks, 解析统计)。
+    reuse_markdown=True 时优先复用已生成的 .md（续传免重复 OCR）。
+    """
+    suffix = file_path.suffix.lower()
+    t0 = time.monotonic()
 
-        if suffix == '.pdf':
+    if suffix in ('.pdf', '.epub'):
+        md_path = file_path.with_suffix('.md')
+        if reuse_markdown and md_path.exists():
+            md_text = await asyncio.to_thread(md_path.read_text, 'utf-8')
+            stats = {"method": "markdown_cache"}
+            logger.info("复用已转换的 Markdown: %s (%d 字)", md_path.name, len(md_text))
+        elif suffix == '.pdf':
             logger.info("PDF 解析开始: %s", file_path.name)
-            md_text = await pdf_to_markdown(file_path)
-            md_path = file_path.with_suffix('.md')
+
+            async def _on_ocr_page(done: int, total: int):
+                await update_file_pages(session_id, file_path.name, total, done)
+
+            md_text, stats = await pdf_to_markdown(file_path, on_progress=_on_ocr_page)
+            stats["method"] = "pdf"
             await asyncio.to_thread(md_path.write_text, md_text, 'utf-8')
             logger.info("PDF 文本提取完成: %s (%d 字)", file_path.name, len(md_text))
-            raw_chunks = split_markdown_chunks(md_text)
-            text = md_text
-        elif suffix == '.epub':
+        else:
             logger.info("EPUB 解析开始: %s", file_path.name)
             md_text = await epub_to_markdown(file_path)
-            md_path = file_path.with_suffix('.md')
+            stats = {"method": "epub"}
             await asyncio.to_thread(md_path.write_text, md_text, 'utf-8')
             logger.info("EPUB 解析完成: %s (%d 字)", file_path.name, len(md_text))
-            raw_chunks = split_markdown_chunks(md_text)
-            text = md_text
-        else:
-            text = await parse_document(file_path)
-            raw_chunks = group_paragraphs(split_into_paragraphs(text))
-            logger.info("文档解析完成: %s (%d 字)", file_path.name, len(text))
+        stats["parse_seconds"] = round(time.monotonic() - t0, 1)
+        return md_text, split_markdown_chunks(md_text), stats
+
+    text = await parse_document(file_path)
+    logger.info("文档解析完成: %s (%d 字)", file_path.name, len(text))
+    stats = {"method": suffix.lstrip('.'), "parse_seconds": round(time.monotonic() - t0, 1)}
+    return text, group_paragraphs(split_into_paragraphs(text)), stats
+
+
+async def ingest_file(file_path: Path, session_id: str, force: bool = False):
+    """
+    解析 → 分块 → 逐批 embedding + 入库，出错直接抛出（由调用方决定标记失败或重试）。
+    每批 chunk 与 processed_chunks 在同一事务提交；若该文件已有部分 chunk 入库（上次中途失败），
+    从已提交的下一个 chunk_index 续传，不重复调用 embedding。
+    force=True（用户显式重新处理）：不从同内容文件复制 chunk，也不按 chunk 哈希复用已有向量，全部重新解析与 embedding。
+    """
+    filename = file_path.name
+    await update_file_status(session_id, filename, 'processing')
+
+    # 同内容文件已在别处入库完成：直接复制 chunk 行，跳过解析 / OCR / embedding
+    content_hash = await asyncio.to_thread(file_sha256, file_path)
+    await set_file_content_hash(session_id, filename, content_hash)
+    source = None if force else await find_ingested_file_by_hash(content_hash, session_id, filename)
+    if source:
+        await _ingest_from_copy(file_path, session_id, source)
+        return
+
+    committed, prev_total = await get_ingest_checkpoint(session_id, filename)
+    text, raw_chunks, stats = await _parse_and_chunk(file_path, session_id, reuse_markdown=committed > 0)
+    total = len(raw_chunks)
+    logger.info("分块完成: %s (%d chunks)", filename, total)
+    await update_file_parse_stats(session_id, filename, stats)
+
+    if committed and (committed > total or (prev_total and prev_total != total)):
+        # 分块结果与上次不一致（解析器 / 源文件变化），断点不可信，整体重建
+        logger.warning("分块数变化 (%d → %d)，丢弃已入库的 %d 个 chunk 重建: %s",
+                       prev_total, total, committed, filename)
+        await delete_file_knowledge(session_id, filename)
+        committed = 0
+    elif committed:
+        logger.info("断点续传: %s 从第 %d/%d 个 chunk 继续", filename, committed, total)
 
-        logger.info("分块完成: %s (%d chunks)", file_path.name, len(raw_chunks))
-        await update_file_status(session_id, file_path.name, 'processing', total=len(raw_chunks))
+    await update_file_status(session_id, filename, 'processing', total=total, processed=committed)
 
-        # 上下文增强（本地操作，无 API 调用）
-        enriched_chunks = enrich_chunks_with_context(text, file_path.name, raw_chunks)
+    # 上下文增强（本地操作，无 API 调用）
+    enriched_chunks = enrich_chunks_with_context(text, filename, raw_chunks)
+    pending = enriched_chunks[committed:]
 
-        # 批量 embedding
-        logger.info("Embedding 开始: %s (%d chunks)", file_path.name, len(enriched_chunks))
-        embeddings = await get_embeddings_batch(embed_client, enriched_chunks)
-        logger.info("Embedding 完成: %s", file_path.name)
+    # 原文相同的 chunk 已有同模型 embedding（任意会话）时直接复用，只为其余 chunk 调用 Gemini
+    hashes = [chunk_hash(c) for c in raw_chunks[committed:]]
+    known = {} if force else await get_embeddings_by_hash(hashes)
+    embs = [known.get(h) for h in hashes]
+    missing = [i for i, e in enumerate(embs) if e is None]
 
-        # 批量写入（单连接，单次 register_vector，executemany）
-        items = list(zip(enriched_chunks, raw_chunks, embeddings))
-        await add_knowledge_batch(items, session_id, source_file=file_path.name)
+    # 批次按 chunk 顺序提交（断点 = 连续前缀），每当前缀上的 embedding 齐全就写入
+    cursor = 0
 
-        await update_file_status(session_id, file_path.name, 'done', processed=len(raw_chunks))
-        logger.info("文件处理完成: %s (%d chunks)", file_path.name, len(raw_chunks))
+    async def _flush():
+        nonlocal cursor
+        end = cursor
+        while end < len(embs) and embs[end] is not None:
+            end += 1
+        if end == cursor:
+            return
+        originals = raw_chunks[committed + cursor:committed + end]
+        items = list(zip(pending[cursor:end], originals, embs[cursor:end], hashes[cursor:end]))
+        # 原文 token 数随批次一次 count_tokens 算好入库，供 prompt 预算规划与全量上下文判定
+        token_counts = await count_chunk_tokens(originals)
+        await add_knowledge_batch(items, session_id, source_file=filename, start_index=committed + cursor,
+                                  token_counts=token_counts)
+        cursor = end
+
+    # 流水线 embedding，按顺序逐批写入（每批一条 INSERT + 进度推进同事务）
+    logger.info("Embedding 开始: %s (%d chunks 待处理，%d 个复用已有向量)",
+                filename, len(pending), len(pending) - len(missing))
+    embed_t0 = time.monotonic()
+    await _flush()
+    async for offset, embeddings in iter_embedding_batches(embed_client, [pending[i] for i in missing]):
+        for j, emb in enumerate(embeddings):
+            embs[missing[offset + j]] = emb
+        await _flush()
+
+    stats.update(chunks=total, embedded_chunks=len(missing), reused_chunks=len(pending) - len(missing),
+                 embed_seconds=round(time.monotonic() - embed_t0, 1))
+    await update_file_parse_stats(session_id, filename, stats)
+    await update_file_status(session_id, filename, 'done', processed=total)
+    await drop_context_cache(session_id)
+    logger.info("文件处理完成: %s (%d chunks) %s", filename, total, stats)
+
+
+async def _ingest_from_copy(file_path: Path, session_id: str, source: dict):
+    """从内容相同、已入库完成的文件复制 chunk（含向量）与已转换的 Markdown。"""
+    filename = file_path.name
+    t0 = time.monotonic()
+    copied = await copy_file_knowledge(source["session_id"], source["filename"], session_id, filename)
+
+    # PDF / EPUB 的转换结果一并复制，后续重新处理可直接复用
+    src_md = (settings.base_dir / source["filepath"]).with_suffix('.md')
+    dst_md = file_path.with_suffix('.md')
+    if file_path.suffix.lower() in ('.pdf', '.epub') and src_md.exists() and not dst_md.exists():
+        await asyncio.to_thread(shutil.copyfile, src_md, dst_md)
+
+    stats = {"method": "dedup", "source_file": source["filename"], "chunks": copied,
+             "parse_seconds": round(time.monotonic() - t0, 1), "embedded_chunks": 0}
+    await update_file_parse_stats(session_id, filename, stats)
+    await update_file_status(session_id, filename, 'done', total=copied, processed=copied)
+    await drop_context_cache(session_id)
+    logger.info("文件内容已入库过，复制 %d 个 chunk: %s ← %s/%s",
+                copied, filename, source["session_id"], source["filename"])
+
+
+async def process_file_and_insert(file_path: Path, session_id: str, force: bool = False):
+    """进程内后台任务入口（Celery 不可用时的降级路径）：出错即标记 failed。"""
+    try:
+        await ingest_file(file_path, session_id, force=force)
     except Exception as e:
         error_msg = str(e) or f"{type(e).__name__}"
         await update_file_status(session_id, file_path.name, 'failed', error=error_msg)
         logger.exception("处理文件 %s 出错: %s", file_path.name, e)
 
 
+async def schedule_ingest(background_tasks: BackgroundTasks, session_id: str, filename: str, relative_path: str,
+                          force: bool = False):
+    """
+    投递文件解析任务：启用 INGEST_VIA_CELERY 时发往 Celery ingest 队列，由独立 worker 执行（OCR / 解析不占 web 进程）；
+    未启用或 broker 不可达时降级为进程内 BackgroundTask。force 见 ingest_file()。
+    """
+    if settings.ingest_via_celery:
+        try:
+            from backend.tasks import ingest_file_task
+            await asyncio.to_thread(
+                ingest_file_task.apply_async,
+                args=(session_id, filename, relative_path, force),
+            )
+            return
+        except Exception as e:
+            logger.warning("Celery 投递失败，降级为进程内后台任务: %s — %s", filename, e)
+    background_tasks.add_task(process_file_and_insert, settings.base_dir / relative_path, session_id, force)
+
+
 @router.get("/status/{session_id}")
 async def get_upload_status(session_id: str, user=Depends(get_current_user)):
     if not await session_owned_by(session_id, user["id"]):
@@ -138,17 +322,25 @@ async def reprocess_file(
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="磁盘文件不存在，请重新上传")
 
-    # 清除该文件的旧向量并重置状态
-    await database.execute(
-        "DELETE FROM knowledge_base WHERE session_id = :sid AND source_file = :src",
-        values={"sid": session_id, "src": filename},
-    )
-    await database.execute(
-        """UPDATE upload_files
-           SET status = 'pending', total_chunks = 0, processed_chunks = 0, error_msg = NULL
-           WHERE session_id = :sid AND filename = :fname""",
-        values={"sid": session_id, "fname": filename},
-    )
+    if row["status"] == "done":
+        # 已完成的文件重新处理 = 整体重建
+        await delete_file_knowledge(session_id, filename)
+        session_vector_cache.invalidate(session_id)
+        await drop_context_cache(session_id)
+        await database.execute(
+            """UPDATE upload_files
+               SET status = 'pending', total_chunks = 0, processed_chunks = 0, error_msg = NULL
+               WHERE session_id = :sid AND filename = :fname""",
+            values={"sid": session_id, "fname": filename},
+        )
+    else:
+        # 失败 / 中断的文件保留已入库的 chunk，后台任务从断点续传
+        await database.execute(
+            """UPDATE upload_files SET status = 'pending', error_msg = NULL
+               WHERE session_id = :sid AND filename = :fname""",
+            values={"sid": session_id, "fname": filename},
+        )
 
-    background_tasks.add_task(process_file_and_insert, file_path, session_id)
+    # 显式重新处理：不走文件级复制与 chunk 向量复用，保证真正重新解析
+    await schedule_ingest(background_tasks, session_id, filename, row["filepath"], force=True)
     return JSONResponse({"success": True})
@@ -0,0 +1,130 @@
+"""
+向量存储精度基准：对比 full / half / binary 三种 EMBEDDING_STORAGE 的体积、建索引耗时、检索延迟与召回率。
+
+在临时表 bench_emb_<模式> 中写入同一批合成向量（围绕若干主题中心的扰动，模拟真实文档的聚簇分布），
+各表按对应模式建 HNSW 索引，再用 query_rag 的 hnsw 查询路径（_search_hnsw，固定 HNSW_EF_SEARCH，
+不做自适应放大）执行相同查询。binary 模式按 BINARY_RERANK_FACTOR 取候选后全精度重排。
+
+召回率 = 与 NumPy 精确余弦 top-k（k = TOP_K_MAX）的交集比例。结束后删除临时表（--keep 保留）。
+
+用法：python -m scripts.bench_embedding_storage [--rows 50000] [--queries 50] [--topics 50]
+                                               [--modes full,half,binary] [--keep]
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.db import database, acquire_conn, embedding_type, hnsw_index_sql
+from backend.rag import _search_hnsw
+from settings import settings
+
+TABLE_PREFIX = "bench_emb_"
+
+
+def _unit(m: np.ndarray) -> np.ndarray:
+    return (m / np.linalg.norm(m, axis=-1, keepdims=True)).astype(np.float32)
+
+
+async def _load(conn, mode: str, sid, vecs: np.ndarray) -> dict:
+    table = TABLE_PREFIX + mode
+    await conn.execute(f"DROP TABLE IF EXISTS {table}")
+    await conn.execute(f"""
+        CREATE TABLE {table} (
+            id SERIAL PRIMARY KEY,
+            session_id UUID,
+            content TEXT,
+            original_content TEXT,
+            source_file TEXT,
+            chunk_index INTEGER,
+            embedding {embedding_type(mode)}
+        )
+    """)
+    # 先以 vector 导入临时表，再 INSERT ... SELECT（halfvec 列隐式转换）
+    await conn.execute("DROP TABLE IF EXISTS bench_emb_src")
+    await conn.execute("CREATE TEMP TABLE bench_emb_src (chunk_index INTEGER, embedding vector)")
+    await conn.copy_records_to_table(
+        "bench_emb_src", columns=["chunk_index", "embedding"],
+        records=[(i, vecs[i]) for i in range(len(vecs))],
+    )
+    await conn.execute(f"""
+        INSERT INTO {table} (session_id, content, original_content, source_file, chunk_index, embedding)
+        SELECT $1, '', '', 'bench.txt', chunk_index, embedding FROM bench_emb_src
+    """, sid)
+    await conn.execute("DROP TABLE bench_emb_src")
+
+    t0 = time.perf_counter()
+    await conn.execute(hnsw_index_sql(f"{table}_hnsw", table, storage=mode))
+    build = time.perf_counter() - t0
+    await conn.execute(f"ANALYZE {table}")
+    sizes = await conn.fetchrow(
+        f"SELECT pg_table_size('{table}') AS tbl, pg_relation_size('{table}_hnsw') AS idx"
+    )
+    return {"table": table, "build": build, "tbl": sizes["tbl"], "idx": sizes["idx"]}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="向量存储精度基准")
+    parser.add_argument("--rows", type=int, default=50000, help="向量条数")
+    parser.add_argument("--queries", type=int, default=50, help="查询次数")
+    parser.add_argument("--topics", type=int, default=50, help="主题中心数")
+    parser.add_argument("--modes", default="full,half,binary", help="逗号分隔的存储模式")
+    parser.add_argument("--keep", action="store_true", help="结束后保留临时表")
+    args = parser.parse_args()
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+
+    rng = np.random.default_rng(42)
+    dim = settings.embedding_dim
+    topics = _unit(rng.normal(size=(args.topics, dim)))
+    vecs = _unit(topics[rng.integers(0, args.topics, size=args.rows)] + rng.normal(scale=0.35, size=(args.rows, dim)))
+    picks = rng.integers(0, args.rows, size=args.queries)
+    queries = _unit(vecs[picks] + rng.normal(scale=0.1, size=(args.queries, dim)))
+
+    limit = settings.top_k_max
+    truth = [set(np.argsort(-(vecs @ q))[:limit].tolist()) for q in queries]
+    sid = uuid.uuid4()
+
+    await database.connect()
+    rows = []
+    try:
+        async with acquire_conn() as conn:
+            for mode in modes:
+                print(f"写入 {args.rows} 条向量（{mode}）并建索引 ...")
+                info = await _load(conn, mode, sid, vecs)
+                lat, rec = [], []
+                for q, want in zip(queries, truth):
+                    t0 = time.perf_counter()
+                    got, _ = await _search_hnsw(conn, q, sid, limit, args.rows, table=info["table"],
+                                                adaptive=False, storage=mode)
+                    lat.append((time.perf_counter() - t0) * 1000)
+                    rec.append(len({r["chunk_index"] for r in got} & want) / limit)
+                lat.sort()
+                rows.append({
+                    "mode": mode, **info,
+                    "p50": statistics.median(lat),
+                    "p95": lat[int(len(lat) * 0.95) - 1] if len(lat) > 1 else lat[0],
+                    "recall": statistics.mean(rec),
+                })
+                if not args.keep:
+                    await conn.execute(f"DROP TABLE IF EXISTS {info['table']}")
+    finally:
+        await database.disconnect()
+
+    print(f"\n{args.rows} 条 × {dim} 维，k = {limit}，ef_search = {settings.hnsw_ef_search}，"
+          f"binary 重排倍数 {settings.binary_rerank_factor}，{args.queries} 次查询\n")
+    print("| 模式 | 表体积 MB | 索引体积 MB | 建索引 s | p50 ms | p95 ms | recall@k |")
+    print("|---|---:|---:|---:|---:|---:|---:|")
+    for r in rows:
+        print(f"| {r['mode']} | {r['tbl'] / 2**20:.1f} | {r['idx'] / 2**20:.1f} | {r['build']:.1f} "
+              f"| {r['p50']:.1f} | {r['p95']:.1f} | {r['recall']:.3f} |")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
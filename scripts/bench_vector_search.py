@@ -0,0 +1,170 @@
+"""
+会话过滤向量检索基准：对比不同会话数下各检索策略的延迟与召回率。
+
+在临时表 bench_knowledge_base 中生成合成数据（各会话共享同一批主题中心，模拟大量会话上传相近
+文档的真实分布，最容易暴露全局 HNSW + 会话过滤的召回塌缩），对随机抽取的会话执行查询：
+
+  global    旧实现：全局 HNSW，session_id 以参数传入，固定 HNSW_EF_SEARCH
+  exact     MATERIALIZED CTE 精确排序（小会话策略，同时作为召回率的真值）
+  hnsw      会话 id 内联 + ef_search 自适应放大（大会话策略，无部分索引）
+  partial   同 hnsw，但目标会话已建部分 HNSW 索引
+
+召回率 = 与 exact 的 top-k（k = TOP_K_MAX）交集比例。结束后删除临时表（--keep 保留）。
+
+用法：python -m scripts.bench_vector_search [--sessions 10,100,1000] [--chunks 200]
+                                           [--queries 30] [--topics 50] [--keep]
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.db import database, acquire_conn, embedding_type, hnsw_index_sql, vec_param
+from backend.rag import _search_exact, _search_hnsw
+from settings import settings
+
+TABLE = "bench_knowledge_base"
+
+
+def _unit(m: np.ndarray) -> np.ndarray:
+    return (m / np.linalg.norm(m, axis=-1, keepdims=True)).astype(np.float32)
+
+
+async def _load(conn, n_sessions: int, chunks: int, topics: np.ndarray, rng) -> list:
+    await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    await conn.execute(f"""
+        CREATE TABLE {TABLE} (
+            id SERIAL PRIMARY KEY,
+            session_id UUID,
+            content TEXT,
+            original_content TEXT,
+            source_file TEXT,
+            chunk_index INTEGER,
+            embedding {embedding_type()}
+        )
+    """)
+    sessions = [uuid.uuid4() for _ in range(n_sessions)]
+    for sid in sessions:
+        # 每个会话的 chunk 落在少数几个共享主题附近
+        picked = topics[rng.choice(len(topics), size=3, replace=False)]
+        base = picked[rng.integers(0, len(picked), size=chunks)]
+        vecs = _unit(base + rng.normal(scale=0.35, size=base.shape))
+        await conn.copy_records_to_table(
+            TABLE,
+            columns=["session_id", "content", "original_content", "source_file", "chunk_index", "embedding"],
+            records=[(sid, "", "", "bench.txt", i, vecs[i]) for i in range(chunks)],
+        )
+    await conn.execute(f"CREATE INDEX ON {TABLE} (session_id)")
+    await conn.execute(hnsw_index_sql(f"{TABLE}_hnsw", TABLE))
+    await conn.execute(f"ANALYZE {TABLE}")
+    return sessions
+
+
+async def _global(conn, vector, session_id, limit):
+    async with conn.transaction():
+        await conn.execute(f"SET LOCAL hnsw.ef_search = {settings.hnsw_ef_search}")
+        return await conn.fetch(f"""
+            SELECT chunk_index, (embedding <=> {vec_param("$2")}) AS distance
+            FROM {TABLE}
+            WHERE session_id = $1
+            ORDER BY embedding <=> {vec_param("$2")}
+            LIMIT $3
+        """, session_id, vector, limit)
+
+
+async def _bench(conn, n_sessions: int, args, topics, rng) -> list:
+    sessions = await _load(conn, n_sessions, args.chunks, topics, rng)
+    limit = settings.top_k_max
+    targets = [sessions[i] for i in rng.choice(len(sessions), size=min(5, len(sessions)), replace=False)]
+
+    # 查询向量：目标会话内某个 chunk 的扰动
+    queries = []
+    for _ in range(args.queries):
+        sid = targets[int(rng.integers(0, len(targets)))]
+        row = await conn.fetchrow(
+            f"SELECT embedding FROM {TABLE} WHERE session_id = $1 AND chunk_index = $2",
+            sid, int(rng.integers(0, args.chunks)),
+        )
+        q = _unit(np.asarray(row["embedding"]) + rng.normal(scale=0.1, size=settings.embedding_dim))
+        queries.append((sid, q))
+
+    truth = {}
+    for i, (sid, q) in enumerate(queries):
+        truth[i] = {r["chunk_index"] for r in await _search_exact(conn, q, sid, limit, table=TABLE)}
+
+    async def run(name, fn):
+        lat, rec, efs = [], [], []
+        for i, (sid, q) in enumerate(queries):
+            t0 = time.perf_counter()
+            rows, ef = await fn(sid, q)
+            lat.append((time.perf_counter() - t0) * 1000)
+            got = {r["chunk_index"] for r in rows}
+            rec.append(len(got & truth[i]) / max(1, len(truth[i])))
+            if ef:
+                efs.append(ef)
+        lat.sort()
+        return {
+            "sessions": n_sessions, "rows": n_sessions * args.chunks, "strategy": name,
+            "p50": statistics.median(lat), "p95": lat[int(len(lat) * 0.95) - 1] if len(lat) > 1 else lat[0],
+            "recall": statistics.mean(rec), "ef": statistics.mean(efs) if efs else None,
+        }
+
+    results = [
+        await run("global", lambda sid, q: _pair(_global(conn, q, sid, limit))),
+        await run("exact", lambda sid, q: _pair(_search_exact(conn, q, sid, limit, table=TABLE))),
+        await run("hnsw", lambda sid, q: _search_hnsw(conn, q, sid, limit, args.chunks, table=TABLE)),
+    ]
+    for sid in targets:
+        await conn.execute(hnsw_index_sql(f"{TABLE}_hnsw_{sid.hex}", TABLE, where=f"session_id = '{sid}'::uuid"))
+    await conn.execute(f"ANALYZE {TABLE}")
+    results.append(await run("partial", lambda sid, q: _search_hnsw(conn, q, sid, limit, args.chunks, table=TABLE)))
+    return results
+
+
+async def _pair(coro):
+    return await coro, None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="会话过滤向量检索基准")
+    parser.add_argument("--sessions", default="10,100,1000", help="逗号分隔的会话数列表")
+    parser.add_argument("--chunks", type=int, default=200, help="每个会话的 chunk 数")
+    parser.add_argument("--queries", type=int, default=30, help="每组查询次数")
+    parser.add_argument("--topics", type=int, default=50, help="共享主题中心数")
+    parser.add_argument("--keep", action="store_true", help="结束后保留临时表")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    topics = _unit(rng.normal(size=(args.topics, settings.embedding_dim)))
+
+    await database.connect()
+    rows = []
+    try:
+        async with acquire_conn() as conn:
+            for n in [int(x) for x in args.sessions.split(",") if x.strip()]:
+                print(f"生成 {n} 个会话 × {args.chunks} chunks ...")
+                rows.extend(await _bench(conn, n, args, topics, rng))
+            if not args.keep:
+                await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    finally:
+        await database.disconnect()
+
+    print(f"\nk = {settings.top_k_max}，ef_search = {settings.hnsw_ef_search}"
+          f"（自适应上限 {settings.hnsw_ef_search_max}），每组 {args.queries} 次查询\n")
+    print("| 会话数 | 总行数 | 策略 | p50 ms | p95 ms | recall@k | 平均 ef |")
+    print("|---:|---:|---|---:|---:|---:|---:|")
+    for r in rows:
+        ef = f"{r['ef']:.0f}" if r["ef"] else "—"
+        print(f"| {r['sessions']} | {r['rows']} | {r['strategy']} | {r['p50']:.1f} | {r['p95']:.1f} "
+              f"| {r['recall']:.3f} | {ef} |")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
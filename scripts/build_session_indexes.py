@@ -0,0 +1,74 @@
+"""
+为大会话建立独立的部分 HNSW 索引（WHERE session_id = '<uuid>'），并清理已失效会话的索引。
+
+全局 HNSW 索引在会话过滤下召回会塌缩（候选大多属于其他会话）；部分索引只含该会话的向量，
+query_rag 的 hnsw 策略把会话 id 内联为字面量，planner 即可直接选用。
+阈值：knowledge_stats 中 chunk 数 ≥ RAG_PARTIAL_INDEX_MIN_CHUNKS（默认 50000）。
+索引以 CREATE INDEX CONCURRENTLY 建立，不阻塞写入，类型随 EMBEDDING_STORAGE；幂等，可放进定时任务重复执行。
+
+用法：python -m scripts.build_session_indexes [--dry-run]
+"""
+import asyncio
+import sys
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.db import database, hnsw_index_sql
+from settings import settings
+
+INDEX_PREFIX = "idx_kb_hnsw_s_"
+
+
+def index_name(session_id) -> str:
+    return INDEX_PREFIX + uuid.UUID(str(session_id)).hex
+
+
+async def main():
+    dry_run = "--dry-run" in sys.argv
+    await database.connect()
+
+    big = await database.fetch_all(
+        """SELECT session_id, SUM(chunk_count) AS chunks
+           FROM knowledge_stats
+           GROUP BY session_id
+           HAVING SUM(chunk_count) >= :min_chunks
+           ORDER BY chunks DESC""",
+        values={"min_chunks": settings.rag_partial_index_min_chunks},
+    )
+    existing = {
+        r["indexname"] for r in await database.fetch_all(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'knowledge_base' AND indexname LIKE :p",
+            values={"p": INDEX_PREFIX + "%"},
+        )
+    }
+    live = await database.fetch_all("SELECT DISTINCT session_id FROM knowledge_stats")
+    live_names = {index_name(r["session_id"]) for r in live}
+
+    print(f"大会话（≥ {settings.rag_partial_index_min_chunks} chunks）：{len(big)} 个；已有部分索引：{len(existing)} 个")
+
+    for r in big:
+        name = index_name(r["session_id"])
+        if name in existing:
+            print(f"  = {name}（{r['chunks']} chunks）已存在")
+            continue
+        print(f"  + {name}（{r['chunks']} chunks）")
+        if not dry_run:
+            sid = uuid.UUID(str(r["session_id"]))
+            await database.execute(hnsw_index_sql(
+                name, "knowledge_base", where=f"session_id = '{sid}'::uuid", concurrently=True,
+            ))
+
+    # 会话已删除 / 知识库已清空的索引直接删除（仍有数据但低于阈值的保留，避免来回重建）
+    for name in sorted(existing - live_names):
+        print(f"  - {name}（会话已无数据）")
+        if not dry_run:
+            await database.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    await database.disconnect()
+    print("完成。" + ("（dry-run，未做修改）" if dry_run else ""))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
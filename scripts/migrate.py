@@ -9,7 +9,7 @@ from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-from backend.db import database
+from backend.db import database, KNOWLEDGE_STATS_DDL, KNOWLEDGE_STATS_REBUILD
 
 
 MIGRATIONS = [
@@ -71,6 +71,97 @@ MIGRATIONS = [
     # 迁移已有 persona 数据到新字段（不重复处理已迁移行）
     ("sessions.migrate_persona",
      "UPDATE sessions SET system_instruction_origin = persona, system_instruction = persona WHERE persona IS NOT NULL AND system_instruction IS NULL"),
+
+    # upload_files 表：扫描版 PDF 的 OCR 页进度
+    ("upload_files.total_pages",
+     "ALTER TABLE upload_files ADD COLUMN IF NOT EXISTS total_pages INTEGER DEFAULT 0"),
+    ("upload_files.processed_pages",
+     "ALTER TABLE upload_files ADD COLUMN IF NOT EXISTS processed_pages INTEGER DEFAULT 0"),
+    # upload_files 表：解析统计（提取方式页数、OCR / 解析 / embedding 耗时）
+    ("upload_files.parse_stats",
+     "ALTER TABLE upload_files ADD COLUMN IF NOT EXISTS parse_stats JSONB"),
+
+    # 内容寻址去重：文件字节 SHA-256 / chunk 规范化文本 SHA-256
+    ("upload_files.content_hash",
+     "ALTER TABLE upload_files ADD COLUMN IF NOT EXISTS content_hash TEXT"),
+    ("idx_upload_files_content_hash",
+     "CREATE INDEX IF NOT EXISTS idx_upload_files_content_hash ON upload_files(content_hash)"),
+    ("knowledge_base.content_hash",
+     "ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS content_hash TEXT"),
+    ("idx_knowledge_base_content_hash",
+     "CREATE INDEX IF NOT EXISTS idx_knowledge_base_content_hash ON knowledge_base(content_hash)"),
+
+    # knowledge_stats：按会话 / 文件维护的语料计数（触发器同步），并由现有数据回填
+    *KNOWLEDGE_STATS_DDL,
+    *KNOWLEDGE_STATS_REBUILD,
+
+    # user_daily_usage：每用户每日 token 汇总，由历史消息回填（已有的日汇总不覆盖）
+    ("user_daily_usage",
+     "CREATE TABLE IF NOT EXISTS user_daily_usage ("
+     "user_id INTEGER REFERENCES users(id) ON DELETE CASCADE, "
+     "day DATE NOT NULL, tokens BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (user_id, day))"),
+    ("user_daily_usage.backfill",
+     "INSERT INTO user_daily_usage (user_id, day, tokens) "
+     "SELECT s.user_id, DATE(m.created_at), SUM(m.tokens_total) "
+     "FROM messages m JOIN sessions s ON m.session_id = s.id "
+     "WHERE s.user_id IS NOT NULL AND m.tokens_total > 0 "
+     "GROUP BY s.user_id, DATE(m.created_at) "
+     "ON CONFLICT (user_id, day) DO NOTHING"),
+    ("extension.pg_trgm", "CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+    ("idx_knowledge_base_trgm",
+     "CREATE INDEX IF NOT EXISTS idx_knowledge_base_trgm "
+     "ON knowledge_base USING gin (original_content gin_trgm_ops)"),
+    ("sessions.is_library",
+     "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS is_library BOOLEAN NOT NULL DEFAULT FALSE"),
+    ("idx_sessions_user_library",
+     "CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_user_library ON sessions(user_id) WHERE is_library"),
+    ("idx_knowledge_base_session_source",
+     "CREATE INDEX IF NOT EXISTS idx_knowledge_base_session_source ON knowledge_base(session_id, source_file)"),
+    ("session_library_files",
+     "CREATE TABLE IF NOT EXISTS session_library_files ("
+     "session_id UUID REFERENCES sessions(id) ON DELETE CASCADE, "
+     "library_id UUID REFERENCES sessions(id) ON DELETE CASCADE, "
+     "source_file TEXT NOT NULL, created_at TIMESTAMP DEFAULT NOW(), "
+     "PRIMARY KEY (session_id, library_id, source_file))"),
+    ("idx_session_library_files_library",
+     "CREATE INDEX IF NOT EXISTS idx_session_library_files_library "
+     "ON session_library_files(library_id, source_file)"),
+    # 语义回答缓存（sessions.corpus_version 由上面的 KNOWLEDGE_STATS_DDL 添加）
+    ("answer_cache",
+     "CREATE TABLE IF NOT EXISTS answer_cache ("
+     "id SERIAL PRIMARY KEY, "
+     "session_id UUID REFERENCES sessions(id) ON DELETE CASCADE, "
+     "corpus_version TEXT NOT NULL, persona_hash TEXT NOT NULL, "
+     "prompt_version INTEGER NOT NULL DEFAULT 0, source_filter TEXT NOT NULL DEFAULT '', "
+     "route TEXT, query TEXT, embedding vector(768), "
+     "answer TEXT NOT NULL, citations JSONB DEFAULT '[]'::jsonb, "
+     "hits INTEGER NOT NULL DEFAULT 0, created_at TIMESTAMPTZ DEFAULT NOW(), last_hit_at TIMESTAMPTZ)"),
+    ("idx_answer_cache_key",
+     "CREATE INDEX IF NOT EXISTS idx_answer_cache_key "
+     "ON answer_cache(session_id, corpus_version, persona_hash, prompt_version)"),
+    ("agent_traces.cache_hit",
+     "ALTER TABLE agent_traces ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN NOT NULL DEFAULT FALSE"),
+    # Gemini 上下文缓存句柄 + trace 中的缓存命中 token 数
+    ("context_caches",
+     "CREATE TABLE IF NOT EXISTS context_caches ("
+     "session_id UUID PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE, "
+     "corpus_version TEXT NOT NULL, model TEXT NOT NULL, cache_name TEXT NOT NULL, "
+     "citations JSONB DEFAULT '[]'::jsonb, token_count INTEGER DEFAULT 0, "
+     "expire_at TIMESTAMPTZ NOT NULL, created_at TIMESTAMPTZ DEFAULT NOW())"),
+    ("agent_traces.tokens_cached",
+     "ALTER TABLE agent_traces ADD COLUMN IF NOT EXISTS tokens_cached INTEGER DEFAULT 0"),
+    # prompt token 预算规划结果（各段额度 / 用量 / 裁剪）
+    ("agent_traces.prompt_budget",
+     "ALTER TABLE agent_traces ADD COLUMN IF NOT EXISTS prompt_budget JSONB"),
+    # 滚动对话摘要
+    ("session_summaries",
+     "CREATE TABLE IF NOT EXISTS session_summaries ("
+     "session_id UUID PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE, "
+     "summary TEXT NOT NULL DEFAULT '', last_message_id INTEGER NOT NULL DEFAULT 0, "
+     "message_count INTEGER NOT NULL DEFAULT 0, updated_at TIMESTAMPTZ DEFAULT NOW())"),
+    # 语义回答缓存键加入滚动摘要哈希
+    ("answer_cache.context_hash",
+     "ALTER TABLE answer_cache ADD COLUMN IF NOT EXISTS context_hash TEXT NOT NULL DEFAULT ''"),
 ]
 
 
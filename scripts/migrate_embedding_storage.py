@@ -0,0 +1,112 @@
+"""
+转换已有向量数据的存储精度（EMBEDDING_STORAGE），并按目标模式重建 HNSW 索引。
+
+  full    vector(768)  + vector_cosine_ops
+  half    halfvec(768) + halfvec_cosine_ops          表与索引约减半
+  binary  vector(768)  + binary_quantize 的 bit_hamming_ops 索引（检索时全精度重排）
+
+对 knowledge_base 与 messages 依次：删除 embedding 的 HNSW 索引 → 列类型不同时 ALTER COLUMN TYPE
+→ 按目标模式重建索引；同时删除会话部分索引（idx_kb_hnsw_s_*），最后输出转换前后的体积。
+ALTER TYPE 会重写整表并持有排他锁，需在维护窗口执行。halfvec / binary_quantize 需 pgvector ≥ 0.7。
+
+完成后把 .env 中 EMBEDDING_STORAGE 改为目标模式并重启 web / worker，
+再执行 python -m scripts.build_session_indexes 重建大会话的部分索引。
+
+用法：python -m scripts.migrate_embedding_storage --to half [--dry-run]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.db import database, EMBEDDING_STORAGES, embedding_type, hnsw_index_sql
+from scripts.build_session_indexes import INDEX_PREFIX
+
+# (表, 索引名, 索引谓词)
+TARGETS = [
+    ("knowledge_base", "idx_knowledge_base_hnsw", ""),
+    ("messages", "idx_messages_embedding", "embedding IS NOT NULL"),
+]
+
+
+async def _column_type(table: str) -> str:
+    return await database.fetch_val(
+        """SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+           WHERE attrelid = CAST(:t AS regclass) AND attname = 'embedding'""",
+        values={"t": table},
+    )
+
+
+async def _sizes(table: str) -> tuple[int, int]:
+    row = await database.fetch_one(
+        "SELECT pg_table_size(CAST(:t AS regclass)) AS tbl, pg_indexes_size(CAST(:t AS regclass)) AS idx",
+        values={"t": table},
+    )
+    return row["tbl"], row["idx"]
+
+
+def _mb(n: int) -> str:
+    return f"{n / 2**20:.1f}MB"
+
+
+async def _run(sql: str, dry_run: bool) -> None:
+    print(f"    {sql}")
+    if dry_run:
+        return
+    t0 = time.monotonic()
+    await database.execute(sql)
+    print(f"      ✓ {time.monotonic() - t0:.1f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="转换向量存储精度")
+    parser.add_argument("--to", required=True, choices=EMBEDDING_STORAGES, help="目标存储模式")
+    parser.add_argument("--dry-run", action="store_true", help="只打印将执行的 SQL")
+    args = parser.parse_args()
+    target_type = embedding_type(args.to)
+
+    await database.connect()
+    try:
+        before = {t: await _sizes(t) for t, _, _ in TARGETS}
+
+        partial = await database.fetch_all(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'knowledge_base' AND indexname LIKE :p",
+            values={"p": INDEX_PREFIX + "%"},
+        )
+        if partial:
+            print(f"删除会话部分索引 {len(partial)} 个（转换后用 build_session_indexes 重建）")
+            for r in partial:
+                await _run(f"DROP INDEX IF EXISTS {r['indexname']}", args.dry_run)
+
+        for table, index, where in TARGETS:
+            current = await _column_type(table)
+            print(f"{table}: {current} → {target_type}（{args.to}）")
+            await _run(f"DROP INDEX IF EXISTS {index}", args.dry_run)
+            if current != target_type:
+                await _run(
+                    f"ALTER TABLE {table} ALTER COLUMN embedding TYPE {target_type} "
+                    f"USING embedding::{target_type}",
+                    args.dry_run,
+                )
+            await _run(hnsw_index_sql(index, table, where=where, storage=args.to), args.dry_run)
+            await _run(f"ANALYZE {table}", args.dry_run)
+
+        if not args.dry_run:
+            print("\n| 表 | 表体积（前 → 后） | 索引体积（前 → 后） |")
+            print("|---|---|---|")
+            for table, _, _ in TARGETS:
+                (tb, ib), (ta, ia) = before[table], await _sizes(table)
+                print(f"| {table} | {_mb(tb)} → {_mb(ta)} | {_mb(ib)} → {_mb(ia)} |")
+    finally:
+        await database.disconnect()
+
+    print("\n完成。" + ("（dry-run，未做修改）" if args.dry_run else
+                     f"请在 .env 中设置 EMBEDDING_STORAGE={args.to} 并重启服务，"
+                     "再执行 python -m scripts.build_session_indexes"))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 """
 将卡在"处理中"状态的文件重置为"等待处理"，以便重新触发解析。
 服务重启后原有后台任务已终止，但数据库状态仍停留在 processing。
+已入库的 chunk 与 processed_chunks 保留，重新解析时从断点续传。
 
 用法：python -m scripts.reset_stuck_processing
 """
@@ -42,7 +43,7 @@ async def main():
 
     await database.execute("""
         UPDATE upload_files
-        SET status = 'pending', total_chunks = 0, processed_chunks = 0, error_msg = NULL
+        SET status = 'pending', error_msg = NULL
         WHERE status = 'processing'
     """)
 
@@ -31,19 +31,88 @@ class Settings(BaseModel):
     generation_model: str = os.getenv("GEMINI_TEXT_MODEL", "gemini-2.5-flash")
     embedding_model: str = os.getenv("GEMINI_EMBED_MODEL", "gemini-embedding-exp-03-07")
     embedding_dim: int = int(os.getenv("EMBEDDING_DIM", "768"))
+    # 向量存储精度：full（vector）/ half（halfvec）/ binary（二值量化索引 + 全精度重排）；
+    # 切换后执行 scripts/migrate_embedding_storage.py
+    embedding_storage: str = os.getenv("EMBEDDING_STORAGE", "full").lower()
+    binary_rerank_factor: int = int(os.getenv("BINARY_RERANK_FACTOR", "4"))
     top_k: int = int(os.getenv("TOP_K", "4"))
     top_k_max: int = int(os.getenv("TOP_K_MAX", "20"))
     top_k_margin: float = float(os.getenv("TOP_K_MARGIN", "0.07"))  # 距最佳匹配的最大额外距离
     top_k_gap: float = float(os.getenv("TOP_K_GAP", "0.05"))        # 触发截断的最小跳变间隔
     rag_distance_threshold: float = float(os.getenv("RAG_DISTANCE_THRESHOLD", "0.40"))
     hnsw_ef_search: int = int(os.getenv("HNSW_EF_SEARCH", "100"))
+    # 会话感知向量检索：chunk 数不超过此值的会话精确暴力计算距离（不走 HNSW）
+    rag_exact_max_chunks: int = int(os.getenv("RAG_EXACT_MAX_CHUNKS", "20000"))
+    # 大会话走 HNSW 时，会话内候选不足则按 4 倍放大 ef_search 重查，直到此上限
+    hnsw_ef_search_max: int = int(os.getenv("HNSW_EF_SEARCH_MAX", "1000"))
+    # pgvector ≥ 0.8 的迭代索引扫描：off / relaxed_order / strict_order
+    hnsw_iterative_scan: str = os.getenv("HNSW_ITERATIVE_SCAN", "off")
+    # scripts/build_session_indexes.py 为 chunk 数达到此值的会话建立独立的部分 HNSW 索引
+    rag_partial_index_min_chunks: int = int(os.getenv("RAG_PARTIAL_INDEX_MIN_CHUNKS", "50000"))
+    # 进程内热点会话向量缓存（FAISS / NumPy）内存预算（MB），0 = 关闭
+    vector_cache_mb: int = int(os.getenv("VECTOR_CACHE_MB", "256"))
+    # 混合检索：查询含编号 / 型号 / 引号内名称时追加 pg_trgm 子串匹配，与向量结果 RRF 融合
+    rag_hybrid: bool = os.getenv("RAG_HYBRID", "false").lower() in ("1", "true", "yes")
+    rag_lexical_k: int = int(os.getenv("RAG_LEXICAL_K", "5"))
+    rag_rrf_k: int = int(os.getenv("RAG_RRF_K", "60"))
     max_history_turns: int = int(os.getenv("MAX_HISTORY_TURNS", "12"))
+    # 滚动对话摘要：较早的消息由后台任务增量折叠进会话摘要，prompt 只带 摘要 + 最近 HISTORY_KEEP_MESSAGES 条原文
+    # （摘要滞后时最多 MAX_HISTORY_TURNS 条）；未折叠消息攒够 HISTORY_SUMMARY_BATCH 条才折叠一次
+    history_summary_enabled: bool = os.getenv("HISTORY_SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+    history_keep_messages: int = int(os.getenv("HISTORY_KEEP_MESSAGES", "6"))
+    history_summary_batch: int = int(os.getenv("HISTORY_SUMMARY_BATCH", "4"))
+    history_summary_max_chars: int = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "1500"))
+    history_summary_model: str = os.getenv("HISTORY_SUMMARY_MODEL", os.getenv("GEMINI_TEXT_MODEL", "gemini-2.5-flash"))
+    # 摘要任务走 Celery（默认队列 celery）；关闭或 broker 不可达时退回进程内后台任务。
+    # 默认关闭：broker 可达但没有 worker 消费默认队列时投递照样成功，较早的消息永远不会被折叠，
+    # 部署了默认队列 worker 再打开
+    summary_via_celery: bool = os.getenv("SUMMARY_VIA_CELERY", "false").lower() in ("1", "true", "yes")
     # session 总语料 token 数低于此阈值时，/chat 走全量上下文路径（跳过 RAG 检索）
     full_context_threshold: int = int(os.getenv("FULL_CONTEXT_THRESHOLD", "300000"))
+    # /chat prompt 的 token 预算：扣除 persona / 指令 / 问题后按份额分给近期对话、历史摘录、文档、web，超出按优先级裁剪
+    prompt_budget_tokens: int = int(os.getenv("PROMPT_BUDGET_TOKENS", "500000"))
+    # 用 Gemini count_tokens 计数（入库 chunk 按批、近期对话 / web 信息按内容缓存）；关闭或失败时按字符估算
+    token_count_api: bool = os.getenv("TOKEN_COUNT_API", "true").lower() in ("1", "true", "yes")
+    token_count_timeout: float = float(os.getenv("TOKEN_COUNT_TIMEOUT", "2.0"))   # 秒，单次 count_tokens 超时
+    token_count_wait: float = float(os.getenv("TOKEN_COUNT_WAIT", "0.2"))         # 秒，/chat 检索结束后最多再等计数
+    token_cache_size: int = int(os.getenv("TOKEN_CACHE_SIZE", "8192"))            # 文本 token 计数缓存条数
     # Phase 2 Agent 循环开关
     agent_chat_enabled: bool = os.getenv("AGENT_CHAT_ENABLED", "true").lower() in ("1", "true", "yes")
     # Agent 单次对话最多调用的工具数（含 LLM 决策轮）
     agent_max_iterations: int = int(os.getenv("AGENT_MAX_ITERATIONS", "6"))
+    # 语义回答缓存：同一会话、语料版本 / persona / prompt 版本不变时，query embedding 距离低于阈值直接复用回答
+    answer_cache_enabled: bool = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    answer_cache_max_distance: float = float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", "0.05"))
+    answer_cache_ttl_hours: int = int(os.getenv("ANSWER_CACHE_TTL_HOURS", "24"))
+    # 短于此字数的提问（“继续”“为什么？”等依赖上下文的追问）不查不存
+    answer_cache_min_chars: int = int(os.getenv("ANSWER_CACHE_MIN_CHARS", "8"))
+    # FULL_CONTEXT 路径的 Gemini 显式上下文缓存：全部文档建成 cached content，每轮只发送上下文与问题
+    context_cache_enabled: bool = os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    context_cache_ttl: int = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))                 # 秒，使用时剩余不足一半即续期
+    context_cache_min_tokens: int = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096"))   # 语料低于此规模不建缓存
+    # FULL_CONTEXT 拼接好的会话全文缓存：进程内预算（MB，0 = 关闭本地层）/ TTL（秒）/ 是否启用 Redis 共享层
+    corpus_cache_mb: int = int(os.getenv("CORPUS_CACHE_MB", "128"))
+    corpus_cache_ttl: int = int(os.getenv("CORPUS_CACHE_TTL", "3600"))
+    corpus_cache_shared: bool = os.getenv("CORPUS_CACHE_SHARED", "false").lower() in ("1", "true", "yes")
+    # Redis（与 Celery broker 同库），供各类共享缓存层使用
+    redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    # query embedding 缓存：进程内 LRU 条数 / TTL（秒）/ 是否启用 Redis 共享层
+    embed_cache_size: int = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+    embed_cache_ttl: int = int(os.getenv("EMBED_CACHE_TTL", "86400"))
+    embed_cache_shared: bool = os.getenv("EMBED_CACHE_SHARED", "false").lower() in ("1", "true", "yes")
+    # 批量 embedding（上传入库）：每批条数 / 同时在途批数 / 单批最大重试次数
+    embed_batch_size: int = int(os.getenv("EMBED_BATCH_SIZE", "50"))
+    embed_concurrency: int = int(os.getenv("EMBED_CONCURRENCY", "4"))
+    embed_max_retries: int = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+    # embedding 配额（进程级令牌桶，query 与上传共用）：每分钟请求数 / token 数，0 = 不限
+    embed_rpm: int = int(os.getenv("EMBED_RPM", "100"))
+    embed_tpm: int = int(os.getenv("EMBED_TPM", "0"))
+    # 扫描版 PDF 并行 OCR 的线程数（每个线程驱动外部 pdftoppm / tesseract 进程），0 = CPU 核数
+    ocr_workers: int = int(os.getenv("OCR_WORKERS", "0"))
+    # 文件解析入库走 Celery ingest 队列（独立 worker）；关闭或 broker 不可达时退回进程内后台任务。
+    # 默认关闭：broker 可达但没有 worker 消费 ingest 队列时投递照样成功，文件会一直停在 pending，
+    # 部署了 ingest worker 再打开
+    ingest_via_celery: bool = os.getenv("INGEST_VIA_CELERY", "false").lower() in ("1", "true", "yes")
     secret_key: str = os.getenv("SECRET_KEY")
     base_dir: Path = BASE_DIR
 
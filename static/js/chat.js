@@ -222,6 +222,57 @@ function makeSaveBtn(rawContent) {
     return $btn;
 }
 
+function renderCitations(citations) {
+    if (!citations || citations.length === 0) return '';
+    const citationItems = citations.map((c, i) => {
+        const snippet = c.snippet
+            ? `<blockquote class="citation-snippet">${escapeHtml(c.snippet)}${c.snippet.length >= 200 ? '…' : ''}</blockquote>`
+            : '';
+        return `<div class="citation-item">
+            <span class="citation-label">[${i + 1}]</span>
+            <span class="citation-source">${escapeHtml(c.source)}</span>
+            <span class="citation-meta">第 ${c.chunk + 1} 段 &nbsp;·&nbsp; 相关度 ${c.score}</span>
+            ${snippet}
+        </div>`;
+    }).join('');
+    return `<details class="citations">
+        <summary>📎 参考了 ${citations.length} 处文档内容</summary>
+        ${citationItems}
+    </details>`;
+}
+
+// 用最终回答 + 引用替换 loading 占位符
+function renderAnswer(loadingId, answer, citations) {
+    const $answerDiv = $("<div>", { class: "message assistant" });
+    $answerDiv.append($("<div>", { class: "msg-body", html: renderMarkdown(answer) + renderCitations(citations) }));
+    $answerDiv.append($("<div>", { class: "msg-actions" }).append(makeSaveBtn(answer)));
+    $('#' + loadingId).replaceWith($answerDiv);
+    $chatBox.animate({ scrollTop: $chatBox[0].scrollHeight }, 400);
+}
+
+// 逐条解析 fetch 返回的 SSE 流，回调 onEvent(event, data)
+async function readEventStream(resp, onEvent) {
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let sep;
+        while ((sep = buffer.indexOf('\n\n')) !== -1) {
+            const raw = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+            let event = 'message', data = '';
+            raw.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
+}
+
 // 加载历史消息
 async function loadMessages() {
 	try {
@@ -278,7 +329,8 @@ async function loadCollections(id) {
                 if (s.status === 'done') {
                     badgeHtml = `<span class="file-status-badge done">✓ 已入库 ${s.total_chunks || 0} 段</span>`;
                 } else if (s.status === 'processing') {
-                    const pct = s.total_chunks > 0 ? ` ${s.processed_chunks || 0}/${s.total_chunks}` : '';
+                    const pct = s.total_chunks > 0 ? ` ${s.processed_chunks || 0}/${s.total_chunks}`
+                        : s.total_pages > 0 ? ` OCR ${s.processed_pages || 0}/${s.total_pages} 页` : '';
                     badgeHtml = `<span class="file-status-badge processing">⏳ 解析中${pct}</span>`;
                 } else if (s.status === 'failed') {
                     badgeHtml = `<span class="file-status-badge failed reprocess-btn" data-filename="${escapeHtml(s.filename)}">❌ 失败，点击重试</span>`;
@@ -336,7 +388,8 @@ function startStatusPolling(filename, $msgDiv) {
             return true;
         }
         if (s.status === 'processing') {
-            const pct = s.total_chunks > 0 ? `，已处理 ${s.processed_chunks || 0}/${s.total_chunks} 段` : '';
+            const pct = s.total_chunks > 0 ? `，已处理 ${s.processed_chunks || 0}/${s.total_chunks} 段`
+                : s.total_pages > 0 ? `，OCR 已识别 ${s.processed_pages || 0}/${s.total_pages} 页` : '';
             $msgDiv.html(`<span>⏳ ${escapeHtml(filename)} 解析中${pct}…</span>`);
             return false;
         }
@@ -439,6 +492,7 @@ $(function () {
         try {
             const resp = await authFetch("/chat", {
                 method: "POST",
+                headers: { "Accept": "text/event-stream" },
                 body: new URLSearchParams({
                     session_id, message,
                     source_files: sourceFiles.join(',')
@@ -451,32 +505,45 @@ $(function () {
                 $chatBox.animate({ scrollTop: $chatBox[0].scrollHeight }, 400);
                 return;
             }
-            const data = await resp.json();
-            const renderedAnswer = renderMarkdown(data.answer);
-            let citationsHtml = '';
-            if (data.citations && data.citations.length > 0) {
-                const citationItems = data.citations.map((c, i) => {
-                    const snippet = c.snippet
-                        ? `<blockquote class="citation-snippet">${escapeHtml(c.snippet)}${c.snippet.length >= 200 ? '…' : ''}</blockquote>`
-                        : '';
-                    return `<div class="citation-item">
-                        <span class="citation-label">[${i + 1}]</span>
-                        <span class="citation-source">${escapeHtml(c.source)}</span>
-                        <span class="citation-meta">第 ${c.chunk + 1} 段 &nbsp;·&nbsp; 相关度 ${c.score}</span>
-                        ${snippet}
-                    </div>`;
-                }).join('');
-                citationsHtml = `<details class="citations">
-                    <summary>📎 参考了 ${data.citations.length} 处文档内容</summary>
-                    ${citationItems}
-                </details>`;
+            // 服务端对 SSE 请求返回 text/event-stream；出错等情况仍可能返回 JSON
+            const isStream = (resp.headers.get('content-type') || '').includes('text/event-stream');
+            if (!isStream) {
+                const data = await resp.json();
+                renderAnswer(loadingId, data.answer, data.citations);
+                return;
             }
-            // 移除 loading 占位符
-            const $answerDiv = $("<div>", { class: "message assistant" });
-            $answerDiv.append($("<div>", { class: "msg-body", html: renderedAnswer + citationsHtml }));
-            $answerDiv.append($("<div>", { class: "msg-actions" }).append(makeSaveBtn(data.answer)));
-            $('#' + loadingId).replaceWith($answerDiv);
-            $chatBox.animate({ scrollTop: $chatBox[0].scrollHeight }, 400);
+            let answer = '';
+            let citations = [];
+            let failed = false;
+            const $body = $("<div>", { class: "msg-body" });
+            const $progress = $("<div>", { class: "agent-progress", style: "color:#888;font-size:0.9em;" });
+            await readEventStream(resp, (event, data) => {
+                if (event === 'round_start') {
+                    // Agent 新一轮：上一轮的文本只是中间思考，清空草稿
+                    answer = '';
+                    $body.empty();
+                    $progress.append($("<div>", { text: `第 ${data.round} 轮推理…` }));
+                    if (data.round === 1) $('#' + loadingId).empty().append($progress, $body);
+                } else if (event === 'tool_call') {
+                    const args = Object.values(data.args || {}).join(', ');
+                    $progress.append($("<div>", { text: `🔧 ${data.tool}(${args})` }));
+                } else if (event === 'tool_result') {
+                    $progress.append($("<div>", { text: `↳ ${data.result_preview.slice(0, 80)}…` }));
+                } else if (event === 'delta') {
+                    if (!answer && !$progress.children().length) $('#' + loadingId).empty().append($body);
+                    answer += data.text;
+                    $body.html(renderMarkdown(answer));
+                    $chatBox.scrollTop($chatBox[0].scrollHeight);
+                } else if (event === 'done') {
+                    if (data.answer) answer = data.answer;
+                } else if (event === 'citations') {
+                    citations = data.citations || [];
+                } else if (event === 'error') {
+                    failed = true;
+                    $('#' + loadingId).replaceWith(`<div class="message assistant" style="color:#c62828;">${escapeHtml(data.detail || '请求失败')}</div>`);
+                }
+            });
+            if (!failed) renderAnswer(loadingId, answer, citations);
         } catch (error) {
             console.error("Error:", error);
             $('#' + loadingId).replaceWith(`<div class="message assistant">Error: Unable to fetch response.</div>`);